@@ -0,0 +1,76 @@
+"""Synthetic data, timing and memory helpers shared by the benchmarks.
+
+Importing this module puts `project/` on `sys.path`, as streamlit does for
+the app, so the benchmarks can import the app modules.
+"""
+import gc
+import os
+import sys
+import time
+from typing import Any, Callable, Optional, Tuple
+
+try:
+    import resource
+except ImportError:
+    # not on Windows: no peak RSS
+    resource = None
+
+PROJECT_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'project')
+if PROJECT_DIRPATH not in sys.path:
+    sys.path.insert(0, PROJECT_DIRPATH)
+
+import numpy as np
+import geopandas as gpd
+
+# Sweden in SWEREF 99 TM (EPSG:3006) and in EPSG:4326 (minx, miny, maxx, maxy)
+SWEDEN_EXTENT = (265_000, 6_130_000, 925_000, 7_680_000)
+SWEDEN_BOUNDS = (10.9, 55.3, 24.2, 69.1)
+
+
+def random_points(n: int, seed: int = 0, extent: tuple = SWEDEN_EXTENT,
+                  crs: str = 'EPSG:3006') -> gpd.GeoDataFrame:
+    """`n` points uniformly over `extent` (Sweden by default), with a random `value` column."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = extent
+    return gpd.GeoDataFrame(
+        {'value': rng.random(n)},
+        geometry=gpd.points_from_xy(rng.uniform(minx, maxx, n), rng.uniform(miny, maxy, n)),
+        crs=crs)
+
+
+def random_cells(n: int, resolution: int, seed: int = 0) -> np.ndarray:
+    """The distinct uint64 cells at `resolution` of `random_points(n, seed)`, sorted."""
+    from h3_funtools import points_to_h3
+    return np.unique(points_to_h3(random_points(n, seed), resolution).to_numpy())
+
+
+def timeit(function: Callable, repeat: int = 3, setup: Callable = None) -> Tuple[float, Any]:
+    """Best time of `repeat` calls of `function`, each after an untimed `setup()`, and the last result."""
+    best, result = float('inf'), None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        gc.collect()
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def peak_rss_mb() -> Optional[float]:
+    """Peak resident memory of this process, in MiB."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return round(peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10, 1)
+
+
+def rss_mb() -> Optional[float]:
+    """Current resident memory of this process, in MiB (the peak where it cannot be read)."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return peak_rss_mb()
+    return round(pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20, 1)
@@ -0,0 +1,64 @@
+"""Compares the size and encoding time of H3 FeatureCollections, per 100k features.
+
+The `iterrows` + `geojson.Feature` loop and `GeoDataFrame.to_json` used
+before are measured against `features.encode_*`, with polygon geometries,
+with the cell id only, and gzip compressed. Run from the repository root:
+
+    python benchmarks/bench_features.py --features 100000 --resolution 8
+"""
+import argparse
+import json
+
+import geojson
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+
+from bench_common import random_cells, timeit
+from features import encode_geodataframe, encode_h3_features
+from h3_funtools import cells_to_polygons, h3_int_to_str
+
+
+def iterrows_features(frame: pd.DataFrame) -> bytes:
+    """The former `latlong_to_geojson_string_h3_geometry` loop."""
+    features = []
+    for _, row in frame.iterrows():
+        features.append(geojson.feature.Feature(
+            geometry=row['geometry'].__geo_interface__, id=row['hex_id'],
+            properties={'count': int(row['count']), 'mean': float(row['mean'])}))
+    return json.dumps(geojson.feature.FeatureCollection(features)).encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--features', type=int, default=100_000)
+    parser.add_argument('--resolution', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    cells = random_cells(args.features, args.resolution)
+    rng = np.random.default_rng(1)
+    properties = pd.DataFrame({'count': rng.integers(0, 1000, len(cells)),
+                               'mean': rng.random(len(cells))})
+    gdf = gpd.GeoDataFrame(properties.assign(hex_id=h3_int_to_str(cells)),
+                           geometry=cells_to_polygons(cells), crs='EPSG:4326')
+
+    cases = {
+        'iterrows + geojson.Feature': lambda: iterrows_features(gdf),
+        'GeoDataFrame.to_json': lambda: gdf.to_json().encode(),
+        'encode_geodataframe': lambda: encode_geodataframe(gdf, id_column='hex_id'),
+        'encode_h3_features, polygons': lambda: encode_h3_features(cells, properties, with_geometry=True),
+        'encode_h3_features, ids only': lambda: encode_h3_features(cells, properties),
+        'encode_h3_features, ids only, gzip': lambda: encode_h3_features(cells, properties, compress=True),
+    }
+
+    scale = 100_000 / len(cells)
+    print(f'{len(cells):,} features at resolution {args.resolution}, figures per 100k features')
+    print(f"{'encoder':<38} {'seconds':>9} {'MiB':>9}")
+    for name, function in cases.items():
+        seconds, data = timeit(function, args.repeat)
+        print(f'{name:<38} {seconds * scale:>9.3f} {len(data) * scale / 2 ** 20:>9.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""Compares cold load time and peak RSS of the GeoPackage datasets against their GeoParquet copies.
+
+Each load runs in a fresh interpreter so that the timings and the peak
+resident memory are those of a cold start. Run from the repository root,
+with the datasets already in `./data/` (see `python project/prefetch.py`):
+
+    python benchmarks/bench_geoparquet.py --repeat 3
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+PROJECT_DIRPATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'project')
+sys.path.insert(0, PROJECT_DIRPATH)
+
+
+def load_once(fmt: str, filepath: str) -> dict:
+    """Loads `filepath` in this process and returns the time and peak RSS (child side)."""
+    import resource
+    import geopandas as gpd
+
+    start = time.perf_counter()
+    if fmt == 'gpkg':
+        gdf = gpd.read_file(filepath)
+    else:
+        gdf = gpd.read_parquet(filepath, memory_map=True)
+    seconds = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux
+    return {'seconds': seconds, 'rows': len(gdf),
+            'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024}
+
+
+def run_child(fmt: str, filepath: str) -> dict:
+    output = subprocess.run(
+        [sys.executable, __file__, '--child', fmt, filepath],
+        check=True, capture_output=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--dirpath', default='./data/')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--child', nargs=2, metavar=('FORMAT', 'FILEPATH'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(load_once(*args.child)))
+        return
+
+    from config import DATA_URL_DICT
+    from geoio import geoparquet_filepath, read_geodataframe
+
+    print(f"{'dataset':<48} {'format':<8} {'rows':>10} {'best s':>9} {'peak RSS MiB':>13}")
+    for item in DATA_URL_DICT.values():
+        gpkg_filepath = os.path.join(args.dirpath, item['name'])
+        if not os.path.exists(gpkg_filepath):
+            print(f"{item['name']:<48} missing, skipped")
+            continue
+        # creates the GeoParquet copy if needed
+        read_geodataframe(gpkg_filepath)
+        parquet_filepath = str(geoparquet_filepath(gpkg_filepath))
+
+        for fmt, filepath in (('gpkg', gpkg_filepath), ('parquet', parquet_filepath)):
+            runs = [run_child(fmt, filepath) for _ in range(args.repeat)]
+            best = min(runs, key=lambda run: run['seconds'])
+            print(f"{item['name']:<48} {fmt:<8} {best['rows']:>10,} {best['seconds']:>9.3f} "
+                  f"{max(run['max_rss_mib'] for run in runs):>13.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""Compares the row-wise `gdf.apply` H3 indexing with the batch `points_to_h3`.
+
+Run from the repository root:
+
+    python benchmarks/bench_h3_indexing.py --n-points 1000000 --resolution 8
+"""
+import argparse
+import os
+
+from h3 import h3
+
+from bench_common import SWEDEN_BOUNDS, random_points, timeit
+from h3_funtools import points_to_h3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--n-points', type=int, default=100_000)
+    parser.add_argument('--resolution', type=int, default=8)
+    parser.add_argument('--n-workers', type=int, default=os.cpu_count())
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    gdf = random_points(args.n_points, seed=42, extent=SWEDEN_BOUNDS, crs='EPSG:4326')
+    res = args.resolution
+
+    def row_wise():
+        return gdf.apply(lambda row: h3.geo_to_h3(
+            row.geometry.y, row.geometry.x, res), axis=1)
+
+    # the per-row path is far too slow to repeat on large inputs
+    t_row, _ = timeit(row_wise, repeat=1)
+    t_batch, _ = timeit(lambda: points_to_h3(gdf, res), repeat=args.repeat)
+    t_pool, _ = timeit(lambda: points_to_h3(gdf, res, n_workers=args.n_workers),
+                       repeat=args.repeat)
+
+    expected = row_wise().to_numpy()
+    got = points_to_h3(gdf, res, as_str=True).to_numpy()
+    assert (expected == got).all(), 'batch indexing differs from h3.geo_to_h3'
+
+    print(f'points: {args.n_points:,}  resolution: {res}')
+    for label, seconds in (('gdf.apply (row-wise)', t_row),
+                           ('points_to_h3', t_batch),
+                           (f'points_to_h3 n_workers={args.n_workers}', t_pool)):
+        print(f'{label:<36} {seconds:9.3f} s  {args.n_points / seconds:14,.0f} points/s'
+              f'  x{t_row / seconds:7.1f}')
+
+
+if __name__ == '__main__':
+    main()
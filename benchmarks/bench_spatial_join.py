@@ -0,0 +1,85 @@
+"""Compares the throughput of `spatial_join.points_in_polygons` with `gpd.sjoin`, in points/second.
+
+Two polygon layers are joined with random points: the 500 m hexagon grid
+(`DATA_URL_DICT[2]`, read from `./data/` if it is there, otherwise an
+equivalent synthetic grid) and a few large polygons with many vertices, as
+the dissolved NMD layers, where the H3 prefilter is used. Both joins are
+checked to return the same pairs. Run from the repository root:
+
+    python benchmarks/bench_spatial_join.py --points 1000000
+"""
+import argparse
+import os
+
+import numpy as np
+import geopandas as gpd
+import shapely
+
+from bench_common import random_points, timeit
+from config import DATA_URL_DICT
+from spatial_join import PointInPolygonJoin
+
+# SWEREF 99 TM extent of the synthetic layers
+EXTENT = (600_000, 6_500_000, 700_000, 6_600_000)
+
+
+def hexagon_grid(size: float = 500.0, extent: tuple = EXTENT) -> gpd.GeoDataFrame:
+    """Flat-topped hexagons `size` meters across the flats, covering `extent`."""
+    radius = size / np.sqrt(3)
+    minx, miny, maxx, maxy = extent
+    columns = np.arange(minx, maxx, 1.5 * radius)
+    rows = np.arange(miny, maxy, size)
+    x, y = (grid.ravel() for grid in np.meshgrid(columns, rows))
+    y = y + (np.round((x - minx) / (1.5 * radius)) % 2) * size / 2
+    angles = np.radians(np.arange(0, 360, 60))
+    rings = np.stack([x[:, None] + radius * np.cos(angles), y[:, None] + radius * np.sin(angles)], axis=-1)
+    return gpd.GeoDataFrame({'grid_id': np.arange(len(x))}, geometry=shapely.polygons(rings), crs='EPSG:3006')
+
+
+def complex_polygons(n: int = 12, vertices: int = 20_000, seed: int = 0) -> gpd.GeoDataFrame:
+    """Large lobed polygons (~15 km radius) with many vertices."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = EXTENT
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    polygons = []
+    for _ in range(n):
+        x, y = rng.uniform(minx, maxx), rng.uniform(miny, maxy)
+        radius = 15_000 * (1 + 0.3 * np.sin(7 * angles) + 0.02 * rng.random(vertices))
+        polygons.append(shapely.Polygon(np.c_[x + radius * np.cos(angles), y + radius * np.sin(angles)]))
+    return gpd.GeoDataFrame({'polygon_id': np.arange(n)}, geometry=polygons, crs='EPSG:3006')
+
+
+def run(name: str, polygons: gpd.GeoDataFrame, points: gpd.GeoDataFrame) -> None:
+    build, engine = timeit(lambda: PointInPolygonJoin(polygons), repeat=1)
+    seconds, joined = timeit(lambda: engine.join(points), repeat=1)
+    reference_seconds, reference = timeit(
+        lambda: gpd.sjoin(points, polygons, how='inner', predicate='intersects'), repeat=1)
+
+    same = set(zip(joined.index, joined['index_right'])) == set(zip(reference.index, reference['index_right']))
+    print(f'{name:<28} {len(polygons):>9,} {engine.resolution:>5} {build:>8.2f} '
+          f'{len(points) / seconds:>14,.0f} {len(points) / reference_seconds:>14,.0f} {str(same):>6}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=1_000_000)
+    parser.add_argument('--dirpath', default='./data/')
+    args = parser.parse_args()
+
+    grid_filepath = os.path.join(args.dirpath, DATA_URL_DICT[2]['name'])
+    if os.path.exists(grid_filepath):
+        grid = gpd.read_file(grid_filepath)
+        grid_name = DATA_URL_DICT[2]['name'][:28]
+    else:
+        grid = hexagon_grid()
+        grid_name = 'synthetic 500 m grid'
+
+    print(f"{'polygons':<28} {'count':>9} {'H3':>5} {'build s':>8} {'join pts/s':>14} {'sjoin pts/s':>14} {'same':>6}")
+    run(grid_name, grid, random_points(args.points, seed=1, extent=grid.total_bounds, crs=grid.crs))
+    polygons = complex_polygons()
+    run('large polygons, 20k vertices', polygons,
+        random_points(args.points // 10, seed=1, extent=polygons.total_bounds, crs=polygons.crs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,325 @@
+"""Times the geospatial hot paths on seeded synthetic data and flags regressions against a baseline.
+
+Points (and small lobed polygons, one per 1000 points) are drawn uniformly
+over the SWEREF 99 TM extent of Sweden, with a fixed seed, so every run
+measures the same work. Each case runs in its own interpreter, so that its
+peak RSS is its own; its time is the best of `--repeat` runs, each after an
+untimed setup (e.g. emptying `h3_cache` for the cold cases). Besides the
+peak RSS, the RSS reached above the one after building the data of the case
+is reported, which is the memory of the timed code.
+
+The results are written as JSON to `--output` and compared with the
+baseline of the same number of points: a case slower, or with a peak RSS
+larger, than the baseline by more than the tolerances is a regression and
+the exit code is 1. Run from the repository root:
+
+    python benchmarks/bench_suite.py --points 1000000
+    python benchmarks/bench_suite.py --points 1000000 --save-baseline
+
+The baselines are machine specific: save them on the machine that runs the
+comparison.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+from bench_common import SWEDEN_EXTENT, peak_rss_mb, random_points, rss_mb, timeit
+from bench_common import random_cells as _random_cells
+
+BENCHMARKS_DIRPATH = os.path.dirname(os.path.abspath(__file__))
+BASELINE_DIRPATH = os.path.join(BENCHMARKS_DIRPATH, 'baselines')
+OUTPUT_DIRPATH = os.path.join('data', 'benchmarks')
+POINT_COUNTS = (10_000, 1_000_000, 10_000_000)
+
+RESOLUTION = 8
+# points per synthetic polygon
+POINTS_PER_POLYGON = 1000
+# fields written to and read from the shelf, at most
+SHELF_MAX_FIELDS = 100_000
+# slower / larger than the baseline by more than this fraction is a regression
+TIME_TOLERANCE = 0.25
+RSS_TOLERANCE = 0.25
+# RSS over the setup below which deltas are compared as equal (MiB)
+RSS_DELTA_FLOOR_MB = 16
+
+
+def random_polygons(n: int, vertices: int = 64, seed: int = 1) -> gpd.GeoDataFrame:
+    """`n` lobed polygons of 1 to 4 km radius over Sweden, in EPSG:3006."""
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = SWEDEN_EXTENT
+    x = rng.uniform(minx, maxx, n)[:, None]
+    y = rng.uniform(miny, maxy, n)[:, None]
+    angles = np.linspace(0, 2 * np.pi, vertices, endpoint=False)
+    radius = rng.uniform(1_000, 4_000, n)[:, None] * (1 + 0.3 * np.sin(5 * angles + rng.uniform(0, 6, (n, 1))))
+    rings = np.stack([x + radius * np.cos(angles), y + radius * np.sin(angles)], axis=-1)
+    return gpd.GeoDataFrame({'polygon_id': np.arange(n)}, geometry=shapely.polygons(rings), crs='EPSG:3006')
+
+
+def random_cells(n: int, seed: int = 0) -> np.ndarray:
+    """The distinct cells at RESOLUTION of `random_points(n)`, sorted."""
+    return _random_cells(n, RESOLUTION, seed)
+
+
+def _clear_h3_cache() -> None:
+    from h3_cache import h3_cache
+    h3_cache.clear(disk=True)
+
+
+def _empty_dirpath(dirpath: str) -> None:
+    shutil.rmtree(dirpath, ignore_errors=True)
+    os.makedirs(dirpath)
+
+
+# Every case takes the number of points and a scratch folder, and returns
+# (setup, run, items): `setup()` is called, untimed, before each `run()`.
+
+def case_h3_indexing(n: int, dirpath: str):
+    from h3_funtools import points_to_h3
+    points = random_points(n)
+    return None, lambda: points_to_h3(points, RESOLUTION), n
+
+
+def case_polyfill(n: int, dirpath: str):
+    from polyfill import polyfill_membership
+    polygons = random_polygons(max(n // POINTS_PER_POLYGON, 10))
+    return _clear_h3_cache, lambda: polyfill_membership(polygons, RESOLUTION, n_workers=1), len(polygons)
+
+
+def case_polyfill_warm(n: int, dirpath: str):
+    from polyfill import polyfill_membership
+    polygons = random_polygons(max(n // POINTS_PER_POLYGON, 10))
+    polyfill_membership(polygons, RESOLUTION, n_workers=1)
+    return None, lambda: polyfill_membership(polygons, RESOLUTION, n_workers=1), len(polygons)
+
+
+def case_polygonize(n: int, dirpath: str):
+    from h3_funtools import cells_to_polygons
+    cells = random_cells(n)
+    return _clear_h3_cache, lambda: cells_to_polygons(cells), len(cells)
+
+
+def case_polygonize_warm(n: int, dirpath: str):
+    from h3_funtools import cells_to_polygons
+    cells = random_cells(n)
+    cells_to_polygons(cells)
+    return None, lambda: cells_to_polygons(cells), len(cells)
+
+
+def case_groupby(n: int, dirpath: str):
+    from h3_funtools import points_to_h3
+    from h3_store import aggregate_cells
+    points = random_points(n)
+    cells = points_to_h3(points, RESOLUTION).to_numpy()
+    values = points['value'].to_numpy()
+    return None, lambda: aggregate_cells(cells, values), n
+
+
+def case_geojson(n: int, dirpath: str):
+    from features import encode_features
+    from h3_funtools import cells_to_polygons, h3_int_to_str
+    cells = random_cells(n)
+    rng = np.random.default_rng(2)
+    properties = pd.DataFrame({'count': rng.integers(0, 1000, len(cells)), 'mean': rng.random(len(cells))})
+    polygons, ids = cells_to_polygons(cells), h3_int_to_str(cells)
+    return None, lambda: encode_features(properties, geometry=polygons, ids=ids), len(cells)
+
+
+def case_visualize_hexagons(n: int, dirpath: str):
+    from h3_funtools import h3_int_to_str, visualize_hexagons
+    hexagons = h3_int_to_str(random_cells(n))
+    bounds = ((55.3, 10.9), (69.1, 24.2))
+    # the whole country at zoom 5: the cells are rolled up to fit the map
+    return _clear_h3_cache, lambda: visualize_hexagons(
+        hexagons, zoom=5, bounds=bounds).get_root().render(), len(hexagons)
+
+
+def case_inshelve(n: int, dirpath: str):
+    from inshelve import Shelf
+    n_fields = min(n, SHELF_MAX_FIELDS)
+    data = {f'column_{i}': {'index': i, 'unit': 'm'} for i in range(n_fields)}
+    filepath = os.path.join(dirpath, 'shelf.sqlite')
+
+    def run():
+        shelf = Shelf(filepath)
+        shelf.persist(data, 'bench')
+        read = shelf.read('bench')
+        shelf.close()
+        return read
+
+    def setup():
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(filepath + suffix):
+                os.remove(filepath + suffix)
+
+    return setup, run, n_fields
+
+
+def case_download_button(n: int, dirpath: str):
+    from external import export_frame
+    points = random_points(n)
+    frame = pd.DataFrame({'x': points.geometry.x, 'y': points.geometry.y, 'value': points['value']})
+    exports_dirpath = os.path.join(dirpath, 'exports')
+    return (lambda: _empty_dirpath(exports_dirpath),
+            lambda: export_frame(frame, 'bench.csv', dirpath=exports_dirpath), n)
+
+
+CASES = {
+    'h3_indexing': case_h3_indexing,
+    'polyfill': case_polyfill,
+    'polyfill_warm': case_polyfill_warm,
+    'polygonize': case_polygonize,
+    'polygonize_warm': case_polygonize_warm,
+    'groupby': case_groupby,
+    'geojson': case_geojson,
+    'visualize_hexagons': case_visualize_hexagons,
+    'inshelve': case_inshelve,
+    'download_button': case_download_button,
+}
+
+
+def _run_case(name: str, n: int, repeat: int) -> dict:
+    """Runs in the child interpreter: times case `name`, with `h3_cache` in a scratch folder.
+
+    The RSS is recorded once the data of the case is built: `rss_delta_mb` is the
+    peak RSS of the runs above it, the memory of the timed code itself.
+    """
+    dirpath = tempfile.mkdtemp(prefix='bench_')
+    try:
+        from h3_cache import h3_cache
+        # the cache of the app is left alone
+        h3_cache.filepath = os.path.join(dirpath, 'h3_cache.sqlite')
+        setup, run, items = CASES[name](n, dirpath)
+        setup_rss = rss_mb()
+        best, _ = timeit(run, repeat, setup=setup)
+        peak = peak_rss_mb()
+        h3_cache.close()
+    finally:
+        shutil.rmtree(dirpath, ignore_errors=True)
+    return {'seconds': round(best, 4), 'items': int(items),
+            'items_per_s': round(items / best) if best > 0 else None, 'peak_rss_mb': peak,
+            'setup_rss_mb': setup_rss,
+            'rss_delta_mb': round(max(peak - setup_rss, 0.0), 1) if peak and setup_rss else None}
+
+
+def run_suite(n: int, cases: list, repeat: int) -> dict:
+    """Runs `cases` with `n` points, each in a new interpreter, and returns the results."""
+    results = {}
+    for name in cases:
+        command = [sys.executable, os.path.abspath(__file__), '--child', name,
+                   '--points', str(n), '--repeat', str(repeat)]
+        completed = subprocess.run(command, capture_output=True, text=True)
+        if completed.returncode != 0:
+            results[name] = {'error': completed.stderr.strip().splitlines()[-1] if completed.stderr else
+                             f'exit code {completed.returncode}'}
+        else:
+            results[name] = json.loads(completed.stdout.strip().splitlines()[-1])
+        print(f'{name:<20} {_format_result(results[name])}', flush=True)
+    return {'created': datetime.now(timezone.utc).isoformat(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'points': n,
+            'repeat': repeat,
+            'cases': results}
+
+
+def _format_result(result: dict) -> str:
+    if 'error' in result:
+        return f"error: {result['error']}"
+    return (f"{result['seconds']:>9.3f} s {result['peak_rss_mb'] or 0:>9.1f} MiB peak "
+            f"{result.get('rss_delta_mb') or 0:>+9.1f} MiB over setup {result['items']:>12,} items")
+
+
+def compare(results: dict, baseline: dict, time_tolerance: float = TIME_TOLERANCE,
+            rss_tolerance: float = RSS_TOLERANCE) -> list:
+    """The regressions of `results` against `baseline`, as (case, metric, ratio) tuples.
+
+    A case that failed, or whose time, peak RSS or RSS over its setup exceeds
+    the baseline by more than the tolerance, is a regression; cases without a
+    baseline are not. RSS deltas below RSS_DELTA_FLOOR_MB are compared as
+    the floor, so that the noise of small deltas is not flagged.
+    """
+    regressions = []
+    for name, result in results['cases'].items():
+        reference = baseline['cases'].get(name)
+        if reference is None or 'error' in reference:
+            continue
+        if 'error' in result:
+            regressions.append((name, 'error', None))
+            continue
+        for metric, tolerance in (('seconds', time_tolerance), ('peak_rss_mb', rss_tolerance),
+                                  ('rss_delta_mb', rss_tolerance)):
+            if result.get(metric) is None or reference.get(metric) is None:
+                continue
+            value, reference_value = result[metric], reference[metric]
+            if metric == 'rss_delta_mb':
+                value, reference_value = max(value, RSS_DELTA_FLOOR_MB), max(reference_value, RSS_DELTA_FLOOR_MB)
+            if not value or not reference_value:
+                continue
+            ratio = value / reference_value
+            if ratio > 1 + tolerance:
+                regressions.append((name, metric, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--points', type=int, default=POINT_COUNTS[0],
+                        help=f'points of the synthetic data, e.g. {", ".join(map(str, POINT_COUNTS))}')
+    parser.add_argument('--cases', nargs='+', choices=list(CASES), default=list(CASES))
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--output', help='results JSON. Defaults to data/benchmarks/bench_suite_<points>.json')
+    parser.add_argument('--baseline', help='baseline JSON. Defaults to benchmarks/baselines/bench_suite_<points>.json')
+    parser.add_argument('--save-baseline', action='store_true', help='write the results as the baseline')
+    parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--rss-tolerance', type=float, default=RSS_TOLERANCE)
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_run_case(args.child, args.points, args.repeat)))
+        return
+
+    filename = f'bench_suite_{args.points}.json'
+    output = args.output or os.path.join(OUTPUT_DIRPATH, filename)
+    baseline_filepath = args.baseline or os.path.join(BASELINE_DIRPATH, filename)
+
+    print(f'{args.points:,} points, H3 resolution {RESOLUTION}, best of {args.repeat}')
+    results = run_suite(args.points, args.cases, args.repeat)
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'results written to {output}')
+
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(os.path.abspath(baseline_filepath)), exist_ok=True)
+        shutil.copyfile(output, baseline_filepath)
+        print(f'baseline written to {baseline_filepath}')
+        return
+    if not os.path.exists(baseline_filepath):
+        print(f'no baseline {baseline_filepath}, nothing compared (see --save-baseline)')
+        return
+
+    with open(baseline_filepath) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.time_tolerance, args.rss_tolerance)
+    for name, metric, ratio in regressions:
+        print(f'REGRESSION {name}: {metric}' + (f' x{ratio:.2f} of the baseline' if ratio else ''))
+    if regressions:
+        sys.exit(1)
+    print(f'no regression against {baseline_filepath}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
+import os
+
 SERVICES_YAML_URL = './project/app_services.yaml'
+# legacy `shelve` file, imported into SHELF_FILEPATH when that is created
 SHELVE_FILEPATH = './data/aquabiota_shelve'
+SHELF_FILEPATH = './data/aquabiota_shelf.sqlite'
+DATA_DIRPATH = './data/'
 
 FILE_TYPES = ["yaml", "yml"]
 
@@ -15,3 +20,60 @@ DATA_URL_DICT = {
         'name': 'qgis_centroids_hexgrid_500m_MMV_havet.gpkg'}
 
 }
+
+# Maximum number of features held in memory when streaming a dataset
+GEO_CHUNK_SIZE = 100_000
+
+# On-disk per-cell H3 aggregates, one folder per dataset fingerprint
+H3_STORE_DIRPATH = './data/h3_store'
+
+# Per-resolution H3 aggregates (Parquet) and the range of resolutions
+# precomputed for them, as (coarsest, finest)
+H3_PYRAMID_DIRPATH = './data/h3_pyramid'
+H3_PYRAMID_RESOLUTIONS = (4, 10)
+
+# Memory budget of the GeoDataFrames cached for all the sessions
+DATASET_CACHE_MAX_BYTES = 2 * 1024 ** 3
+
+# Columnar (GeoParquet) copies of the vector datasets, for fast cold starts
+GEOPARQUET_CACHE_DIRPATH = './data/geoparquet'
+
+# GeoTIFFs offered for zonal statistics per H3 cell in the hexagon service
+ZONAL_RASTER_DIRPATH = './data/rasters'
+
+# Registry and results of the background jobs, and the worker processes running them
+JOBS_DIRPATH = './data/jobs'
+JOBS_MAX_WORKERS = int(os.environ.get('JOBS_MAX_WORKERS', 2))
+
+# Parquet copies of the tab-separated files uploaded to the ETL service, and
+# the station blocks parsed per chunk
+INGEST_DIRPATH = './data/ingest'
+INGEST_CHUNK_STATIONS = 10_000
+
+# Files offered by `external.download_button`, one folder per export, and the
+# age and total size past which the least recently used folders are removed
+EXPORTS_DIRPATH = './data/exports'
+EXPORTS_MAX_AGE_SECONDS = 24 * 3600
+EXPORTS_MAX_BYTES = 2 * 1024 ** 3
+
+# Startup profiles written by `profiling.py`
+PROFILING_DIRPATH = './data/profiling'
+
+# Memoized H3 geometry (cell boundaries and centers, polyfills, merged cell
+# sets): the database kept across restarts and its budget, and the memory
+# budget of the entries held in memory by each process
+H3_CACHE_FILEPATH = './data/h3_cache.sqlite'
+H3_CACHE_MAX_DISK_BYTES = 2 * 1024 ** 3
+H3_CACHE_MAX_BYTES = 512 * 1024 ** 2
+
+# HTTP server started next to Streamlit for tiles and downloads; the public
+# URL is the one the browser uses to reach it. It only listens on this machine
+# unless LOCAL_SERVER_HOST says otherwise (docker-compose sets 0.0.0.0)
+LOCAL_SERVER_HOST = os.environ.get('LOCAL_SERVER_HOST', '127.0.0.1')
+LOCAL_SERVER_PORT = int(os.environ.get('LOCAL_SERVER_PORT', 8765))
+LOCAL_SERVER_PUBLIC_URL = os.environ.get(
+    'LOCAL_SERVER_PUBLIC_URL', f'http://localhost:{LOCAL_SERVER_PORT}')
+# ports tried from LOCAL_SERVER_PORT on when it is in use (e.g. by another app
+# process). Only raise it if the browser can reach all of them: docker-compose
+# publishes LOCAL_SERVER_PORT alone, so by default a taken port is an error
+LOCAL_SERVER_PORT_ATTEMPTS = int(os.environ.get('LOCAL_SERVER_PORT_ATTEMPTS', 1))
@@ -0,0 +1,174 @@
+"""Process-wide cache of parsed GeoDataFrames shared by all Streamlit sessions.
+
+Entries are keyed by the absolute path, mtime, size and content fingerprint
+of the file, so a file changed on disk is never served from the cache. The
+cache is bounded by an estimate of the memory used by the cached frames
+and evicts the least recently used ones first. The most recent frame is
+always kept, even one larger than the budget, so the reruns of the session
+that loaded it do not parse it again.
+"""
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Union
+
+import numpy as np
+
+from turpy.logger import log
+from config import DATASET_CACHE_MAX_BYTES
+from geoio import file_fingerprint, read_geodataframe
+from lazy import lazy_import
+
+gpd = lazy_import('geopandas')
+
+
+def estimate_nbytes(gdf: 'gpd.GeoDataFrame') -> int:
+    """Approximate memory used by `gdf`, including its geometries."""
+    nbytes = int(gdf.memory_usage(index=True, deep=True).sum())
+    for column in gdf.columns[gdf.dtypes == 'geometry']:
+        nbytes += int(gdf[column].to_wkb().str.len().sum())
+    return nbytes
+
+
+def freeze(gdf: 'gpd.GeoDataFrame') -> 'gpd.GeoDataFrame':
+    """Makes the value arrays of `gdf` (and of its shallow copies) read-only, in place.
+
+    Writing into them, e.g. `gdf.loc[0, 'a'] = 1`, then raises `ValueError`
+    instead of changing the frame of every session sharing them.
+    """
+    for block in gdf._mgr.blocks:
+        values = block.values
+        # numpy blocks, the geometry array and the masked (nullable) arrays
+        for array in (values, getattr(values, '_data', None), getattr(values, '_mask', None),
+                      getattr(values, '_ndarray', None)):
+            if isinstance(array, np.ndarray):
+                array.setflags(write=False)
+    return gdf
+
+
+class _Entry:
+    __slots__ = ('gdf', 'nbytes')
+
+    def __init__(self, gdf: 'gpd.GeoDataFrame', nbytes: int):
+        self.gdf = gdf
+        self.nbytes = nbytes
+
+
+class DatasetCache:
+    """LRU cache of GeoDataFrames bounded in bytes.
+
+    Concurrent requests for the same file wait for a single parse and then
+    share it. The cached frame itself is never handed out:
+
+    - `mode='view'` returns a shallow copy of the cached frame, whose value
+      arrays are read-only (see `freeze`); adding, dropping or replacing
+      columns (e.g. `to_crs`, `gdf[col] = ...`) does not affect the cache,
+      and modifying values in place raises `ValueError`.
+    - `mode='copy'` returns a deep copy that may be modified freely.
+
+    Args:
+        max_bytes (int, optional): memory budget. Defaults to DATASET_CACHE_MAX_BYTES.
+        loader (Callable, optional): parses a file. Defaults to `geoio.read_geodataframe`.
+    """
+
+    def __init__(self, max_bytes: int = DATASET_CACHE_MAX_BYTES,
+                 loader: 'Callable[[str], gpd.GeoDataFrame]' = read_geodataframe):
+        self.max_bytes = max_bytes
+        self._loader = loader
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    @staticmethod
+    def _key(filepath: Union[str, Path]) -> tuple:
+        stat = os.stat(filepath)
+        return (os.path.abspath(filepath), stat.st_mtime_ns, stat.st_size,
+                file_fingerprint(filepath))
+
+    @staticmethod
+    def _hand_out(gdf: 'gpd.GeoDataFrame', mode: str) -> 'gpd.GeoDataFrame':
+        if mode == 'view':
+            return gdf.copy(deep=False)
+        if mode == 'copy':
+            return gdf.copy(deep=True)
+        raise ValueError(f"mode must be 'view' or 'copy', got {mode!r}")
+
+    def _evict(self) -> None:
+        # the most recent entry stays, whatever its size
+        while self._nbytes > self.max_bytes and len(self._entries) > 1:
+            _, entry = self._entries.popitem(last=False)
+            self._nbytes -= entry.nbytes
+            self._evictions += 1
+
+    def _discard_stale(self, key: tuple) -> None:
+        # older versions of the same file can never be served again
+        for stale in [k for k in self._entries if k[0] == key[0] and k != key]:
+            self._nbytes -= self._entries.pop(stale).nbytes
+
+    def get(self, filepath: Union[str, Path], mode: str = 'view') -> 'gpd.GeoDataFrame':
+        """Returns the GeoDataFrame of `filepath`, parsing it only if it is not cached."""
+        key = self._key(filepath)
+        while True:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return self._hand_out(entry.gdf, mode)
+                event = self._loading.get(key)
+                owner = event is None
+                if owner:
+                    event = self._loading[key] = threading.Event()
+            if owner:
+                break
+            # another session is parsing the same file
+            event.wait()
+
+        try:
+            gdf = freeze(self._loader(key[0]))
+            nbytes = estimate_nbytes(gdf)
+        except BaseException:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+            raise
+
+        # the entry is published before the waiting sessions are woken up
+        with self._lock:
+            self._misses += 1
+            self._discard_stale(key)
+            if nbytes > self.max_bytes:
+                log.warning(f'dataset_cache: {key[0]} ({nbytes} bytes) exceeds the cache budget '
+                            f'of {self.max_bytes} bytes, cached alone until the next dataset')
+            self._entries[key] = _Entry(gdf, nbytes)
+            self._nbytes += nbytes
+            self._evict()
+            del self._loading[key]
+        event.set()
+        return self._hand_out(gdf, mode)
+
+    def stats(self) -> dict:
+        """Returns hit/miss/eviction counters and the memory in use."""
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else 0.0,
+                    'evictions': self._evictions,
+                    'entries': len(self._entries),
+                    'nbytes': self._nbytes,
+                    'max_bytes': self.max_bytes}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+# shared by every session of the app process
+dataset_cache = DatasetCache()
@@ -1,16 +1,259 @@
+"""Download links for the services.
+
+The objects are written once to a file in `EXPORTS_DIRPATH` (DataFrames in
+chunks: gzipped CSV, Parquet or GeoPackage) and served by the local server,
+instead of being embedded in the page as base64. An export is named after a
+fingerprint of its content and options, so the reruns rendering the same
+download link only hash the DataFrame again, without encoding anything.
+Folders unused for `EXPORTS_MAX_AGE_SECONDS`, and the least recently used
+ones past `EXPORTS_MAX_BYTES`, are removed after each new export.
+"""
 import os
 
-import base64
+import gzip
+import hashlib
 import json
 import pickle
-import uuid
 import re
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Iterator
 
 import streamlit as st
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from turpy.logger import log
+from config import EXPORTS_DIRPATH, EXPORTS_MAX_AGE_SECONDS, EXPORTS_MAX_BYTES, GEO_CHUNK_SIZE
+from local_server import ensure_server, register_route
+
+try:
+    import geopandas as gpd
+except ImportError:
+    gpd = None
+
+# export formats by file extension
+EXPORT_FORMATS = {'.csv': 'csv', '.tsv': 'csv', '.txt': 'csv', '.parquet': 'parquet', '.gpkg': 'gpkg'}
+CONTENT_TYPES = {'.gz': 'application/gzip', '.parquet': 'application/vnd.apache.parquet',
+                 '.gpkg': 'application/geopackage+sqlite3'}
+
+
+def _frame_chunks(frame: pd.DataFrame, chunk_size: int = GEO_CHUNK_SIZE) -> Iterator[pd.DataFrame]:
+    for start in range(0, max(len(frame), 1), chunk_size):
+        yield frame.iloc[start:start + chunk_size]
+
+
+def frame_fingerprint(frame: pd.DataFrame, index: bool = True, chunk_size: int = GEO_CHUNK_SIZE) -> str:
+    """Hash of the content, columns and dtypes of a (Geo)DataFrame, computed in chunks."""
+    digest = hashlib.sha256()
+    digest.update(repr([(str(column), str(dtype)) for column, dtype in frame.dtypes.items()]).encode())
+    geometry_columns = [column for column, dtype in frame.dtypes.items() if str(dtype) == 'geometry']
+    for chunk in _frame_chunks(frame, chunk_size):
+        if geometry_columns:
+            chunk = pd.DataFrame(chunk).assign(**{column: chunk[column].to_wkb() for column in geometry_columns})
+        try:
+            digest.update(pd.util.hash_pandas_object(chunk, index=index).to_numpy().tobytes())
+        except TypeError:
+            # unhashable values (e.g. lists)
+            digest.update(pickle.dumps(chunk))
+    return digest.hexdigest()[:32]
+
+
+def _write_csv(frame: pd.DataFrame, filepath: Path, sep: str, encoding: str, index: bool, compress: bool):
+    opener = gzip.open if compress else open
+    with opener(filepath, 'wt', encoding=encoding, newline='') as f:
+        for i, chunk in enumerate(_frame_chunks(frame)):
+            chunk.to_csv(f, sep=sep, index=index, header=i == 0)
+
+
+def _write_parquet(frame: pd.DataFrame, filepath: Path, index: bool):
+    if gpd is not None and isinstance(frame, gpd.GeoDataFrame):
+        # GeoParquet metadata is written for the whole frame
+        frame.to_parquet(filepath, index=index, compression='snappy')
+        return
+    writer = None
+    try:
+        for chunk in _frame_chunks(frame):
+            table = pa.Table.from_pandas(
+                chunk, schema=writer.schema if writer is not None else None, preserve_index=index)
+            if writer is None:
+                writer = pq.ParquetWriter(str(filepath), table.schema, compression='snappy')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
 
 
-def download_button(object_to_download, download_filename, button_text, pickle_it=False, sep='\t', encoding='utf-8', index=True):
+def _write_gpkg(frame: pd.DataFrame, filepath: Path, index: bool):
+    if gpd is None or not isinstance(frame, gpd.GeoDataFrame):
+        raise ValueError('GeoPackage exports need a GeoDataFrame')
+    for i, chunk in enumerate(_frame_chunks(frame)):
+        chunk.to_file(filepath, driver='GPKG', index=index, mode='a' if i else 'w')
+
+
+def export_frame(frame: pd.DataFrame, download_filename: str, sep: str = '\t', encoding: str = 'utf-8',
+                 index: bool = True, compress: bool = True, dirpath: str = EXPORTS_DIRPATH) -> Path:
+    """Writes `frame` to an export file, unless the same export exists, and returns its path.
+
+    Args:
+        frame (pd.DataFrame): DataFrame or GeoDataFrame.
+        download_filename (str): file name, whose extension gives the format: CSV
+            (.csv, .tsv, .txt), Parquet (.parquet) or GeoPackage (.gpkg).
+        sep (str, optional): CSV separator. Defaults to tab.
+        encoding (str, optional): CSV encoding. Defaults to 'utf-8'.
+        index (bool, optional): write the index. Defaults to True.
+        compress (bool, optional): gzip the CSV exports ('.gz' is appended to their name).
+            Defaults to True.
+        dirpath (str, optional): exports folder. Defaults to EXPORTS_DIRPATH.
+
+    Returns:
+        Path: the export, in a folder named after its fingerprint.
+    """
+    download_filename = os.path.basename(download_filename)
+    extension = os.path.splitext(download_filename)[1].lower()
+    export_format = EXPORT_FORMATS.get(extension)
+    if export_format is None:
+        raise ValueError(f'no export format for {download_filename}')
+    compress = compress and export_format == 'csv'
+    if compress:
+        download_filename += '.gz'
+
+    options = json.dumps([export_format, sep, encoding, index, compress])
+    key = hashlib.sha256(f'{frame_fingerprint(frame, index=index)}{options}'.encode()).hexdigest()[:32]
+    filepath = Path(dirpath) / key / download_filename
+    if _touch(filepath):
+        return filepath
+
+    with _export_locks_lock:
+        lock = _export_locks.setdefault(key, threading.Lock())
+    try:
+        with lock:
+            if _touch(filepath):
+                return filepath
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            tmp_filepath = filepath.with_name(f'tmp-{os.getpid()}-{threading.get_ident()}-{download_filename}')
+            try:
+                if export_format == 'csv':
+                    _write_csv(frame, tmp_filepath, sep, encoding, index, compress)
+                elif export_format == 'parquet':
+                    _write_parquet(frame, tmp_filepath, index)
+                else:
+                    _write_gpkg(frame, tmp_filepath, index)
+                os.replace(tmp_filepath, filepath)
+            finally:
+                if tmp_filepath.exists():
+                    tmp_filepath.unlink()
+    finally:
+        # the export exists (or failed) once the lock is released: later calls
+        # find the file, so the entry is not needed anymore
+        with _export_locks_lock:
+            if _export_locks.get(key) is lock:
+                del _export_locks[key]
+    log.info(f'export_frame: {len(frame):,} rows written to {filepath}')
+    cleanup_exports(dirpath, keep=key)
+    return filepath
+
+
+def export_bytes(payload: bytes, download_filename: str, dirpath: str = EXPORTS_DIRPATH) -> Path:
+    """Writes `payload` to an export file named after its hash, unless it exists, and returns its path."""
+    download_filename = os.path.basename(download_filename)
+    key = hashlib.sha256(payload).hexdigest()[:32]
+    filepath = Path(dirpath) / key / download_filename
+    if not _touch(filepath):
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        tmp_filepath = filepath.with_name(f'tmp-{os.getpid()}-{threading.get_ident()}-{download_filename}')
+        tmp_filepath.write_bytes(payload)
+        os.replace(tmp_filepath, filepath)
+        cleanup_exports(dirpath, keep=key)
+    return filepath
+
+
+def _touch(filepath: Path) -> bool:
+    """Marks the folder of an existing export as used now; False if the export does not exist."""
+    if not filepath.exists():
+        return False
+    try:
+        os.utime(filepath.parent)
+    except OSError:
+        pass
+    return True
+
+
+def cleanup_exports(dirpath: str = EXPORTS_DIRPATH, max_age_seconds: float = EXPORTS_MAX_AGE_SECONDS,
+                    max_bytes: int = EXPORTS_MAX_BYTES, keep: str = None) -> int:
+    """Removes the export folders unused for `max_age_seconds`, then the least recently used ones
+    until the folders total at most `max_bytes`.
+
+    A folder counts as used when its export is written or requested again. The
+    folders of the exports being written, and `keep`, are left in place.
+
+    Args:
+        dirpath (str, optional): exports folder. Defaults to EXPORTS_DIRPATH.
+        max_age_seconds (float, optional): Defaults to EXPORTS_MAX_AGE_SECONDS.
+        max_bytes (int, optional): Defaults to EXPORTS_MAX_BYTES.
+        keep (str, optional): key of a folder to keep, e.g. the export just written.
+
+    Returns:
+        int: number of folders removed.
+    """
+    with _export_locks_lock:
+        busy = set(_export_locks)
+    if keep is not None:
+        busy.add(keep)
+    folders = []
+    try:
+        entries = list(os.scandir(dirpath))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.is_dir() or entry.name in busy:
+            continue
+        try:
+            nbytes = sum(f.stat().st_size for f in os.scandir(entry.path) if f.is_file())
+            folders.append((entry.stat().st_mtime, nbytes, entry.path))
+        except FileNotFoundError:
+            continue
+    folders.sort()
+
+    removed = 0
+    total = sum(nbytes for _, nbytes, _ in folders)
+    now = time.time()
+    for mtime, nbytes, path in folders:
+        if now - mtime <= max_age_seconds and total <= max_bytes:
+            break
+        shutil.rmtree(path, ignore_errors=True)
+        total -= nbytes
+        removed += 1
+    if removed:
+        log.info(f'cleanup_exports: {removed} export folders removed from {dirpath}')
+    return removed
+
+
+def export_url(filepath: Path) -> str:
+    """URL of an export on the local server."""
+    filepath = Path(filepath)
+    return f'{ensure_server()}/exports/{filepath.parent.name}/{filepath.name}'
+
+
+def _handle_export_request(path: str, query: dict):
+    key, _, filename = path.partition('/')
+    if not re.fullmatch('[0-9a-f]{32}', key) or not filename or '/' in filename or filename.startswith('.'):
+        return 404, {}, b''
+    filepath = Path(EXPORTS_DIRPATH) / key / filename
+    if not filepath.is_file():
+        return 404, {}, b''
+    content_type = CONTENT_TYPES.get(filepath.suffix.lower(), 'application/octet-stream')
+    return 200, {'Content-Type': content_type,
+                 'Content-Disposition': f'attachment; filename="{filename}"'}, open(filepath, 'rb')
+
+
+register_route('exports', _handle_export_request)
+
+
+def download_button(object_to_download, download_filename, button_text, pickle_it=False, sep='\t', encoding='utf-8', index=True, compress=True):
     """
     Generates a link to download the given object_to_download.
     Params:
@@ -21,6 +264,13 @@ def download_button(object_to_download, download_filename, button_text, pickle_i
     link.
     button_text (str): Text to display on download button (e.g. 'click here to download file')
     pickle_it (bool): If True, pickle file.
+    compress (bool): If True, gzip the CSV exports of DataFrames ('.gz' is
+    appended to download_filename).
+
+    DataFrames are exported by extension of download_filename: CSV (.csv,
+    .tsv, .txt), Parquet (.parquet) or GeoPackage (.gpkg, GeoDataFrames).
+    The file is written once, in chunks, and served by the local server
+    (see `export_frame`).
     Returns:
     -------
     (str): the anchor tag to download object_to_download
@@ -45,33 +295,37 @@ def download_button(object_to_download, download_filename, button_text, pickle_i
     https://discuss.streamlit.io/t/a-download-button-with-custom-css/4220
     https://gist.github.com/chad-m/6be98ed6cf1c4f17d09b7f6e5ca2978f
     """
-    if pickle_it:
+    if isinstance(object_to_download, pd.DataFrame) and not pickle_it:
+        # written in chunks to a file, once per content
         try:
-            object_to_download = pickle.dumps(object_to_download)
-        except pickle.PicklingError as e:
+            filepath = export_frame(object_to_download, download_filename,
+                                    sep=sep, encoding=encoding, index=index, compress=compress)
+        except ValueError as e:
             st.write(e)
             return None
+        download_filename = filepath.name
 
     else:
-        if isinstance(object_to_download, bytes):
-            pass
+        if pickle_it:
+            try:
+                object_to_download = pickle.dumps(object_to_download)
+            except pickle.PicklingError as e:
+                st.write(e)
+                return None
 
-        elif isinstance(object_to_download, pd.DataFrame):
-            object_to_download = object_to_download.to_csv(index=index, sep=sep, encoding=encoding)
+        elif isinstance(object_to_download, bytes):
+            pass
 
         # Try JSON encode for everything else
         else:
             object_to_download = json.dumps(object_to_download)
 
-    try:
-        # some strings <-> bytes conversions necessary here
-        b64 = base64.b64encode(object_to_download.encode()).decode()
-
-    except AttributeError as e:
-        b64 = base64.b64encode(object_to_download).decode()
+        if isinstance(object_to_download, str):
+            object_to_download = object_to_download.encode(encoding)
+        filepath = export_bytes(object_to_download, download_filename)
 
-    button_uuid = str(uuid.uuid4()).replace('-', '')
-    button_id = re.sub('\d+', '', button_uuid)
+    # the same export renders the same button on every rerun
+    button_id = f'download-{filepath.parent.name[:16]}'
 
     custom_css = f""" 
         <style>
@@ -99,6 +353,11 @@ def download_button(object_to_download, download_filename, button_text, pickle_i
         </style> """
 
     dl_link = custom_css + \
-        f'<a download="{download_filename}" id="{button_id}" href="data:file/txt;base64,{b64}">{button_text}</a><br></br>'
+        f'<a download="{download_filename}" id="{button_id}" href="{export_url(filepath)}">{button_text}</a><br></br>'
 
     return dl_link
+
+
+# shared by every session of the app process
+_export_locks = {}
+_export_locks_lock = threading.Lock()
@@ -0,0 +1,214 @@
+"""Fast GeoJSON FeatureCollection encoding from column arrays.
+
+Features are written straight from the columns of a frame and from the
+GeoJSON of the geometries produced in bulk by shapely, then joined as bytes,
+instead of building a `geojson.Feature` or a pandas row per feature.
+Coordinates are rounded to `precision` decimals (6 decimals is ~0.1 m) and
+the output can be gzip compressed.
+
+H3 layers can also be encoded with the cell id as the only geometry: the
+feature `id` is the hexadecimal cell and `geometry` is null, and the
+browser rebuilds the hexagons with h3-js (see `H3GeoJsonLayer`). This is
+several times smaller than the polygons.
+"""
+import gzip
+import json
+from typing import Iterable, Mapping, Union
+
+import importlib.util
+
+import numpy as np
+import pandas as pd
+from branca.element import JavascriptLink, MacroElement
+from jinja2 import Template
+
+from h3_funtools import cells_to_polygons, h3_int_to_str, h3_to_int_array
+from lazy import lazy_import
+
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+# imported on the first encoding, if installed
+orjson = lazy_import('orjson') if importlib.util.find_spec('orjson') is not None else None
+
+# decimals kept in the coordinates (~0.1 m)
+DEFAULT_PRECISION = 6
+GZIP_COMPRESSLEVEL = 6
+H3_JS_URL = 'https://unpkg.com/h3-js@3.7.2/dist/h3-js.umd.js'
+
+Columns = Union[pd.DataFrame, Mapping[str, Iterable]]
+
+
+def dumps(obj) -> bytes:
+    """Serializes `obj` to compact JSON bytes, with orjson when it is installed.
+
+    Values JSON has no type for (dates, decimals, ...) are written as their `str`.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(obj, separators=(',', ':'), allow_nan=False, default=str).encode()
+
+
+def _column_values(values) -> list:
+    """Python values of a column, with missing values as None (JSON null).
+
+    Datetimes and timedeltas are written as strings, as `GeoDataFrame.to_json` does.
+    """
+    series = pd.Series(values)
+    missing = series.isna()
+    if series.dtype.kind in 'Mm':
+        series = series.astype(str)
+    if series.dtype.kind in 'fcO' or missing.any():
+        series = series.astype(object).where(~missing, None)
+    return series.tolist()
+
+
+def _properties_json(properties: Columns, n: int) -> list:
+    if properties is None or len(properties.keys()) == 0:
+        return [b'{}'] * n
+    names = [str(name) for name in properties.keys()]
+    columns = [_column_values(properties[name]) for name in properties.keys()]
+    return [dumps(dict(zip(names, row))) for row in zip(*columns)]
+
+
+def _round_coordinates(coordinates, precision: int):
+    array = np.asarray(coordinates, dtype=object)
+    if array.ndim == 2 and array.shape[-1] in (2, 3):
+        return np.round(np.asarray(coordinates, dtype=float), precision).tolist()
+    return [_round_coordinates(part, precision) for part in coordinates]
+
+
+def _geometries_json(geometry, precision: int) -> list:
+    geometries = np.asarray(gpd.GeoSeries(geometry).values, dtype=object)
+    if hasattr(shapely, 'to_geojson'):
+        # shapely >= 2: rounding and writing are vectorized
+        if precision is not None:
+            geometries = shapely.transform(geometries, lambda coords: np.round(coords, precision))
+        return [b'null' if text is None else text.encode()
+                for text in shapely.to_geojson(geometries).tolist()]
+
+    encoded = []
+    for geom in geometries:
+        if geom is None or geom.is_empty:
+            encoded.append(b'null')
+            continue
+        geojson_geom = dict(shapely.geometry.mapping(geom))
+        if precision is not None:
+            geojson_geom['coordinates'] = _round_coordinates(geojson_geom['coordinates'], precision)
+        encoded.append(dumps(geojson_geom))
+    return encoded
+
+
+def encode_features(
+    properties: Columns = None,
+    geometry: Iterable = None,
+    ids: Iterable = None,
+    precision: int = DEFAULT_PRECISION,
+    compress: bool = False
+) -> bytes:
+    """Encodes columns as a GeoJSON FeatureCollection.
+
+    Args:
+        properties (Columns, optional): property columns, a DataFrame or a mapping of
+            name to array. Defaults to None (empty properties).
+        geometry (Iterable, optional): shapely geometries, in EPSG:4326. Defaults to None
+            (null geometries).
+        ids (Iterable, optional): feature ids. Defaults to None (no id).
+        precision (int, optional): decimals kept in the coordinates, None for all.
+            Defaults to DEFAULT_PRECISION.
+        compress (bool, optional): gzip the output. Defaults to False.
+
+    Returns:
+        bytes: the FeatureCollection, UTF-8 encoded (gzip compressed if `compress`).
+    """
+    lengths = {len(values) for values in (geometry, ids) if values is not None}
+    if properties is not None and len(properties.keys()):
+        lengths.add(len(next(iter(properties.values())) if isinstance(properties, Mapping)
+                        else properties))
+    if len(lengths) > 1:
+        raise ValueError(f'properties, geometry and ids differ in length: {sorted(lengths)}')
+    n = lengths.pop() if lengths else 0
+
+    properties_json = _properties_json(properties, n)
+    geometries_json = _geometries_json(geometry, precision) if geometry is not None else [b'null'] * n
+    if ids is not None:
+        heads = [b'{"type":"Feature","id":' + dumps(i) + b',"geometry":'
+                 for i in _column_values(ids)]
+    else:
+        heads = [b'{"type":"Feature","geometry":'] * n
+
+    features = b','.join(head + geom + b',"properties":' + props + b'}'
+                         for head, geom, props in zip(heads, geometries_json, properties_json))
+    data = b'{"type":"FeatureCollection","features":[' + features + b']}'
+    return gzip.compress(data, compresslevel=GZIP_COMPRESSLEVEL) if compress else data
+
+
+def encode_geodataframe(gdf: 'gpd.GeoDataFrame', precision: int = DEFAULT_PRECISION,
+                        compress: bool = False, id_column: str = None,
+                        index_as_id: bool = False) -> bytes:
+    """Encodes a GeoDataFrame in EPSG:4326 as a FeatureCollection (see `encode_features`).
+
+    The feature ids are the values of `id_column` or, with `index_as_id`, the index
+    as strings like `GeoDataFrame.to_json` writes them.
+    """
+    properties = gdf.drop(columns=[gdf.geometry.name] + ([id_column] if id_column else []))
+    if id_column:
+        ids = gdf[id_column]
+    elif index_as_id:
+        ids = gdf.index.astype(str)
+    else:
+        ids = None
+    return encode_features(
+        properties=properties, geometry=gdf.geometry.values,
+        ids=ids, precision=precision, compress=compress)
+
+
+def encode_h3_features(
+    cells: Iterable,
+    properties: Columns = None,
+    with_geometry: bool = False,
+    precision: int = DEFAULT_PRECISION,
+    compress: bool = False
+) -> bytes:
+    """Encodes H3 cells as a FeatureCollection whose feature ids are the hexadecimal cells.
+
+    Without `with_geometry`, the geometries are null and have to be rebuilt
+    from the ids by the client (see `H3GeoJsonLayer`).
+    """
+    cells = h3_to_int_array(cells)
+    return encode_features(
+        properties=properties,
+        geometry=cells_to_polygons(cells) if with_geometry else None,
+        ids=h3_int_to_str(cells), precision=precision, compress=compress)
+
+
+class H3GeoJsonLayer(MacroElement):
+    """Leaflet GeoJSON layer of a FeatureCollection encoded by `encode_h3_features` without geometry.
+
+    The hexagon of each feature is rebuilt in the browser from its id with h3-js.
+    """
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }}_data = {{ this.data }};
+            {{ this.get_name() }}_data.features.forEach(function(feature) {
+                if (feature.geometry === null) {
+                    feature.geometry = {type: 'Polygon',
+                                        coordinates: [h3.h3ToGeoBoundary(feature.id, true)]};
+                }
+            });
+            var {{ this.get_name() }} = L.geoJSON({{ this.get_name() }}_data, {
+                style: function(feature) { return {{ this.style|tojson }}; }
+            }).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, data: bytes, style: dict = None):
+        super().__init__()
+        self._name = 'H3GeoJsonLayer'
+        # the data is inlined in a <script>, which must not be closed by a property value
+        self.data = data.decode().replace('</', '<\\/')
+        self.style = style or {'color': 'red', 'weight': 1, 'fillOpacity': 0.4}
+
+    def render(self, **kwargs):
+        self.get_root().header.add_child(JavascriptLink(H3_JS_URL), name='h3_js')
+        super().render(**kwargs)
@@ -0,0 +1,194 @@
+"""Reading of vector datasets (GeoPackage, Shapefile, ...).
+
+Large files can be streamed in bounded memory with `read_geodataframe_chunks`.
+`read_geodataframe` keeps a columnar GeoParquet copy of each file, so only
+the first load of a given file version goes through GDAL/fiona.
+"""
+import hashlib
+import itertools
+import os
+import re
+import threading
+from functools import lru_cache
+from glob import escape as glob_escape
+from pathlib import Path
+from typing import Iterator, List, Tuple, Union
+
+from turpy.logger import log
+from config import GEO_CHUNK_SIZE, GEOPARQUET_CACHE_DIRPATH
+from lazy import lazy_import
+
+# only the first load of a file version (and the job workers) read through fiona
+fiona = lazy_import('fiona')
+gpd = lazy_import('geopandas')
+
+# coordinate columns added to the GeoParquet copies, in the CRS of the dataset
+COORDINATE_COLUMNS = ('coord_x', 'coord_y')
+
+
+def read_geodataframe_chunks(
+        filepath: Union[str, Path],
+        chunk_size: int = GEO_CHUNK_SIZE,
+        bbox: Tuple[float, float, float, float] = None,
+        columns: List[str] = None,
+        max_rows: int = None,
+        layer: Union[str, int] = None) -> 'Iterator[gpd.GeoDataFrame]':
+    """Yields the features of a vector dataset as GeoDataFrames of at most `chunk_size` rows.
+
+    Only one chunk is held in memory at a time. The bounding box filter and
+    the column selection are passed to the reader (fiona/GDAL), so filtered
+    out features and fields are never parsed.
+
+    Args:
+        filepath (Union[str, Path]): path of the dataset.
+        chunk_size (int, optional): maximum rows per chunk. Defaults to GEO_CHUNK_SIZE.
+        bbox (Tuple[float, float, float, float], optional): (minx, miny, maxx, maxy)
+            filter in the CRS of the dataset. Defaults to None.
+        columns (List[str], optional): attribute columns to read; `[]` reads the
+            geometry only. Defaults to None (all columns).
+        max_rows (int, optional): stop after this many rows. Defaults to None.
+        layer (Union[str, int], optional): layer to read. Defaults to None (first layer).
+
+    Yields:
+        gpd.GeoDataFrame: chunks indexed by the running row number.
+    """
+    if chunk_size < 1:
+        raise ValueError(f'chunk_size must be positive, got {chunk_size}')
+
+    ignore_fields = None
+    if columns is not None:
+        with fiona.open(filepath, layer=layer) as src:
+            fields = list(src.schema['properties'])
+        missing = set(columns) - set(fields)
+        if missing:
+            raise KeyError(f'columns not found in {filepath}: {sorted(missing)}')
+        ignore_fields = [field for field in fields if field not in columns]
+
+    with fiona.open(filepath, layer=layer, ignore_fields=ignore_fields) as src:
+        crs = src.crs_wkt or None
+        features = src.filter(bbox=bbox) if bbox is not None else iter(src)
+        if max_rows is not None:
+            features = itertools.islice(features, max_rows)
+
+        offset = 0
+        while True:
+            batch = list(itertools.islice(features, chunk_size))
+            if not batch:
+                break
+            chunk = gpd.GeoDataFrame.from_features(batch, crs=crs)
+            if columns is not None:
+                chunk = chunk[list(columns) + ['geometry']]
+            chunk.index = chunk.index + offset
+            offset += len(chunk)
+            yield chunk
+
+
+def count_features(filepath: Union[str, Path], layer: Union[str, int] = None) -> int:
+    """Returns the number of features of a dataset without reading them."""
+    with fiona.open(filepath, layer=layer) as src:
+        return len(src)
+
+
+@lru_cache(maxsize=256)
+def _content_digest(filepath: str, size: int, mtime_ns: int) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f'{size}'.encode())
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def file_fingerprint(filepath: Union[str, Path]) -> str:
+    """Returns a digest of the content of `filepath`.
+
+    The file is hashed once per (path, size, mtime); later calls only `stat` it.
+    """
+    stat = os.stat(filepath)
+    return _content_digest(os.path.abspath(filepath), stat.st_size, stat.st_mtime_ns)
+
+
+def geoparquet_filepath(filepath: Union[str, Path],
+                        cache_dirpath: Union[str, Path] = GEOPARQUET_CACHE_DIRPATH) -> Path:
+    """Path of the GeoParquet copy of the current version of `filepath`."""
+    filepath = Path(filepath)
+    return Path(cache_dirpath) / f'{filepath.stem}-{file_fingerprint(filepath)}.parquet'
+
+
+def _with_coordinates(gdf: 'gpd.GeoDataFrame') -> 'gpd.GeoDataFrame':
+    """`gdf` with the `coord_x`/`coord_y` columns of its points (or representative points)."""
+    points = gdf.geometry
+    if not (points.geom_type == 'Point').all():
+        points = points.representative_point()
+    return gdf.assign(**{COORDINATE_COLUMNS[0]: points.x.to_numpy(),
+                         COORDINATE_COLUMNS[1]: points.y.to_numpy()})
+
+
+def _stale_geoparquet_filepaths(parquet_filepath: Path, stem: str) -> List[Path]:
+    """Copies of the older versions of the dataset named `stem` (exactly `<stem>-<fingerprint>.parquet`)."""
+    pattern = re.compile(re.escape(stem) + r'-[0-9a-f]{32}\.parquet')
+    return [path for path in parquet_filepath.parent.glob(f'{glob_escape(stem)}-*.parquet')
+            if path != parquet_filepath and pattern.fullmatch(path.name)]
+
+
+def write_geoparquet(gdf: 'gpd.GeoDataFrame', parquet_filepath: Union[str, Path]) -> Path:
+    """Writes `gdf` as GeoParquet (WKB geometry) with its projected coordinates as columns.
+
+    The coordinates are those of the points, or of a representative point for
+    other geometries, in the CRS of `gdf`. The file is written atomically.
+    """
+    parquet_filepath = Path(parquet_filepath)
+    parquet_filepath.parent.mkdir(parents=True, exist_ok=True)
+    columnar = _with_coordinates(gdf)
+    # the app and the job workers may convert the same file at once
+    tmp_filepath = parquet_filepath.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    try:
+        columnar.to_parquet(tmp_filepath, index=True, compression='snappy')
+        os.replace(tmp_filepath, parquet_filepath)
+    finally:
+        if tmp_filepath.exists():
+            tmp_filepath.unlink()
+    return parquet_filepath
+
+
+def read_geodataframe(filepath: Union[str, Path], columns: List[str] = None,
+                      with_coordinates: bool = False,
+                      cache_dirpath: Union[str, Path] = GEOPARQUET_CACHE_DIRPATH) -> 'gpd.GeoDataFrame':
+    """Reads a vector dataset through its GeoParquet copy, creating the copy on first load.
+
+    The copy is named after the content fingerprint of `filepath`, so a
+    changed file is converted again; copies of older versions are removed.
+    It is read with memory-mapped Arrow I/O.
+
+    Args:
+        filepath (Union[str, Path]): path of the dataset (GeoPackage, ...).
+        columns (List[str], optional): attribute columns to read. Defaults to None (all).
+        with_coordinates (bool, optional): also return the `coord_x`/`coord_y`
+            columns. Defaults to False.
+        cache_dirpath (Union[str, Path], optional): folder of the copies.
+            Defaults to GEOPARQUET_CACHE_DIRPATH.
+    """
+    parquet_filepath = geoparquet_filepath(filepath, cache_dirpath)
+    if not parquet_filepath.exists():
+        gdf = gpd.read_file(filepath)
+        try:
+            write_geoparquet(gdf, parquet_filepath)
+            for stale in _stale_geoparquet_filepaths(parquet_filepath, Path(filepath).stem):
+                stale.unlink()
+        except Exception as msg:
+            log.error(f'geoparquet conversion of {filepath} failed: {msg}')
+        if with_coordinates:
+            gdf = _with_coordinates(gdf)
+        if columns is not None:
+            gdf = gdf[list(columns) + [gdf.geometry.name]
+                      + (list(COORDINATE_COLUMNS) if with_coordinates else [])]
+        return gdf
+
+    if columns is not None:
+        columns = list(columns) + ['geometry']
+        if with_coordinates:
+            columns += list(COORDINATE_COLUMNS)
+    gdf = gpd.read_parquet(parquet_filepath, columns=columns, memory_map=True)
+    if not with_coordinates:
+        gdf = gdf.drop(columns=[c for c in COORDINATE_COLUMNS if c in gdf.columns])
+    return gdf
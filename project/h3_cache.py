@@ -0,0 +1,380 @@
+"""Memoization of H3 geometry shared by every session and kept across restarts.
+
+Cell boundaries and centers, polyfills and merged cell sets are computed
+again and again for the same cells and polygons, on every rerun of a
+service. `H3Cache` stores them under a (function, argument, resolution) key,
+where the argument is a cell id or the digest of a polygon or cell set:
+
+- a memory tier, bounded by an estimate of the bytes held, evicting the
+  least recently used entries first;
+- a disk tier in SQLite (WAL mode, shared by the processes of the app) that
+  survives restarts, so that a new container starts warm. It is bounded in
+  bytes too, and evicts the entries read least recently.
+
+Lookups and stores are made in batches, one query per few hundred keys.
+Values are written to disk by a background thread, so storing a large
+value does not hold up the rerun that computed it. The entries are dropped
+when the H3 library version changes. Hits and misses of each tier are
+counted per function (`H3Cache.stats`).
+
+:Warning: Values are stored with `pickle`, it is insecure to load a
+database from an untrusted source. Cached values are shared: they must not
+be modified in place.
+"""
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, Optional
+
+import numpy as np
+
+from turpy.logger import log
+from config import H3_CACHE_FILEPATH, H3_CACHE_MAX_BYTES, H3_CACHE_MAX_DISK_BYTES
+from lazy import lazy_import
+
+h3_package = lazy_import('h3')
+
+# fixed so that a value always pickles to the same bytes
+PICKLE_PROTOCOL = 4
+# keys per SQLite query, below SQLITE_MAX_VARIABLE_NUMBER
+_QUERY_CHUNK_SIZE = 500
+# memory held by an entry besides its value (key tuple, dict slot)
+_ENTRY_OVERHEAD_BYTES = 200
+# version of _SCHEMA: a database with another one is emptied and recreated
+_SCHEMA_VERSION = '2'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS entries (
+    function TEXT NOT NULL,
+    resolution INTEGER NOT NULL,
+    arg NOT NULL,
+    value BLOB NOT NULL,
+    nbytes INTEGER NOT NULL,
+    accessed REAL NOT NULL,
+    PRIMARY KEY (function, resolution, arg)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+
+def geojson_digest(geometry: dict) -> str:
+    """Digest of the coordinates of a GeoJSON Polygon or MultiPolygon mapping."""
+    digest = hashlib.sha1(geometry['type'].encode())
+    polygons = geometry['coordinates']
+    if geometry['type'] == 'Polygon':
+        polygons = [polygons]
+    for polygon in polygons:
+        digest.update(b'P')
+        for ring in polygon:
+            ring = np.asarray(ring, dtype=np.float64)
+            digest.update(len(ring).to_bytes(8, 'little'))
+            digest.update(ring.tobytes())
+    return digest.hexdigest()
+
+
+def cells_digest(cells: np.ndarray) -> str:
+    """Digest of a set of uint64 cells, whatever their order and repetitions."""
+    return hashlib.sha1(np.unique(np.asarray(cells, dtype=np.uint64)).tobytes()).hexdigest()
+
+
+def _nbytes(value: Any) -> int:
+    """Memory held by `value`: its arrays are counted without pickling them."""
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, bytes):
+        return len(value)
+    if isinstance(value, tuple) and all(isinstance(item, np.ndarray) for item in value):
+        return sum(item.nbytes for item in value)
+    return len(pickle.dumps(value, protocol=PICKLE_PROTOCOL))
+
+
+class H3Cache:
+    """Two-tier (memory, SQLite) cache of H3 geometry.
+
+    Args:
+        filepath (str, optional): path of the SQLite database; None keeps the entries in
+            memory only. Defaults to H3_CACHE_FILEPATH.
+        max_bytes (int, optional): budget of the memory tier. Defaults to H3_CACHE_MAX_BYTES.
+        max_disk_bytes (int, optional): budget of the values in the database.
+            Defaults to H3_CACHE_MAX_DISK_BYTES.
+        timeout (float, optional): seconds to wait for the write lock held by another process.
+    """
+
+    def __init__(self, filepath: Optional[str] = H3_CACHE_FILEPATH,
+                 max_bytes: int = H3_CACHE_MAX_BYTES, max_disk_bytes: int = H3_CACHE_MAX_DISK_BYTES,
+                 timeout: float = 30.0):
+        self.filepath = filepath
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self.timeout = timeout
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._connection = None
+        self._pid = None
+        self._writer = None
+        self._pending = []
+        self._disabled = filepath is None
+        self._counts = defaultdict(lambda: {'memory_hits': 0, 'disk_hits': 0, 'misses': 0})
+        self._disk_writes = 0
+        self._disk_evictions = 0
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        # called with self._db_lock held
+        if self._disabled:
+            return None
+        # a connection must not be shared with a forked child process
+        if self._connection is None or self._pid != os.getpid():
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.filepath)), exist_ok=True)
+                connection = sqlite3.connect(self.filepath, timeout=self.timeout,
+                                             isolation_level=None, check_same_thread=False)
+                connection.execute('PRAGMA journal_mode=WAL')
+                connection.execute('PRAGMA synchronous=NORMAL')
+                connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+                self._check_versions(connection)
+            except sqlite3.Error as msg:
+                # the memory tier keeps working without the database
+                log.error(f'H3Cache: {self.filepath}: {msg}, entries kept in memory only')
+                self._disabled = True
+                return None
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    @staticmethod
+    def _check_versions(connection: sqlite3.Connection) -> None:
+        """Drops the entries of another schema or computed by another version of the H3 library."""
+        versions = {'h3_version': h3_package.__version__, 'schema_version': _SCHEMA_VERSION}
+        stored = dict(connection.execute('SELECT key, value FROM meta').fetchall())
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            if any(stored.get(key) != value for key, value in versions.items()):
+                connection.execute('DROP TABLE IF EXISTS entries')
+                connection.executemany('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                                       list(versions.items()))
+            for statement in _SCHEMA.split(';'):
+                if statement.strip():
+                    connection.execute(statement)
+            connection.execute('COMMIT')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+
+    def _remember(self, key: tuple, value: Any, nbytes: int) -> None:
+        # called with self._lock held
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous[1]
+        self._entries[key] = (value, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes and len(self._entries) > 1:
+            _, (_, evicted_nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= evicted_nbytes
+
+    def get_many(self, function: str, args: Iterable, resolution: int) -> Dict[Any, Any]:
+        """Cached values of `function` for `args` at `resolution`; the missing ones are left out.
+
+        Args:
+            function (str): name of the memoized function.
+            args (Iterable): cell ids (int) or digests (str).
+            resolution (int): H3 resolution.
+
+        Returns:
+            Dict[Any, Any]: value per argument found in either tier.
+        """
+        found, missing = {}, []
+        with self._lock:
+            for arg in args:
+                key = (function, resolution, arg)
+                entry = self._entries.get(key)
+                if entry is None:
+                    missing.append(arg)
+                else:
+                    self._entries.move_to_end(key)
+                    found[arg] = entry[0]
+            memory_hits = len(found)
+
+        loaded = {}
+        if missing:
+            with self._db_lock:
+                connection = self._connect()
+                if connection is not None:
+                    for start in range(0, len(missing), _QUERY_CHUNK_SIZE):
+                        chunk = missing[start:start + _QUERY_CHUNK_SIZE]
+                        rows = connection.execute(
+                            f'SELECT arg, value FROM entries WHERE function = ? AND resolution = ? '
+                            f'AND arg IN ({",".join("?" * len(chunk))})',
+                            [function, resolution] + chunk).fetchall()
+                        loaded.update(rows)
+            if loaded:
+                # the entries read recently are the last evicted from the disk
+                self._write_behind(self._touch, function, resolution, list(loaded))
+        if loaded:
+            with self._lock:
+                for arg, blob in loaded.items():
+                    value = pickle.loads(blob)
+                    self._remember((function, resolution, arg), value, _nbytes(value) + _ENTRY_OVERHEAD_BYTES)
+                    found[arg] = value
+
+        with self._lock:
+            counts = self._counts[function]
+            counts['memory_hits'] += memory_hits
+            counts['disk_hits'] += len(loaded)
+            counts['misses'] += len(missing) - len(loaded)
+        return found
+
+    def put_many(self, function: str, values: Dict[Any, Any], resolution: int, persist: bool = True) -> None:
+        """Stores the values of `function` per argument at `resolution`.
+
+        Args:
+            function (str): name of the memoized function.
+            values (Dict[Any, Any]): value per argument.
+            resolution (int): H3 resolution.
+            persist (bool, optional): also write them to the database, in the background;
+                False for values unlikely to be asked for again. Defaults to True.
+        """
+        if not values:
+            return
+        with self._lock:
+            for arg, value in values.items():
+                self._remember((function, resolution, arg), value, _nbytes(value) + _ENTRY_OVERHEAD_BYTES)
+        if persist and not self._disabled:
+            self._write_behind(self._write, function, resolution, dict(values))
+
+    def get(self, function: str, arg, resolution: int, default=None):
+        """Cached value of `function` for one argument, or `default`."""
+        return self.get_many(function, [arg], resolution).get(arg, default)
+
+    def put(self, function: str, arg, resolution: int, value, persist: bool = True) -> None:
+        self.put_many(function, {arg: value}, resolution, persist=persist)
+
+    def _write_behind(self, task, *args) -> None:
+        with self._lock:
+            # the writer thread does not survive in a forked child process
+            if self._writer is None or self._writer[0] != os.getpid():
+                self._writer = (os.getpid(), ThreadPoolExecutor(max_workers=1, thread_name_prefix='h3_cache'))
+                self._pending = []
+            self._pending = [future for future in self._pending if not future.done()]
+            self._pending.append(self._writer[1].submit(task, *args))
+
+    def flush(self) -> None:
+        """Waits for the values queued for the database to be written."""
+        with self._lock:
+            pending = list(self._pending)
+        for future in pending:
+            future.result()
+
+    def _touch(self, function: str, resolution: int, args: list) -> None:
+        with self._db_lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            now = time.time()
+            try:
+                connection.executemany(
+                    'UPDATE entries SET accessed = ? WHERE function = ? AND resolution = ? AND arg = ?',
+                    [(now, function, resolution, arg) for arg in args])
+            except sqlite3.Error as msg:
+                log.error(f'H3Cache: {function}: access times not updated in {self.filepath}: {msg}')
+
+    def _write(self, function: str, resolution: int, values: Dict[Any, Any]) -> None:
+        rows = []
+        now = time.time()
+        for arg, value in values.items():
+            blob = pickle.dumps(value, protocol=PICKLE_PROTOCOL)
+            if len(blob) <= self.max_disk_bytes:
+                rows.append((function, resolution, arg, blob, len(blob), now))
+        if not rows:
+            return
+        with self._db_lock:
+            connection = self._connect()
+            if connection is None:
+                return
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.executemany(
+                    'INSERT OR REPLACE INTO entries (function, resolution, arg, value, nbytes, accessed) '
+                    'VALUES (?, ?, ?, ?, ?, ?)', rows)
+                self._disk_writes += len(rows)
+                self._disk_evictions += self._evict_disk(connection)
+                connection.execute('COMMIT')
+            except sqlite3.Error as msg:
+                if connection.in_transaction:
+                    connection.execute('ROLLBACK')
+                log.error(f'H3Cache: {function}: {len(rows)} entries not written to {self.filepath}: {msg}')
+
+    def _evict_disk(self, connection: sqlite3.Connection) -> int:
+        """Deletes the entries read least recently until the database is within its budget."""
+        excess = connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM entries').fetchone()[0] \
+            - self.max_disk_bytes
+        if excess <= 0:
+            return 0
+        evicted, freed = [], 0
+        for function, resolution, arg, nbytes in connection.execute(
+                'SELECT function, resolution, arg, nbytes FROM entries ORDER BY accessed'):
+            evicted.append((function, resolution, arg))
+            freed += nbytes
+            if freed >= excess:
+                break
+        connection.executemany(
+            'DELETE FROM entries WHERE function = ? AND resolution = ? AND arg = ?', evicted)
+        return len(evicted)
+
+    def disk_nbytes(self) -> int:
+        """Bytes of the values in the database."""
+        with self._db_lock:
+            connection = self._connect()
+            if connection is None:
+                return 0
+            return connection.execute('SELECT COALESCE(SUM(nbytes), 0) FROM entries').fetchone()[0]
+
+    def stats(self) -> dict:
+        """Lookups per function and tier, their hit rate, and the size of the memory tier."""
+        with self._lock:
+            functions = {}
+            for function, counts in self._counts.items():
+                lookups = sum(counts.values())
+                hits = counts['memory_hits'] + counts['disk_hits']
+                functions[function] = {**counts, 'hit_rate': hits / lookups if lookups else 0.0}
+            lookups = sum(sum(counts.values()) for counts in self._counts.values())
+            hits = sum(counts['memory_hits'] + counts['disk_hits'] for counts in self._counts.values())
+            return {'functions': functions,
+                    'hit_rate': hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries),
+                    'nbytes': self.nbytes,
+                    'disk_writes': self._disk_writes,
+                    'disk_evictions': self._disk_evictions}
+
+    def clear(self, disk: bool = False) -> None:
+        """Empties the memory tier, and the database if `disk`."""
+        self.flush()
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self._counts.clear()
+        if disk:
+            with self._db_lock:
+                connection = self._connect()
+                if connection is not None:
+                    connection.execute('DELETE FROM entries')
+
+    def close(self) -> None:
+        self.flush()
+        with self._db_lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+# shared by every session of the app process
+h3_cache = H3Cache()
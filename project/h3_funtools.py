@@ -1,39 +1,495 @@
-from shapely.geometry import Polygon
-import geopandas as gpd
-from h3 import h3
-import folium
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Iterable, Tuple, Union
+
+import numpy as np
+import pandas as pd
 
 import streamlit as st
 
+from turpy.logger import log
+from h3_cache import cells_digest, geojson_digest, h3_cache
+from lazy import lazy_import
+from reproject import cached_to_crs, same_crs, transform_coordinates
+
+# only the maps need folium
+folium = lazy_import('folium')
+# imported on first use, the services import this module on every start
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+h3 = lazy_import('h3.api.basic_str')
+h3_int = lazy_import('h3.api.numpy_int')
+
+
+@lru_cache(maxsize=None)
+def _h3_vect():
+    """The vectorized functions shipped with h3-py >= 3.7, or None."""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            from h3.unstable import vect
+    except ImportError:
+        return None
+    return vect
+
+
+@lru_cache(maxsize=None)
+def _pygeos():
+    """The pygeos module, or None if it is not installed."""
+    try:
+        import pygeos
+    except ImportError:
+        return None
+    return pygeos
+
 """ when useing folium you need to reproject to 4326
 import geopandas as gpd
 df = gpd.read_file(data)
 
 """
 
+# number of points sent to h3 per call when indexing in batch
+H3_INDEX_CHUNK_SIZE = 250_000
+# number of single cell boundaries kept in memory (~200 bytes each), see `_cell_boundary`
+H3_BOUNDARY_CACHE_SIZE = 2 ** 16
+# average hexagon edge length in meters per H3 resolution, `h3.edge_length(res, 'm')`
+H3_EDGE_LENGTH_M = (1107712.591, 418676.0055, 158244.6558, 59810.85794, 22606.3794,
+                    8544.408276, 3229.482772, 1220.629759, 461.3546837, 174.3756681,
+                    65.90780749, 24.9105614, 9.415526211, 3.559893033, 1.348574562,
+                    0.509713273)
+# most cells drawn by `visualize_hexagons` in level-of-detail mode
+H3_LOD_MAX_CELLS = 5_000
+# cells used to cut the viewport are at least this many pixels wide
+H3_LOD_VIEWPORT_EDGE_PX = 256.0
+
+
+def resolution_for_zoom(zoom: float, latitude: float = 62.0,
+                        min_edge_px: float = 4.0, max_resolution: int = 15) -> int:
+    """Returns the finest H3 resolution whose hexagon edges are at least `min_edge_px`
+    pixels long on a web map at `zoom` and `latitude`, capped at `max_resolution`.
+    """
+    meters_per_px = 156543.03392 * np.cos(np.radians(latitude)) / 2 ** zoom
+    resolution = 0
+    for res, edge_length in enumerate(H3_EDGE_LENGTH_M):
+        if edge_length / meters_per_px >= min_edge_px:
+            resolution = res
+    return min(resolution, max_resolution)
+
+
+def check_h3_resolution(resolution) -> int:
+    """Returns `resolution` as an int, raising `ValueError` if it is not a valid H3 resolution."""
+    if int(resolution) != resolution or not 0 <= resolution <= 15:
+        raise ValueError(
+            f'H3 resolution must be an integer between 0 and 15, got {resolution}')
+    return int(resolution)
+
+
+def missing_geometries(geoseries: 'gpd.GeoSeries') -> np.ndarray:
+    """Boolean mask of the None or empty geometries of `geoseries`, which have no location."""
+    return (geoseries.isna() | geoseries.is_empty).to_numpy()
+
+
+def geoseries_to_latlng(geoseries: 'gpd.GeoSeries') -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the coordinates of a point GeoSeries as `(lat, lng)` float64 arrays.
+
+    The coordinates of the points are read from the geometry array in one
+    vectorized call, without creating a shapely object per row. Other
+    geometries are reduced to their centroid, taken in the coordinates of the
+    series. Missing or empty geometries give NaN.
+    """
+    if not geoseries.geom_type.isin(['Point', None]).all():
+        # GeoSeries.centroid warns in a geographic CRS: the centroid is only used to locate
+        # the geometry in a cell, not as a measure
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            geoseries = geoseries.centroid
+    lat = geoseries.y.to_numpy(dtype=np.float64)
+    lng = geoseries.x.to_numpy(dtype=np.float64)
+    return lat, lng
+
+
+def _geo_to_h3_chunk(args) -> np.ndarray:
+    lat, lng, resolution = args
+    h3_vect = _h3_vect()
+    if h3_vect is not None and hasattr(h3_vect, 'geo_to_h3'):
+        return h3_vect.geo_to_h3(lat, lng, resolution)
+    return np.fromiter(
+        (h3_int.geo_to_h3(y, x, resolution) for y, x in zip(lat.tolist(), lng.tolist())),
+        dtype=np.uint64, count=len(lat))
+
+
+def geo_to_h3_array(
+        lat: np.ndarray,
+        lng: np.ndarray,
+        resolution: int,
+        chunk_size: int = H3_INDEX_CHUNK_SIZE,
+        n_workers: int = None) -> np.ndarray:
+    """Indexes arrays of coordinates in decimal degrees (EPSG:4326) as integer H3 cells.
+
+    Args:
+        lat (np.ndarray): latitudes in decimal degrees.
+        lng (np.ndarray): longitudes in decimal degrees.
+        resolution (int): H3 resolution.
+        chunk_size (int, optional): points indexed per call. Defaults to H3_INDEX_CHUNK_SIZE.
+        n_workers (int, optional): if > 1, the chunks are indexed in a process pool. Defaults to None.
+
+    Returns:
+        np.ndarray: uint64 array of H3 cell ids, aligned with the input coordinates.
+    """
+    resolution = check_h3_resolution(resolution)
+    lat = np.ascontiguousarray(lat, dtype=np.float64)
+    lng = np.ascontiguousarray(lng, dtype=np.float64)
+    if lat.shape != lng.shape:
+        raise ValueError('`lat` and `lng` must have the same shape')
+
+    chunks = [(lat[i:i + chunk_size], lng[i:i + chunk_size], resolution)
+              for i in range(0, len(lat), chunk_size)]
+
+    if n_workers is not None and n_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            parts = list(pool.map(_geo_to_h3_chunk, chunks))
+    else:
+        parts = [_geo_to_h3_chunk(chunk) for chunk in chunks]
+
+    if not parts:
+        return np.empty(0, dtype=np.uint64)
+    return np.concatenate(parts).astype(np.uint64, copy=False)
+
+
+def h3_to_parent_array(cells: np.ndarray, resolution: int) -> np.ndarray:
+    """Returns the parents at `resolution` of an array of integer H3 cells."""
+    resolution = check_h3_resolution(resolution)
+    cells = np.ascontiguousarray(cells, dtype=np.uint64)
+    h3_vect = _h3_vect()
+    if h3_vect is not None and hasattr(h3_vect, 'h3_to_parent'):
+        return np.asarray(h3_vect.h3_to_parent(cells, resolution), dtype=np.uint64)
+    return np.fromiter((h3_int.h3_to_parent(c, resolution) for c in cells.tolist()),
+                       dtype=np.uint64, count=len(cells))
+
+
+def h3_int_to_str(cells: np.ndarray) -> np.ndarray:
+    """Converts integer H3 cell ids to their hexadecimal string form."""
+    return np.array([format(c, 'x') for c in np.asarray(cells, dtype=np.uint64).tolist()],
+                    dtype=object)
+
+
+def h3_to_int_array(cells: Iterable) -> np.ndarray:
+    """Returns H3 cells given as hexadecimal strings or integers as a uint64 array."""
+    values = cells if isinstance(cells, (np.ndarray, pd.Series, pd.Index)) else list(cells)
+    values = np.asarray(values)
+    if values.dtype.kind in 'OUS':
+        return np.array([int(c, 16) if isinstance(c, str) else int(c) for c in values.tolist()],
+                        dtype=np.uint64)
+    return values.astype(np.uint64, copy=False)
+
+
+@lru_cache(maxsize=H3_BOUNDARY_CACHE_SIZE)
+def _cell_boundary(cell: int) -> np.ndarray:
+    """Closed (lng, lat) boundary of `cell`, cached by cell id."""
+    boundary = np.asarray(h3_int.h3_to_geo_boundary(cell, geo_json=True), dtype=np.float64)
+    boundary.setflags(write=False)
+    return boundary
+
+
+def _memoized_per_cell(function: str, cells: np.ndarray, compute, row_dtype: np.dtype
+                       ) -> Tuple[np.ndarray, np.ndarray]:
+    """Calls `compute` only for the distinct `cells` not memoized yet, across reruns and restarts.
+
+    `compute(cells)` returns a structured array of `row_dtype` aligned with its
+    cells. Each row is stored in `h3_cache` as bytes under its cell and
+    resolution, so sets of cells that overlap (a panned view, another polygon)
+    share the cells they have in common.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the positions of `cells` in their sorted
+        distinct cells, and the rows of the distinct cells.
+    """
+    distinct = np.unique(cells)
+    resolutions = (distinct >> np.uint64(52)) & np.uint64(0xF)
+    found = {}
+    for resolution in np.unique(resolutions).tolist():
+        found.update(h3_cache.get_many(function, distinct[resolutions == resolution].tolist(), resolution))
+
+    missing = np.array([cell for cell in distinct.tolist() if cell not in found], dtype=np.uint64)
+    if len(missing):
+        data, size = compute(missing).astype(row_dtype, copy=False).tobytes(), row_dtype.itemsize
+        missing_resolutions = ((missing >> np.uint64(52)) & np.uint64(0xF)).tolist()
+        computed = {resolution: {} for resolution in set(missing_resolutions)}
+        for i, (cell, resolution) in enumerate(zip(missing.tolist(), missing_resolutions)):
+            computed[resolution][cell] = found[cell] = data[i * size:(i + 1) * size]
+        for resolution, rows in computed.items():
+            h3_cache.put_many(function, rows, resolution)
+
+    rows = np.frombuffer(b''.join([found[cell] for cell in distinct.tolist()]), dtype=row_dtype)
+    return np.searchsorted(distinct, cells), rows
+
+
+_BOUNDARY_DTYPE = np.dtype([('ring', np.float64, (7, 2)), ('irregular', np.bool_)])
+_CENTER_DTYPE = np.dtype([('center', np.float64, (2,))])
+
 
-def visualize_hexagons(hexagons, color="red", folium_map=None):
+def _compute_boundaries(cells: np.ndarray) -> np.ndarray:
+    boundaries = np.zeros(len(cells), dtype=_BOUNDARY_DTYPE)
+    boundaries['ring'] = np.nan
+    for i, cell in enumerate(cells.tolist()):
+        boundary = h3_int.h3_to_geo_boundary(cell, geo_json=True)
+        if len(boundary) == 7:
+            boundaries['ring'][i] = boundary
+        else:
+            boundaries['irregular'][i] = True
+    return boundaries
+
+
+def h3_boundaries_array(cells: Iterable) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the closed boundary rings of `cells` as one (n, 7, 2) array of (lng, lat).
+
+    Pentagons and cells distorted by an icosahedron edge do not have 7 ring
+    vertices; their rows are left as NaN and flagged in the returned mask.
+    The ring of each cell is computed once and memoized in `h3_cache`.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray]: the (n, 7, 2) rings and a boolean mask of
+        the irregular cells.
+    """
+    cells = h3_to_int_array(cells)
+    if len(cells) == 0:
+        return np.empty((0, 7, 2), dtype=np.float64), np.zeros(0, dtype=bool)
+    positions, boundaries = _memoized_per_cell(
+        'h3_to_geo_boundary', cells, _compute_boundaries, _BOUNDARY_DTYPE)
+    return boundaries['ring'][positions], boundaries['irregular'][positions]
+
+
+def _compute_centers(cells: np.ndarray) -> np.ndarray:
+    centers = np.zeros(len(cells), dtype=_CENTER_DTYPE)
+    # (lat, lng) to (lng, lat)
+    centers['center'] = np.array([h3_int.h3_to_geo(cell) for cell in cells.tolist()],
+                                 dtype=np.float64).reshape(-1, 2)[:, ::-1]
+    return centers
+
+
+def h3_centers_array(cells: Iterable) -> np.ndarray:
+    """Returns the centers of `cells` as an (n, 2) array of (lng, lat), memoized in `h3_cache`."""
+    cells = h3_to_int_array(cells)
+    if len(cells) == 0:
+        return np.empty((0, 2), dtype=np.float64)
+    positions, centers = _memoized_per_cell('h3_to_geo', cells, _compute_centers, _CENTER_DTYPE)
+    return centers['center'][positions]
+
+
+def _polygons_from_rings(rings: np.ndarray) -> np.ndarray:
+    if hasattr(shapely, 'polygons'):
+        # shapely >= 2
+        return shapely.polygons(rings)
+    pygeos = _pygeos()
+    if pygeos is not None and gpd.options.use_pygeos:
+        return pygeos.polygons(rings)
+    return np.array([shapely.geometry.Polygon(ring) for ring in rings], dtype=object)
+
+
+def cells_to_polygons(cells: Iterable) -> 'gpd.array.GeometryArray':
+    """Builds the hexagon polygons of `cells` in one vectorized call.
+
+    Args:
+        cells (Iterable): H3 cells as hexadecimal strings or integers.
+
+    Returns:
+        gpd.array.GeometryArray: polygons in EPSG:4326, aligned with `cells`.
+    """
+    cells = h3_to_int_array(cells)
+    rings, irregular = h3_boundaries_array(cells)
+    polygons = np.empty(len(cells), dtype=object)
+    polygons[~irregular] = _polygons_from_rings(rings[~irregular])
+    if irregular.any():
+        polygons[irregular] = [shapely.geometry.Polygon(_cell_boundary(cell))
+                               for cell in cells[irregular].tolist()]
+    return gpd.array.from_shapely(polygons)
+
+
+def cells_to_geoseries(cells: Iterable, crs: str = "EPSG:4326") -> 'gpd.GeoSeries':
+    """Returns the hexagon polygons of `cells` as a GeoSeries indexed by the cells."""
+    cells = list(cells) if not isinstance(cells, (np.ndarray, pd.Series, pd.Index)) else cells
+    return gpd.GeoSeries(cells_to_polygons(cells), index=cells, crs=crs)
+
+
+def points_to_h3(
+        gdf: 'Union[gpd.GeoDataFrame, gpd.GeoSeries]',
+        resolution: int,
+        chunk_size: int = H3_INDEX_CHUNK_SIZE,
+        n_workers: int = None,
+        as_str: bool = False) -> pd.Series:
+    """Returns the H3 cell of every point in `gdf` as a Series ready to be assigned as a column.
+
+    Replaces the row-wise `gdf.apply(lambda row: h3.geo_to_h3(...), axis=1)`.
+    Points in another CRS than EPSG:4326 only have their coordinates
+    reprojected (see `reproject.transform_coordinates`), no geometry is built.
+
+    Args:
+        gdf (Union[gpd.GeoDataFrame, gpd.GeoSeries]): point geometries, in EPSG:4326 if without CRS.
+        resolution (int): H3 resolution.
+        chunk_size (int, optional): points indexed per call. Defaults to H3_INDEX_CHUNK_SIZE.
+        n_workers (int, optional): if > 1, the chunks are indexed in a process pool. Defaults to None.
+        as_str (bool, optional): return hexadecimal strings instead of uint64 ids. Defaults to False.
+
+    Rows without a location (None or empty geometries, see `missing_geometries`)
+    have no cell: they are left out of the result, with a warning.
+
+    Returns:
+        pd.Series: H3 cells with the index of the rows of `gdf` that have a geometry.
+    """
+    geoseries = gdf.geometry if isinstance(gdf, gpd.GeoDataFrame) else gdf
+    missing = missing_geometries(geoseries)
+    if missing.any():
+        log.warning(f'points_to_h3: {int(missing.sum()):,} of {len(geoseries):,} rows without a geometry left out')
+        geoseries = geoseries[~missing]
+    lat, lng = geoseries_to_latlng(geoseries)
+    if geoseries.crs is not None and not same_crs(geoseries.crs, 'EPSG:4326'):
+        lng, lat = transform_coordinates(
+            np.require(lng, np.float64, ['C', 'W']), np.require(lat, np.float64, ['C', 'W']),
+            geoseries.crs, 'EPSG:4326')
+    cells = geo_to_h3_array(lat, lng, resolution,
+                            chunk_size=chunk_size, n_workers=n_workers)
+    if as_str:
+        cells = h3_int_to_str(cells)
+    return pd.Series(cells, index=geoseries.index, name=f'H3_{int(resolution)}')
+
+
+def _viewport_cells(bounds, resolution: int) -> np.ndarray:
+    """Cells at `resolution` covering `bounds` ((south, west), (north, east)), with a ring of margin."""
+    (south, west), (north, east) = bounds
+    bbox = {'type': 'Polygon',
+            'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]}
+    # the same viewport is filled again on every rerun; it is only kept in
+    # memory, as each pan or zoom makes a new one
+    key = geojson_digest(bbox)
+    cells = h3_cache.get('polyfill', key, resolution)
+    if cells is None:
+        cells = h3.polyfill(bbox, resolution, geo_json_conformant=True)
+        h3_cache.put('polyfill', key, resolution, cells, persist=False)
+    if not cells:
+        # viewport smaller than one cell
+        cells = {h3.geo_to_h3((south + north) / 2, (west + east) / 2, resolution)}
+    covering = set()
+    for cell in cells:
+        covering.update(h3.k_ring(cell, 1))
+    return h3_to_int_array(covering)
+
+
+def lod_cells(
+    hexagons: Iterable,
+    zoom: float,
+    bounds=None,
+    classes: Iterable = None,
+    max_cells: int = H3_LOD_MAX_CELLS
+) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Reduces `hexagons` to what is worth drawing on a web map at `zoom`.
+
+    The cells outside the viewport `bounds` are dropped and the rest are rolled
+    up to the resolution picked by `resolution_for_zoom`, and further up until
+    at most `max_cells` remain. A parent cell takes the most frequent class of
+    its children. Everything is vectorized, so the cost grows slowly with the
+    number of input cells.
+
+    Args:
+        hexagons (Iterable): H3 cells, as hexadecimal strings or integers.
+        zoom (float): zoom level of the map.
+        bounds (optional): viewport as ((south, west), (north, east)). Defaults to None (all cells).
+        classes (Iterable, optional): class of each cell. Defaults to None (a single class).
+        max_cells (int, optional): most cells returned. Defaults to H3_LOD_MAX_CELLS.
+
+    Returns:
+        Tuple[np.ndarray, np.ndarray, int]: uint64 cells, their classes and their resolution.
+    """
+    cells = h3_to_int_array(hexagons)
+    classes = np.zeros(len(cells), dtype=np.int8) if classes is None else np.asarray(classes)
+    if len(cells) == 0:
+        return cells, classes, 0
+    cell_resolution = int(h3_int.h3_get_resolution(int(cells[0])))
+
+    latitude = 62.0
+    if bounds is not None:
+        (south, west), (north, east) = bounds
+        latitude = (south + north) / 2
+        viewport_resolution = min(cell_resolution, resolution_for_zoom(
+            zoom, latitude=latitude, min_edge_px=H3_LOD_VIEWPORT_EDGE_PX))
+        inside = np.isin(h3_to_parent_array(cells, viewport_resolution),
+                         _viewport_cells(bounds, viewport_resolution))
+        cells, classes = cells[inside], classes[inside]
+
+    resolution = min(cell_resolution, resolution_for_zoom(zoom, latitude=latitude))
+    while True:
+        parents = h3_to_parent_array(cells, resolution) if resolution < cell_resolution else cells
+        frame = pd.DataFrame({'cell': parents, 'cls': classes})
+        # most frequent class of each parent
+        frame = (frame.groupby(['cell', 'cls'], sort=False).size().rename('n').reset_index()
+                 .sort_values('n', ascending=False, kind='stable')
+                 .drop_duplicates('cell'))
+        if len(frame) <= max_cells or resolution == 0:
+            break
+        resolution -= 1
+    return (frame['cell'].to_numpy(dtype=np.uint64), frame['cls'].to_numpy(), resolution)
+
+
+def _visualize_hexagons_lod(hexagons, color, folium_map, zoom, bounds, classes, max_cells):
+    cells, cell_classes, resolution = lod_cells(
+        hexagons, zoom, bounds=bounds, classes=classes, max_cells=max_cells)
+
+    if folium_map is None:
+        if bounds is not None:
+            (south, west), (north, east) = bounds
+            location = [(south + north) / 2, (west + east) / 2]
+        else:
+            location = [62.0, 15.0]
+        folium_map = folium.Map(location=location, zoom_start=zoom, tiles='cartodbpositron')
+
+    for cls in pd.unique(cell_classes):
+        members = cells[cell_classes == cls]
+        # contiguous cells of a class are merged into a single multipolygon,
+        # once per distinct set of cells
+        key = cells_digest(members)
+        polygons = h3_cache.get('h3_set_to_multi_polygon', key, resolution)
+        if polygons is None:
+            polygons = h3.h3_set_to_multi_polygon(set(h3_int_to_str(members)), geo_json=True)
+            h3_cache.put('h3_set_to_multi_polygon', key, resolution, polygons)
+        geometry = {'type': 'MultiPolygon',
+                    'coordinates': [[np.round(loop, 6).tolist() for loop in polygon]
+                                    for polygon in polygons]}
+        class_color = color.get(cls, 'red') if isinstance(color, dict) else color
+        folium.GeoJson(
+            geometry,
+            name=f'H3_{resolution} {cls}' if classes is not None else f'H3_{resolution}',
+            style_function=lambda feature, class_color=class_color: {
+                'color': class_color, 'fillColor': class_color, 'weight': 1, 'fillOpacity': 0.4},
+        ).add_to(folium_map)
+    return folium_map
+
+
+def visualize_hexagons(hexagons, color="red", folium_map=None, zoom=None, bounds=None,
+                       classes=None, max_cells=H3_LOD_MAX_CELLS):
     """
     hexagons is a list of hexcluster. Each hexcluster is a list of hexagons. 
     eg. [[hex1, hex2], [hex3, hex4]]
 
+    When `zoom` is given, the hexagons are drawn in level-of-detail mode (see
+    `lod_cells`): only the cells in the viewport `bounds`, at a resolution
+    suited to the zoom, and with the contiguous cells of each of `classes`
+    merged into one multipolygon. `color` may then map each class to a color.
+    The size of the map no longer grows with the number of hexagons.
+
     source: https://nbviewer.jupyter.org/github/uber/h3-py-notebooks/blob/master/notebooks/usage.ipynb
     """
-    polylines = []
-    lat = []
-    lng = []
-    for _hex in hexagons:
-        polygons = h3.h3_set_to_multi_polygon([_hex], geo_json=False)
-        # flatten polygons into loops.
-        outlines = [loop for polygon in polygons for loop in polygon]
-        polyline = [outline + [outline[0]] for outline in outlines][0]
-        lat.extend(map(lambda v: v[0], polyline))
-        lng.extend(map(lambda v: v[1], polyline))
-        polylines.append(polyline)
+    if zoom is not None:
+        return _visualize_hexagons_lod(hexagons, color, folium_map, zoom, bounds, classes, max_cells)
+
+    # closed (lat, lng) outline of each hexagon, memoized in `h3_cache`
+    cells = h3_to_int_array(hexagons)
+    rings, irregular = h3_boundaries_array(cells)
+    polylines = [(_cell_boundary(int(cell)) if is_irregular else ring)[:, ::-1].tolist()
+                 for cell, ring, is_irregular in zip(cells.tolist(), rings, irregular)]
 
     if folium_map is None:
-        m = folium.Map(location=[sum(lat)/len(lat), sum(lng) /
-                                 len(lng)], zoom_start=13, tiles='cartodbpositron')
+        lng, lat = h3_centers_array(cells).mean(axis=0)
+        m = folium.Map(location=[lat, lng], zoom_start=13, tiles='cartodbpositron')
     else:
         m = folium_map
     for polyline in polylines:
@@ -60,24 +516,31 @@ def visualize_polygon(polyline, color):
     return m
 
 
-def build_hexs(gdf: gpd.GeoDataFrame, APERTURE_SIZE: int = 8):
-    """
+def build_hexs(gdf: 'gpd.GeoDataFrame', APERTURE_SIZE: int = 8):
+    """Returns the set of hexagons (hexadecimal ids) filling all the features of `gdf`.
+
+    See `polyfill.polyfill_membership` for the cells of each feature.
+
     source: https://geographicdata.science/book/data/h3_grid/build_sd_h3_grid.html
     """
-    hexs = h3.polyfill(
-        gdf.geometry[0].__geo_interface__, APERTURE_SIZE, geo_json_conformant=True)
+    # imported here, `polyfill` depends on this module
+    from polyfill import polyfill_cells
+    hexs = set(h3_int_to_str(polyfill_cells(gdf, APERTURE_SIZE)))
     return hexs
 
 
-def gdf_to_h3_geojson(gdf: gpd.GeoDataFrame):
+def gdf_to_h3_geojson(gdf: 'gpd.GeoDataFrame'):
 
     assert gdf.crs is not None
     assert gdf.crs != ""
 
     st.write(f"gdf.crs: {gdf.crs}")
-    df = gdf.to_crs(epsg='4326')
+    # reprojected once per distinct geometry set, across reruns
+    df = cached_to_crs(gdf, 'EPSG:4326')
     #  this is a string
-    js = df.to_json()
+    # imported here, `features` depends on this module
+    from features import encode_geodataframe
+    js = encode_geodataframe(df, index_as_id=True).decode()
 
     return js
 
@@ -86,25 +549,21 @@ def polygonise(hex_id):
     """
     source: https://geographicdata.science/book/data/h3_grid/build_sd_h3_grid.html
     """
-    return Polygon(h3.h3_to_geo_boundary(
+    return shapely.geometry.Polygon(h3.h3_to_geo_boundary(
         hex_id, geo_json=True))
 
 
-def polygonize_hexagons(gdf: gpd.GeoDataFrame, APERTURE_SIZE: int = 8, crs: str = "EPSG:4326"):
+def polygonize_hexagons(gdf: 'gpd.GeoDataFrame', APERTURE_SIZE: int = 8, crs: str = "EPSG:4326"):
     """
 
     https://geographicdata.science/book/data/h3_grid/build_sd_h3_grid.html
     """
 
-    GeoJSON_polygon = gdf_to_h3_geojson(gdf=gdf)
-
-    hexs = h3.polyfill(GeoJSON_polygon, APERTURE_SIZE,
-                       geo_json_conformant=True)
+    # every feature is filled, multipart and large polygons in parallel pieces
+    from polyfill import polyfill_cells
+    hexs = polyfill_cells(gdf, APERTURE_SIZE)
 
-    all_polys = gpd.GeoSeries(list(map(polygonise, hexs)),
-                              index=hexs,
-                              crs=crs
-                              )
+    all_polys = cells_to_geoseries(hexs, crs=crs)
     return all_polys
 
 
@@ -0,0 +1,306 @@
+"""Neighborhood statistics of per-cell H3 tables, as sparse matrix products.
+
+The neighbors of every cell of a table, up to `k` rings away, are found once
+and stored as a sparse CSR matrix over the positions of the (sorted, uint64)
+cells: entry (i, j) holds the grid distance between cells i and j, plus one
+so that a cell is its own neighbor at distance 0 without an explicit zero.
+Cells that are not in the table (e.g. cells without points in a count table)
+are not neighbors of anything, except for the spatial autocorrelation
+statistics: they run over the observed cells and the cells up to `k` rings
+around them, the missing ones counting 0, so that a hotspot is measured
+against its empty surroundings too. Every statistic is then a product of a
+weight matrix derived from it with the column of values:
+
+- k-ring sums and means (`k_ring_sum`, `k_ring_mean`);
+- distance-decay smoothing (`decay_smooth`);
+- Getis-Ord Gi* hotspots (`getis_ord_g`), global and local Moran's I
+  (`morans_i`, `local_morans_i`), with their analytical z-scores.
+
+Finding the neighbors calls `h3.k_ring_distances` once per cell, in a
+process pool for large tables; the adjacency of a table is cached, so the
+statistics computed for the same cells (e.g. on every rerun) reuse it.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+from h3_funtools import h3_to_int_array
+from lazy import lazy_import
+
+# scipy.stats alone takes over half a second to import
+sparse = lazy_import('scipy.sparse')
+stats = lazy_import('scipy.stats')
+h3_int = lazy_import('h3.api.numpy_int')
+
+# cells sent to a worker per task when finding neighbors
+NEIGHBORS_CHUNK_SIZE = 50_000
+# adjacency matrices kept in memory for all the sessions
+NEIGHBORS_CACHE_SIZE = 8
+
+
+def _k_ring_chunk(args) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """(cell position, neighbor, distance) of every neighbor up to `k` rings of a chunk of cells."""
+    start, cells, k = args
+    if len(cells) == 0:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int8)
+    if k <= 1:
+        # one array per cell; its neighbors are at distance 1
+        rings = [h3_int.k_ring(cell, k) for cell in cells.tolist()]
+        lengths = np.fromiter((len(ring) for ring in rings), dtype=np.int64, count=len(rings))
+        neighbors = np.concatenate(rings).astype(np.uint64, copy=False)
+        positions = np.repeat(np.arange(start, start + len(cells)), lengths)
+        distances = (neighbors != np.repeat(cells, lengths)).astype(np.int8)
+        return positions, neighbors, distances
+
+    rings = [ring for cell in cells.tolist() for ring in h3_int.k_ring_distances(cell, k)]
+    lengths = np.fromiter((len(ring) for ring in rings), dtype=np.int64, count=len(rings))
+    neighbors = np.concatenate([np.asarray(ring, dtype=np.uint64) for ring in rings])
+    positions = np.repeat(np.arange(start, start + len(cells)), lengths.reshape(-1, k + 1).sum(axis=1))
+    distances = np.repeat(np.tile(np.arange(k + 1, dtype=np.int8), len(cells)), lengths)
+    return positions, neighbors, distances
+
+
+class H3Neighborhood:
+    """Neighbors up to `k` rings among a set of H3 cells, as a sparse distance matrix.
+
+    Args:
+        cells (np.ndarray): distinct cells (uint64 or hexadecimal strings).
+        k (int): number of rings.
+        n_workers (int, optional): if > 1, the neighbors are found in a process pool.
+            Defaults to None.
+    """
+
+    def __init__(self, cells, k: int, n_workers: int = None):
+        if k < 0:
+            raise ValueError('k must be >= 0')
+        self.cells = np.unique(h3_to_int_array(cells))
+        self.k = int(k)
+        self.n = len(self.cells)
+
+        chunks = [(i, self.cells[i:i + NEIGHBORS_CHUNK_SIZE], self.k)
+                  for i in range(0, self.n, NEIGHBORS_CHUNK_SIZE)]
+        if n_workers is not None and n_workers > 1 and len(chunks) > 1:
+            with ProcessPoolExecutor(max_workers=n_workers) as pool:
+                parts = list(pool.map(_k_ring_chunk, chunks))
+        else:
+            parts = [_k_ring_chunk(chunk) for chunk in chunks]
+
+        rows = np.concatenate([part[0] for part in parts]) if parts else np.empty(0, dtype=np.int64)
+        neighbors = np.concatenate([part[1] for part in parts]) if parts else np.empty(0, dtype=np.uint64)
+        distances = np.concatenate([part[2] for part in parts]) if parts else np.empty(0, dtype=np.int8)
+
+        # only the neighbors that are cells of the table
+        columns = np.searchsorted(self.cells, neighbors)
+        columns[columns == self.n] = 0
+        present = self.cells[columns] == neighbors if self.n else np.zeros(0, dtype=bool)
+        # distance + 1: a cell is at distance 0 of itself, stored without an explicit zero
+        self.distances = sparse.csr_matrix(
+            (distances[present].astype(np.float64) + 1, (rows[present], columns[present])),
+            shape=(self.n, self.n))
+
+    def align(self, values: pd.Series) -> np.ndarray:
+        """The values of a Series indexed by cell, as a float array aligned with `cells` (NaN if missing)."""
+        values = pd.Series(values.to_numpy(dtype=np.float64), index=h3_to_int_array(values.index.to_numpy()))
+        return values.reindex(self.cells).to_numpy()
+
+    def weights(self, kind: str = 'binary', k: int = None, include_self: bool = True,
+                decay: float = 0.5, bandwidth: float = None) -> 'sparse.csr_matrix':
+        """Weight matrix of the neighbors up to `k` rings (all of them by default).
+
+        Args:
+            kind (str, optional): 'binary' (1 per neighbor), 'exponential' (`decay ** distance`)
+                or 'gaussian' (`exp(-(distance / bandwidth) ** 2 / 2)`). Defaults to 'binary'.
+            k (int, optional): rings, at most the `k` of the neighborhood. Defaults to None (all).
+            include_self (bool, optional): a cell is its own neighbor. Defaults to True.
+            decay (float, optional): ratio of the weights of two successive rings. Defaults to 0.5.
+            bandwidth (float, optional): gaussian bandwidth, in rings. Defaults to None (k / 2).
+        """
+        k = self.k if k is None else min(int(k), self.k)
+        weights = self.distances.copy()
+        distance = weights.data - 1
+        keep = (distance <= k) & ((distance > 0) | include_self)
+        if kind == 'binary':
+            data = np.ones(len(distance))
+        elif kind == 'exponential':
+            data = np.power(decay, distance)
+        elif kind == 'gaussian':
+            bandwidth = bandwidth or max(k / 2, 0.5)
+            data = np.exp(-0.5 * (distance / bandwidth) ** 2)
+        else:
+            raise ValueError(f"kind must be 'binary', 'exponential' or 'gaussian', got {kind!r}")
+        weights.data = np.where(keep, data, 0.0)
+        weights.eliminate_zeros()
+        return weights
+
+
+def _fingerprint(cells: np.ndarray) -> str:
+    return hashlib.sha256(np.ascontiguousarray(cells).tobytes()).hexdigest()[:32]
+
+
+def neighborhood(cells, k: int, n_workers: int = None) -> H3Neighborhood:
+    """The `H3Neighborhood` of `cells` up to `k` rings, built once per set of cells and `k`."""
+    cells = np.unique(h3_to_int_array(cells))
+    key = (_fingerprint(cells), int(k))
+    with _neighborhoods_lock:
+        cached = _neighborhoods.get(key)
+        if cached is not None:
+            _neighborhoods.move_to_end(key)
+            return cached
+    built = H3Neighborhood(cells, k, n_workers=n_workers)
+    with _neighborhoods_lock:
+        _neighborhoods[key] = built
+        while len(_neighborhoods) > NEIGHBORS_CACHE_SIZE:
+            _neighborhoods.popitem(last=False)
+    return built
+
+
+def _index(hood: H3Neighborhood, values: pd.Series) -> pd.Index:
+    return pd.Index(hood.cells, name=values.index.name)
+
+
+def k_ring_cells(cells, k: int) -> np.ndarray:
+    """The distinct cells up to `k` rings around `cells`, `cells` included (sorted uint64)."""
+    cells = np.unique(h3_to_int_array(cells))
+    parts = [_k_ring_chunk((i, cells[i:i + NEIGHBORS_CHUNK_SIZE], int(k)))[1]
+             for i in range(0, len(cells), NEIGHBORS_CHUNK_SIZE)]
+    return np.unique(np.concatenate(parts)) if parts else cells
+
+
+def _observed(values: pd.Series, k: int, n_workers: int) -> Tuple[H3Neighborhood, np.ndarray]:
+    hood = neighborhood(values.index.to_numpy(), k, n_workers=n_workers)
+    x = hood.align(values)
+    if np.isnan(x).any():
+        raise ValueError('the values must not be missing')
+    return hood, x
+
+
+def _filled(values: pd.Series, k: int, n_workers: int) -> Tuple[H3Neighborhood, np.ndarray]:
+    """Like `_observed`, over the observed cells and the cells up to `k` rings around them (0)."""
+    if values.isna().any():
+        raise ValueError('the values must not be missing')
+    hood = neighborhood(k_ring_cells(values.index.to_numpy(), k), k, n_workers=n_workers)
+    return hood, np.nan_to_num(hood.align(values), nan=0.0)
+
+
+def k_ring_sum(values: pd.Series, k: int = 1, include_self: bool = True, n_workers: int = None) -> pd.Series:
+    """Sum of the values of the cells up to `k` rings away, for a Series indexed by cell."""
+    hood, x = _observed(values, k, n_workers)
+    sums = hood.weights('binary', include_self=include_self) @ x
+    return pd.Series(sums, index=_index(hood, values), name=f'{values.name}_sum_k{k}')
+
+
+def k_ring_mean(values: pd.Series, k: int = 1, include_self: bool = True, n_workers: int = None) -> pd.Series:
+    """Mean of the values of the cells up to `k` rings away that are in `values`."""
+    hood, x = _observed(values, k, n_workers)
+    weights = hood.weights('binary', include_self=include_self)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (weights @ x) / np.asarray(weights.sum(axis=1)).ravel()
+    return pd.Series(means, index=_index(hood, values), name=f'{values.name}_mean_k{k}')
+
+
+def decay_smooth(values: pd.Series, k: int = 2, kind: str = 'exponential', decay: float = 0.5,
+                 bandwidth: float = None, n_workers: int = None) -> pd.Series:
+    """Weighted mean of the values up to `k` rings away, the weights decaying with the distance.
+
+    See `H3Neighborhood.weights` for the kernels.
+    """
+    hood, x = _observed(values, k, n_workers)
+    weights = hood.weights(kind, decay=decay, bandwidth=bandwidth)
+    smoothed = (weights @ x) / np.asarray(weights.sum(axis=1)).ravel()
+    return pd.Series(smoothed, index=_index(hood, values), name=f'{values.name}_smooth_k{k}')
+
+
+def getis_ord_g(values: pd.Series, k: int = 1, n_workers: int = None) -> pd.DataFrame:
+    """Getis-Ord Gi* of every cell, with binary weights up to `k` rings (the cell included).
+
+    The cells up to `k` rings around the cells of `values` count 0.
+
+    Returns:
+        pd.DataFrame: `z` (the Gi* z-score, > 0 for hotspots) and `p` (two-sided), indexed by
+        the cells of `values` and the cells around them.
+    """
+    hood, x = _filled(values, k, n_workers)
+    n = hood.n
+    weights = hood.weights('binary', include_self=True)
+    mean = x.mean()
+    s = np.sqrt((x ** 2).mean() - mean ** 2)
+    w_sum = np.asarray(weights.sum(axis=1)).ravel()
+    w_sq_sum = np.asarray(weights.multiply(weights).sum(axis=1)).ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z = (weights @ x - mean * w_sum) / (s * np.sqrt((n * w_sq_sum - w_sum ** 2) / (n - 1)))
+    return pd.DataFrame({'z': z, 'p': 2 * stats.norm.sf(np.abs(z))}, index=_index(hood, values))
+
+
+def _row_standardized(hood: H3Neighborhood, k: int) -> 'sparse.csr_matrix':
+    weights = hood.weights('binary', k=k, include_self=False)
+    row_sums = np.asarray(weights.sum(axis=1)).ravel()
+    with np.errstate(divide='ignore'):
+        return sparse.diags(np.where(row_sums > 0, 1 / row_sums, 0.0)) @ weights
+
+
+def morans_i(values: pd.Series, k: int = 1, n_workers: int = None) -> dict:
+    """Global Moran's I with row-standardized weights up to `k` rings, and its z-score under normality.
+
+    The cells up to `k` rings around the cells of `values` count 0.
+
+    Returns:
+        dict: `I`, its expectation `EI`, variance `VI`, `z` and two-sided `p`.
+    """
+    hood, x = _filled(values, k, n_workers)
+    n = hood.n
+    weights = _row_standardized(hood, k)
+    z = x - x.mean()
+    s0 = weights.sum()
+    moran = n / s0 * (z @ (weights @ z)) / (z @ z)
+
+    symmetric = weights + weights.T
+    s1 = 0.5 * symmetric.multiply(symmetric).sum()
+    s2 = ((np.asarray(weights.sum(axis=1)).ravel() + np.asarray(weights.sum(axis=0)).ravel()) ** 2).sum()
+    expected = -1 / (n - 1)
+    variance = (n ** 2 * s1 - n * s2 + 3 * s0 ** 2) / ((n ** 2 - 1) * s0 ** 2) - expected ** 2
+    z_score = (moran - expected) / np.sqrt(variance)
+    return {'I': float(moran), 'EI': expected, 'VI': float(variance),
+            'z': float(z_score), 'p': float(2 * stats.norm.sf(abs(z_score)))}
+
+
+def local_morans_i(values: pd.Series, k: int = 1, n_workers: int = None) -> pd.DataFrame:
+    """Local Moran's I (Anselin, 1995) with row-standardized weights up to `k` rings.
+
+    The z-scores use the expectation and variance of Ii under randomization. The
+    cells up to `k` rings around the cells of `values` count 0.
+
+    Returns:
+        pd.DataFrame: `I`, `z`, two-sided `p` and the `quadrant` of the cell in the Moran
+        scatterplot ('HH', 'LH', 'LL', 'HL'), indexed by the cells of `values` and the
+        cells around them.
+    """
+    hood, x = _filled(values, k, n_workers)
+    n = hood.n
+    weights = _row_standardized(hood, k)
+    z = x - x.mean()
+    m2 = (z ** 2).mean()
+    lag = weights @ z
+    local = z / m2 * lag
+
+    b2 = (z ** 4).mean() / m2 ** 2
+    w_i = np.asarray(weights.sum(axis=1)).ravel()
+    w_i2 = np.asarray(weights.multiply(weights).sum(axis=1)).ravel()
+    expected = -w_i / (n - 1)
+    variance = (w_i2 * (n - b2) / (n - 1)
+                + (w_i ** 2 - w_i2) * (2 * b2 - n) / ((n - 1) * (n - 2))
+                - expected ** 2)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        z_scores = (local - expected) / np.sqrt(variance)
+
+    quadrant = np.where(z >= 0, np.where(lag >= 0, 'HH', 'HL'), np.where(lag >= 0, 'LH', 'LL'))
+    return pd.DataFrame({'I': local, 'z': z_scores, 'p': 2 * stats.norm.sf(np.abs(z_scores)), 'quadrant': quadrant},
+                        index=_index(hood, values))
+
+
+# shared by every session of the app process
+_neighborhoods = OrderedDict()
+_neighborhoods_lock = threading.Lock()
@@ -0,0 +1,198 @@
+"""Multi-resolution H3 aggregates ("pyramid") persisted as Parquet.
+
+The points of a dataset are indexed once at the finest resolution; every
+coarser level is rolled up from the level below it with `h3_to_parent`.
+Each level is written to `<root_dir>/<fingerprint>/res_<resolution>.parquet`
+so a resolution slider can read any level without recomputation. The folder
+also records the dataset it was built from, so the levels of the older
+versions of a dataset are removed when a new one is built.
+"""
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from turpy.logger import log
+from config import H3_PYRAMID_DIRPATH
+from h3_funtools import check_h3_resolution, missing_geometries, points_to_h3
+from h3_store import FIELDS, aggregate_cells, merge_tables, rollup, table_to_frame
+
+# levels kept in memory after being read
+PYRAMID_MEMORY_LEVELS = 16
+# file of a pyramid folder naming the dataset it was built from
+SOURCE_FILENAME = 'source.txt'
+
+
+class H3Pyramid:
+    """Precomputed per-cell aggregates of a dataset at every resolution of a range.
+
+    Example:
+        >>> pyramid = H3Pyramid('./data/h3_pyramid')
+        >>> pyramid.build(fingerprint, cells, finest_resolution=10, coarsest_resolution=4)
+        >>> pyramid.read(fingerprint, 7)
+    """
+
+    def __init__(self, root_dir: str = H3_PYRAMID_DIRPATH):
+        self.root_dir = Path(root_dir)
+        self._levels = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _filepath(self, fingerprint: str, resolution: int) -> Path:
+        return self.root_dir / fingerprint / f'res_{resolution:02d}.parquet'
+
+    def levels(self, fingerprint: str) -> List[int]:
+        """Returns the resolutions persisted for `fingerprint`."""
+        dirpath = self.root_dir / fingerprint
+        if not dirpath.is_dir():
+            return []
+        return sorted(int(path.stem.split('_')[1]) for path in dirpath.glob('res_*.parquet'))
+
+    def has(self, fingerprint: str, resolution: int) -> bool:
+        return self._filepath(fingerprint, resolution).exists()
+
+    def build_from_table(
+            self,
+            fingerprint: str,
+            table: Dict[str, np.ndarray],
+            finest_resolution: int,
+            coarsest_resolution: int = 0,
+            source: str = None) -> List[int]:
+        """Persists an aggregate table at `finest_resolution` and all its coarser levels.
+
+        Args:
+            fingerprint (str): dataset fingerprint.
+            table (Dict[str, np.ndarray]): aggregates at `finest_resolution`
+                (see `h3_store.aggregate_cells`).
+            finest_resolution (int): resolution of `table`.
+            coarsest_resolution (int, optional): last level to build. Defaults to 0.
+            source (str, optional): path of the dataset. If given, the pyramids of
+                its other fingerprints are removed. Defaults to None.
+
+        Returns:
+            List[int]: the resolutions written.
+        """
+        finest_resolution = check_h3_resolution(finest_resolution)
+        coarsest_resolution = check_h3_resolution(coarsest_resolution)
+        if coarsest_resolution > finest_resolution:
+            raise ValueError('coarsest_resolution must not be finer than finest_resolution')
+
+        written = []
+        for resolution in range(finest_resolution, coarsest_resolution - 1, -1):
+            if resolution < finest_resolution:
+                # each level is rolled up from the previous, already reduced one
+                table = rollup(table, resolution)
+            self._write(fingerprint, resolution, table)
+            written.append(resolution)
+        if source is not None:
+            self._set_source(fingerprint, source)
+        return written
+
+    @staticmethod
+    def _source_key(source: str) -> str:
+        return os.path.normcase(os.path.abspath(source))
+
+    def _set_source(self, fingerprint: str, source: str) -> None:
+        """Records `source` as the dataset of `fingerprint` and removes its older pyramids."""
+        source = self._source_key(source)
+        (self.root_dir / fingerprint / SOURCE_FILENAME).write_text(source, encoding='utf-8')
+        for dirpath in self.root_dir.iterdir():
+            if dirpath.name == fingerprint or not dirpath.is_dir():
+                continue
+            try:
+                stale = (dirpath / SOURCE_FILENAME).read_text(encoding='utf-8') == source
+            except OSError:
+                continue
+            if stale:
+                self.remove(dirpath.name)
+
+    def remove(self, fingerprint: str) -> None:
+        """Removes the levels of `fingerprint`, from disk and from memory."""
+        with self._lock:
+            for key in [key for key in self._levels if key[0] == fingerprint]:
+                del self._levels[key]
+        shutil.rmtree(self.root_dir / fingerprint, ignore_errors=True)
+        log.info(f'H3Pyramid.remove: removed the levels of {fingerprint}')
+
+    def build(
+            self,
+            fingerprint: str,
+            cells: np.ndarray,
+            finest_resolution: int,
+            coarsest_resolution: int = 0,
+            values: np.ndarray = None) -> List[int]:
+        """Builds the pyramid from points indexed at `finest_resolution`."""
+        return self.build_from_table(
+            fingerprint, aggregate_cells(cells, values),
+            finest_resolution, coarsest_resolution)
+
+    def build_from_chunks(
+            self,
+            fingerprint: str,
+            chunks: Iterable,
+            finest_resolution: int,
+            coarsest_resolution: int = 0,
+            value_column: str = None) -> List[int]:
+        """Builds the pyramid from GeoDataFrame point chunks, indexing each chunk once."""
+        table = None
+        for chunk in chunks:
+            # the values of the points left out by points_to_h3 are left out with them
+            chunk = chunk[~missing_geometries(chunk.geometry)]
+            if chunk.empty:
+                continue
+            cells = points_to_h3(chunk, finest_resolution).to_numpy()
+            values = None if value_column is None else chunk[value_column].to_numpy()
+            chunk_table = aggregate_cells(cells, values)
+            table = chunk_table if table is None else merge_tables(table, chunk_table)
+        if table is None:
+            table = aggregate_cells(np.empty(0, dtype=np.uint64))
+        return self.build_from_table(fingerprint, table, finest_resolution, coarsest_resolution)
+
+    def _write(self, fingerprint: str, resolution: int, table: Dict[str, np.ndarray]) -> None:
+        filepath = self._filepath(fingerprint, resolution)
+        filepath.parent.mkdir(parents=True, exist_ok=True)
+        # the jobs building the same dataset each write their own
+        tmp_filepath = filepath.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            pd.DataFrame({'cells': table['cells'], **{field: table[field] for field in FIELDS}}
+                         ).to_parquet(tmp_filepath, index=False)
+            os.replace(tmp_filepath, filepath)
+        finally:
+            if tmp_filepath.exists():
+                tmp_filepath.unlink()
+        with self._lock:
+            self._levels.pop((fingerprint, resolution), None)
+
+    def read(self, fingerprint: str, resolution: int) -> Optional[pd.DataFrame]:
+        """Returns the level `resolution` of `fingerprint`, indexed by uint64 cell id.
+
+        Returns `None` if the level was not built. The frame is a copy: the sessions
+        sharing the pyramid may modify it.
+        """
+        key = (fingerprint, check_h3_resolution(resolution))
+        with self._lock:
+            if key in self._levels:
+                self._levels.move_to_end(key)
+                return self._levels[key].copy()
+
+        filepath = self._filepath(*key)
+        if not filepath.exists():
+            return None
+        data = pd.read_parquet(filepath)
+        level = table_to_frame(
+            {'cells': data['cells'].to_numpy(dtype=np.uint64),
+             **{field: data[field].to_numpy() for field in FIELDS}}, resolution)
+
+        with self._lock:
+            self._levels[key] = level
+            while len(self._levels) > PYRAMID_MEMORY_LEVELS:
+                self._levels.popitem(last=False)
+        return level.copy()
+
+
+# shared by every session of the app process
+pyramid = H3Pyramid()
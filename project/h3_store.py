@@ -0,0 +1,244 @@
+"""On-disk, mergeable per-cell H3 aggregates.
+
+Aggregates are kept per (dataset fingerprint, resolution) as compact NumPy
+arrays (`cells`, `count`, `sum`, `min`, `max`) in
+`<root_dir>/<fingerprint>/res_<resolution>.npz`. Coarser resolutions are
+rolled up from a stored finer one with `h3_to_parent`, so the raw points
+are never read again.
+"""
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+import pandas as pd
+
+from config import H3_STORE_DIRPATH
+from h3_funtools import check_h3_resolution, h3_to_parent_array
+
+FIELDS = ('count', 'sum', 'min', 'max')
+
+
+def _empty_table() -> Dict[str, np.ndarray]:
+    return {'cells': np.empty(0, dtype=np.uint64),
+            'count': np.empty(0, dtype=np.int64),
+            'sum': np.empty(0, dtype=np.float64),
+            'min': np.empty(0, dtype=np.float64),
+            'max': np.empty(0, dtype=np.float64)}
+
+
+def _reduce(table: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Combines the rows of `table` that share a cell."""
+    if len(table['cells']) == 0:
+        return _empty_table()
+    order = np.argsort(table['cells'], kind='stable')
+    cells = table['cells'][order]
+    unique, starts = np.unique(cells, return_index=True)
+    return {'cells': unique,
+            'count': np.add.reduceat(table['count'][order], starts),
+            'sum': np.add.reduceat(table['sum'][order], starts),
+            'min': np.minimum.reduceat(table['min'][order], starts),
+            'max': np.maximum.reduceat(table['max'][order], starts)}
+
+
+def _concat(*tables: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    return {key: np.concatenate([table[key] for table in tables])
+            for key in ('cells',) + FIELDS}
+
+
+def merge_tables(*tables: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+    """Merges aggregate tables into one, combining the rows of shared cells."""
+    return _reduce(_concat(*tables))
+
+
+def aggregate_cells(cells: np.ndarray, values: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """Aggregates per-point `values` by H3 cell.
+
+    Args:
+        cells (np.ndarray): integer H3 cell of each point.
+        values (np.ndarray, optional): value of each point. Defaults to None (1 per point).
+
+    Returns:
+        Dict[str, np.ndarray]: sorted unique `cells` with their `count`, `sum`, `min` and `max`.
+    """
+    cells = np.asarray(cells, dtype=np.uint64)
+    if values is None:
+        values = np.ones(len(cells), dtype=np.float64)
+    values = np.asarray(values, dtype=np.float64)
+    if values.shape != cells.shape:
+        raise ValueError('`cells` and `values` must have the same shape')
+    return _reduce({'cells': cells,
+                    'count': np.ones(len(cells), dtype=np.int64),
+                    'sum': values, 'min': values, 'max': values})
+
+
+class TableAccumulator:
+    """Aggregates chunks of indexed points into one table, outside of any store.
+
+    Each chunk is reduced on its own, and reduced tables are merged only
+    with tables built from as many points (as in a binary counter), so
+    every point is re-sorted about log2(chunks) times instead of the whole
+    running table being re-sorted for every chunk.
+    """
+
+    def __init__(self):
+        # (points, table) pairs, the points decreasing
+        self._tables = []
+
+    def add(self, cells: np.ndarray, values: np.ndarray = None) -> None:
+        """Adds a chunk of points, by cell (see `aggregate_cells`)."""
+        points, table = len(cells), aggregate_cells(cells, values)
+        while self._tables and self._tables[-1][0] <= points:
+            previous_points, previous = self._tables.pop()
+            points, table = points + previous_points, merge_tables(previous, table)
+        self._tables.append((points, table))
+
+    def table(self) -> Dict[str, np.ndarray]:
+        """The aggregates of all the chunks added."""
+        if not self._tables:
+            return _empty_table()
+        if len(self._tables) == 1:
+            return self._tables[0][1]
+        return merge_tables(*(table for _, table in self._tables))
+
+
+def rollup(table: Dict[str, np.ndarray], resolution: int) -> Dict[str, np.ndarray]:
+    """Rolls an aggregate table up to the coarser `resolution`."""
+    parents = dict(table, cells=h3_to_parent_array(table['cells'], resolution))
+    return _reduce(parents)
+
+
+def table_to_frame(table: Dict[str, np.ndarray], resolution: int) -> pd.DataFrame:
+    """Returns an aggregate table as a DataFrame indexed by uint64 cell id."""
+    return pd.DataFrame({field: table[field] for field in FIELDS},
+                        index=pd.Index(table['cells'], name=f'H3_{resolution}'))
+
+
+class H3AggregationStore:
+    """Per-cell count/sum/min/max aggregates keyed by (dataset fingerprint, resolution).
+
+    Tables are held in memory once read or computed, so switching between
+    stored resolutions does not touch the disk. A dataset is aggregated
+    privately, in a `TableAccumulator`, and published whole with `put`, so
+    sessions indexing the same dataset never see, or add to, each other's
+    partial counts. `merge` only updates the in-memory table; call `save`
+    once the dataset has been fully merged. Tables with unsaved merges are
+    not served by `get`.
+
+    Example:
+        >>> store = H3AggregationStore('./data/h3_store')
+        >>> accumulator = TableAccumulator()
+        >>> for chunk in chunks:
+        ...     accumulator.add(points_to_h3(chunk, 9).to_numpy())
+        >>> store.put(fingerprint, 9, accumulator.table())
+        >>> store.get(fingerprint, 7)  # rolled up from resolution 9
+    """
+
+    def __init__(self, root_dir: str = H3_STORE_DIRPATH):
+        self.root_dir = Path(root_dir)
+        self._tables = {}
+        self._unsaved = set()
+        self._lock = threading.RLock()
+
+    def _filepath(self, fingerprint: str, resolution: int) -> Path:
+        return self.root_dir / fingerprint / f'res_{resolution:02d}.npz'
+
+    def resolutions(self, fingerprint: str) -> List[int]:
+        """Returns the resolutions stored for `fingerprint`, in memory or on disk."""
+        stored = {res for fp, res in self._tables if fp == fingerprint}
+        dirpath = self.root_dir / fingerprint
+        if dirpath.is_dir():
+            stored.update(int(path.stem.split('_')[1]) for path in dirpath.glob('res_*.npz'))
+        return sorted(stored)
+
+    def _load(self, fingerprint: str, resolution: int) -> Optional[Dict[str, np.ndarray]]:
+        key = (fingerprint, resolution)
+        if key not in self._tables:
+            filepath = self._filepath(fingerprint, resolution)
+            if not filepath.exists():
+                return None
+            with np.load(filepath) as data:
+                self._tables[key] = {name: data[name] for name in data.files}
+        return self._tables[key]
+
+    def _drop_coarser(self, fingerprint: str, resolution: int) -> None:
+        # coarser tables rolled up from the previous state are stale now
+        for res in self.resolutions(fingerprint):
+            if res < resolution:
+                self._tables.pop((fingerprint, res), None)
+                self._filepath(fingerprint, res).unlink(missing_ok=True)
+
+    def put(self, fingerprint: str, resolution: int, table: Dict[str, np.ndarray]) -> None:
+        """Replaces the aggregates of (`fingerprint`, `resolution`) with `table` and saves them.
+
+        The replacement is atomic: `get` serves the previous table or this one.
+        """
+        resolution = check_h3_resolution(resolution)
+        with self._lock:
+            self._tables[(fingerprint, resolution)] = table
+            self._drop_coarser(fingerprint, resolution)
+            self.save(fingerprint, resolution)
+
+    def merge(self, fingerprint: str, resolution: int,
+              cells: np.ndarray, values: np.ndarray = None) -> None:
+        """Adds a chunk of indexed points to the aggregates of (`fingerprint`, `resolution`)."""
+        resolution = check_h3_resolution(resolution)
+        chunk = aggregate_cells(cells, values)
+        with self._lock:
+            current = self._load(fingerprint, resolution)
+            self._tables[(fingerprint, resolution)] = (
+                chunk if current is None else merge_tables(current, chunk))
+            self._unsaved.add((fingerprint, resolution))
+            self._drop_coarser(fingerprint, resolution)
+
+    def save(self, fingerprint: str, resolution: int) -> None:
+        """Writes the table of (`fingerprint`, `resolution`) to disk atomically."""
+        with self._lock:
+            table = self._tables[(fingerprint, resolution)]
+            filepath = self._filepath(fingerprint, resolution)
+            filepath.parent.mkdir(parents=True, exist_ok=True)
+            tmp_filepath = filepath.with_name(f'{filepath.stem}-{os.getpid()}-{threading.get_ident()}.tmp')
+            with open(tmp_filepath, 'wb') as f:
+                np.savez(f, **table)
+            os.replace(tmp_filepath, filepath)
+            self._unsaved.discard((fingerprint, resolution))
+
+    def get_table(self, fingerprint: str, resolution: int) -> Optional[Dict[str, np.ndarray]]:
+        """Returns the raw arrays of (`fingerprint`, `resolution`), rolling them up if needed.
+
+        Returns `None` when neither the resolution nor any finer one is stored.
+        """
+        resolution = check_h3_resolution(resolution)
+        with self._lock:
+            if (fingerprint, resolution) in self._unsaved:
+                return None
+            table = self._load(fingerprint, resolution)
+            if table is not None:
+                return table
+            finer = [res for res in self.resolutions(fingerprint)
+                     if res > resolution and (fingerprint, res) not in self._unsaved]
+            if not finer:
+                return None
+            table = rollup(self._load(fingerprint, finer[0]), resolution)
+            self._tables[(fingerprint, resolution)] = table
+            self.save(fingerprint, resolution)
+            return table
+
+    def get(self, fingerprint: str, resolution: int) -> Optional[pd.DataFrame]:
+        """Returns the aggregates of (`fingerprint`, `resolution`) as a DataFrame indexed by cell."""
+        table = self.get_table(fingerprint, resolution)
+        return None if table is None else table_to_frame(table, resolution)
+
+    def clear(self, fingerprint: str) -> None:
+        """Removes every table of `fingerprint` from memory and disk."""
+        with self._lock:
+            for key in [key for key in self._tables if key[0] == fingerprint]:
+                del self._tables[key]
+                self._unsaved.discard(key)
+            shutil.rmtree(self.root_dir / fingerprint, ignore_errors=True)
+
+
+# shared by every session of the app process
+store = H3AggregationStore()
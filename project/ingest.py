@@ -0,0 +1,257 @@
+"""Streaming ingestion of tab-separated station data into Parquet.
+
+An uploaded file is parsed in chunks of whole station blocks
+(`N_ROWS_PER_STATION` rows: the video frames and the presence summary row),
+so memory stays a small multiple of the chunk size whatever the size of the
+file. The column dtypes are those given, or inferred once from the first
+chunk and then enforced on every chunk, so that all the row groups of the
+Parquet file share one schema.
+
+Each block is validated as it is read: with a station column, its rows must
+all carry the same, non-missing station id, not seen in an earlier block;
+the last block must be complete. Invalid blocks are left out of the Parquet
+file and listed in the report.
+
+The output is named after the content of the file and the ingestion
+parameters, so the reruns of a service reuse it instead of ingesting the
+same upload again.
+"""
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from turpy.logger import log
+from config import INGEST_CHUNK_STATIONS, INGEST_DIRPATH
+from development_API import N_ROWS_PER_STATION
+
+# invalid blocks listed in a report (all of them are counted)
+INGEST_MAX_ERRORS = 1000
+# column added with the (0-based) station block of every row
+BLOCK_COLUMN = 'station_block'
+# bytes hashed per read when fingerprinting an upload
+_HASH_BUFFER_SIZE = 2 ** 20
+
+
+def _no_progress(fraction: float, message: str = '') -> None:
+    pass
+
+
+def _stream_size(stream: BinaryIO) -> int:
+    position = stream.tell()
+    size = stream.seek(0, os.SEEK_END)
+    stream.seek(position)
+    return size
+
+
+def stream_digest(stream: BinaryIO) -> str:
+    """SHA-256 of the content of a seekable binary stream, read in bounded memory."""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for block in iter(lambda: stream.read(_HASH_BUFFER_SIZE), b''):
+        digest.update(block)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def infer_dtypes(sample: pd.DataFrame) -> Dict[str, str]:
+    """Dtypes of the columns of `sample`, that the following chunks can be read with.
+
+    Integers and booleans become the nullable pandas dtypes (a later chunk
+    may have missing values) and the text, or empty, columns are strings.
+    """
+    dtypes = {}
+    for column, dtype in sample.dtypes.items():
+        if sample[column].isna().all():
+            dtypes[column] = 'string'
+        elif pd.api.types.is_bool_dtype(dtype):
+            dtypes[column] = 'boolean'
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtypes[column] = 'Int64'
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[column] = 'float64'
+        else:
+            dtypes[column] = 'string'
+    return dtypes
+
+
+class BlockValidator:
+    """Validates the station blocks of consecutive chunks, each starting on a block boundary.
+
+    Args:
+        station_column (str, optional): column of the station ids. Defaults to None (only
+            the completeness of the blocks is checked).
+        rows_per_station (int, optional): rows per block. Defaults to N_ROWS_PER_STATION.
+    """
+
+    def __init__(self, station_column: str = None, rows_per_station: int = N_ROWS_PER_STATION):
+        self.station_column = station_column
+        self.rows_per_station = rows_per_station
+        self.rows = 0
+        self.blocks = 0
+        self.invalid_blocks = 0
+        self.errors = []
+        self._seen = set()
+
+    def _error(self, block: int, reason: str, station=None) -> None:
+        self.invalid_blocks += 1
+        if len(self.errors) < INGEST_MAX_ERRORS:
+            # data rows start on line 2, after the header
+            self.errors.append({'block': int(block), 'line': int(2 + block * self.rows_per_station),
+                                'station': None if station is None else str(station), 'reason': reason})
+
+    def validate(self, chunk: pd.DataFrame) -> np.ndarray:
+        """Validates the blocks of `chunk`; returns the block number of each row, -1 for the invalid ones."""
+        rows_per_station = self.rows_per_station
+        n_blocks = -(-len(chunk) // rows_per_station)
+        local_blocks = np.arange(len(chunk)) // rows_per_station
+        valid = np.ones(n_blocks, dtype=bool)
+
+        if len(chunk) % rows_per_station:
+            valid[-1] = False
+            self._error(self.blocks + n_blocks - 1,
+                        f'incomplete block of {len(chunk) % rows_per_station} rows')
+
+        if self.station_column is not None:
+            n_full = len(chunk) // rows_per_station
+            stations = chunk[self.station_column].to_numpy()[:n_full * rows_per_station]
+            codes, uniques = pd.factorize(stations)
+            codes = codes.reshape(n_full, rows_per_station)
+            missing = (codes < 0).any(axis=1)
+            mixed = (codes != codes[:, :1]).any(axis=1)
+            for i in np.flatnonzero(missing | mixed):
+                valid[i] = False
+                self._error(self.blocks + i, 'missing station id' if missing[i] else 'several station ids')
+            for i in np.flatnonzero(~(missing | mixed)):
+                station = uniques[codes[i, 0]]
+                if station in self._seen:
+                    valid[i] = False
+                    self._error(self.blocks + i, 'station already ingested', station)
+                else:
+                    self._seen.add(station)
+
+        block_numbers = np.where(valid[local_blocks], self.blocks + local_blocks, -1)
+        self.rows += len(chunk)
+        self.blocks += n_blocks
+        return block_numbers
+
+
+def ingest_tsv(
+        stream: BinaryIO,
+        name: str = 'upload',
+        output_dirpath: str = INGEST_DIRPATH,
+        station_column: str = None,
+        dtypes: Dict[str, str] = None,
+        chunk_stations: int = INGEST_CHUNK_STATIONS,
+        rows_per_station: int = N_ROWS_PER_STATION,
+        encoding: str = 'utf-8',
+        progress: Callable[[float, str], None] = _no_progress) -> dict:
+    """Ingests a tab-separated file of station blocks into a Parquet file, in chunks.
+
+    Args:
+        stream (BinaryIO): seekable binary stream of the file, e.g. a Streamlit upload.
+        name (str, optional): name of the file, for the report. Defaults to 'upload'.
+        output_dirpath (str, optional): folder of the Parquet files and their reports.
+            Defaults to INGEST_DIRPATH.
+        station_column (str, optional): column of the station ids. Defaults to None.
+        dtypes (Dict[str, str], optional): dtypes of (some of) the columns; the others are
+            inferred from the first chunk. Defaults to None.
+        chunk_stations (int, optional): station blocks per chunk. Defaults to INGEST_CHUNK_STATIONS.
+        rows_per_station (int, optional): rows per block. Defaults to N_ROWS_PER_STATION.
+        encoding (str, optional): text encoding. Defaults to 'utf-8'.
+        progress (Callable[[float, str], None], optional): progress callback.
+
+    Returns:
+        dict: the report: `parquet_filepath`, `rows`, `rows_written`, `blocks`, `invalid_blocks`,
+        `errors` (the first INGEST_MAX_ERRORS invalid blocks) and `dtypes`.
+    """
+    params = {'station_column': station_column, 'dtypes': dtypes or {},
+              'rows_per_station': rows_per_station, 'encoding': encoding}
+    key = hashlib.sha256(json.dumps(
+        {'content': stream_digest(stream), **params}, sort_keys=True).encode()).hexdigest()[:32]
+    output_dirpath = Path(output_dirpath)
+    parquet_filepath = output_dirpath / f'{key}.parquet'
+    report_filepath = output_dirpath / f'{key}.json'
+    if parquet_filepath.exists() and report_filepath.exists():
+        with open(report_filepath) as f:
+            return json.load(f)
+
+    output_dirpath.mkdir(parents=True, exist_ok=True)
+    size = max(_stream_size(stream), 1)
+    chunk_rows = chunk_stations * rows_per_station
+
+    # dtypes inferred from the first chunk, then enforced on all of them
+    sample = pd.read_csv(stream, sep='\t', encoding=encoding, nrows=chunk_rows, dtype=dtypes)
+    stream.seek(0)
+    frozen_dtypes = {**infer_dtypes(sample), **(dtypes or {})}
+    del sample
+    if station_column is not None and station_column not in frozen_dtypes:
+        raise ValueError(f'{name}: no column {station_column!r}')
+
+    validator = BlockValidator(station_column, rows_per_station)
+    # the sessions uploading the same file each write their own
+    tmp_filepath = parquet_filepath.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+    writer, rows_written, completed = None, 0, False
+    try:
+        reader = pd.read_csv(stream, sep='\t', encoding=encoding, dtype=frozen_dtypes, chunksize=chunk_rows)
+        for chunk in reader:
+            if chunk.empty:
+                # a header without rows
+                continue
+            blocks = validator.validate(chunk)
+            valid = blocks >= 0
+            chunk = chunk[valid].assign(**{BLOCK_COLUMN: blocks[valid]})
+            table = pa.Table.from_pandas(
+                chunk, schema=writer.schema if writer is not None else None, preserve_index=False)
+            if writer is None:
+                writer = pq.ParquetWriter(str(tmp_filepath), table.schema, compression='snappy')
+            writer.write_table(table)
+            rows_written += len(chunk)
+            progress(min(stream.tell() / size, 1.0),
+                     f'{validator.rows:,} rows, {validator.blocks:,} stations read')
+        completed = True
+    except ValueError as exc:
+        # a value that does not parse with the dtype of its column
+        raise ValueError(f'{name}: {exc} (after row {validator.rows:,})') from exc
+    finally:
+        if writer is not None:
+            writer.close()
+        if not completed and tmp_filepath.exists():
+            # a failed (or interrupted) ingestion leaves no partial file behind
+            tmp_filepath.unlink()
+
+    if writer is None:
+        raise ValueError(f'{name}: no rows')
+    os.replace(tmp_filepath, parquet_filepath)
+
+    report = {'name': name, 'parquet_filepath': str(parquet_filepath), 'rows': validator.rows,
+              'rows_written': rows_written, 'blocks': validator.blocks,
+              'invalid_blocks': validator.invalid_blocks,
+              'errors': sorted(validator.errors, key=lambda error: error['block']),
+              'dtypes': frozen_dtypes}
+    with open(report_filepath, 'w') as f:
+        json.dump(report, f, indent=2)
+    log.info(f'ingest_tsv: {name}: {rows_written:,} of {validator.rows:,} rows written to {parquet_filepath}')
+    return report
+
+
+def read_header(stream: BinaryIO, encoding: str = 'utf-8') -> list:
+    """The column names of a tab-separated stream, which is rewound."""
+    columns = list(pd.read_csv(stream, sep='\t', encoding=encoding, nrows=0).columns)
+    stream.seek(0)
+    return columns
+
+
+def preview(parquet_filepath: str, rows: int = 20) -> Optional[pd.DataFrame]:
+    """The first rows of an ingested file, read from its first row group only."""
+    parquet_file = pq.ParquetFile(parquet_filepath)
+    if parquet_file.num_row_groups == 0:
+        return None
+    return parquet_file.read_row_group(0).slice(0, rows).to_pandas()
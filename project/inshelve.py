@@ -1,47 +1,405 @@
 
+import bisect
+import difflib
+import json
 import os
+import pickle
 import shelve
+import sqlite3
+import threading
+from contextlib import contextmanager
 from turpy.logger import log
-from config import SHELVE_FILEPATH
-from typing import List
+from config import SHELF_FILEPATH, SHELVE_FILEPATH
+from typing import Any, Dict, Iterable, List, Optional
 
-#TODO: refactor as class
+PICKLE_PROTOCOL = 4
 
+# version of the field encoding, in PRAGMA user_version (0: pickled field names)
+_SCHEMA_VERSION = 1
 
-def shelf_persist(data: dict, table_key: str, SHELVE_FILEPATH: str = SHELVE_FILEPATH):
-    """Persist dictionaries and objects in shelve. This is toy implementation. 
-    Shelve will be open without `writeback=True`. Shelves do not track modifications
-    to volatile objects, by default. That means if you change the contents of an item
-    stored in the shelf, you must update the shelf explicitly by storing the item again.
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS fields (
+    table_key TEXT NOT NULL,
+    field BLOB NOT NULL,
+    value BLOB NOT NULL,
+    UNIQUE (table_key, field)
+);
+CREATE TABLE IF NOT EXISTS generations (
+    table_key TEXT PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tables (
+    table_key TEXT PRIMARY KEY
+);
+"""
+
+
+def _dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=PICKLE_PROTOCOL)
+
+
+def _canonical(key: Any) -> Any:
+    """JSON form of a str, int, float, bool or None key, or of a tuple of them; None if there is none."""
+    if key is None or isinstance(key, (str, int, float)):
+        return key
+    if isinstance(key, tuple):
+        items = [_canonical(item) for item in key]
+        if all(item is not None or key_item is None for item, key_item in zip(items, key)):
+            return {'tuple': items}
+    return None
+
+
+def _decode_tuples(obj: dict) -> Any:
+    return tuple(obj['tuple']) if set(obj) == {'tuple'} else obj
+
+
+def encode_field(field: Any) -> Any:
+    """Stored form of a field name: canonical JSON text for the str, int, float, bool,
+    None and tuple keys, so that equal keys are always stored the same; a pickle
+    (BLOB) for the other keys."""
+    canonical = _canonical(field)
+    if canonical is None and field is not None:
+        return _dumps(field)
+    return json.dumps(canonical, sort_keys=True)
+
+
+def decode_field(stored: Any) -> Any:
+    """Field name from its stored form (see `encode_field`)."""
+    if isinstance(stored, str):
+        return json.loads(stored, object_hook=_decode_tuples)
+    return pickle.loads(stored)
+
+
+def normalize_key(key: Any) -> Any:
+    """Case-folds strings and collapses their whitespace; other keys are returned as is."""
+    return ' '.join(key.split()).casefold() if isinstance(key, str) else key
+
+
+class KeyIndex:
+    """In-memory index of the field names of one table, for fast matching.
+
+    Built once per write generation of the table. Exact lookups use a dict of
+    key positions; the normalized map and the sorted keys used for prefix
+    matching are only built when first needed.
+    """
+
+    def __init__(self, keys: list, generation: int):
+        self.generation = generation
+        self.keys = keys
+        self.positions = {key: position for position, key in enumerate(keys)}
+        self._normalized = None
+        self._sorted = None
+
+    @property
+    def normalized(self) -> Dict[Any, List[int]]:
+        if self._normalized is None:
+            normalized = {}
+            for position, key in enumerate(self.keys):
+                normalized.setdefault(normalize_key(key), []).append(position)
+            self._normalized = normalized
+        return self._normalized
+
+    @property
+    def sorted_keys(self) -> list:
+        """(normalized key, position) pairs of the string keys, sorted."""
+        if self._sorted is None:
+            self._sorted = sorted((normalize_key(key), position)
+                                  for position, key in enumerate(self.keys)
+                                  if isinstance(key, str))
+        return self._sorted
+
+    def match(self, input: Iterable, normalize: bool = False, prefix: bool = False,
+              fuzzy_cutoff: float = None) -> list:
+        """Returns the keys matched by the items of `input`, in table order.
+
+        :param input: items to look up.
+        :param normalize: ignore case and repeated/surrounding whitespace.
+        :param prefix: also match keys that start with an item (implies `normalize`).
+        :param fuzzy_cutoff: if given, items without a match are matched to the
+            closest key with a similarity ratio of at least `fuzzy_cutoff` (0-1).
+        """
+        positions = set()
+        unmatched = []
+        for item in set(input):
+            if not normalize and not prefix:
+                position = self.positions.get(item)
+                if position is not None:
+                    positions.add(position)
+                    continue
+            else:
+                found = self.normalized.get(normalize_key(item))
+                if found:
+                    positions.update(found)
+                    if not prefix:
+                        continue
+            if prefix and isinstance(item, str):
+                start = normalize_key(item)
+                i = bisect.bisect_left(self.sorted_keys, (start,))
+                matched = False
+                while i < len(self.sorted_keys) and self.sorted_keys[i][0].startswith(start):
+                    positions.add(self.sorted_keys[i][1])
+                    matched = True
+                    i += 1
+                if matched:
+                    continue
+            unmatched.append(item)
+
+        if fuzzy_cutoff is not None and unmatched:
+            candidates = {}
+            for normalized, position in self.sorted_keys:
+                candidates.setdefault(normalized, position)
+            candidate_keys = list(candidates)
+            for item in unmatched:
+                if isinstance(item, str):
+                    close = difflib.get_close_matches(
+                        normalize_key(item), candidate_keys, n=1, cutoff=fuzzy_cutoff)
+                    positions.update(candidates[key] for key in close)
+
+        return [self.keys[position] for position in sorted(positions)]
+
+
+class Shelf:
+    """Persistent dictionaries ("tables") stored in SQLite, a replacement for `shelve`.
+
+    Every field of a table is stored as its own row, so updating a table
+    only writes the fields given instead of re-pickling the whole table.
+    The database runs in WAL mode: many sessions can read while one writes,
+    including from other processes. One connection is opened per process
+    and reused by all its threads.
+
+    Fields keep the order in which they were first stored, like a dict.
+
+    :param filepath: path of the SQLite database.
+    :param legacy_shelve_filepath: a `shelve` file imported when the database is created.
+    :param timeout: seconds to wait for the write lock held by another process.
+
+    Field names are stored canonically (see `encode_field`), so equal keys
+    always address the same row.
+
+    :Warning: Values (and the field names that are not str, numbers or tuples)
+    are stored with `pickle`, it is insecure to load a database from an untrusted source.
+    """
+
+    def __init__(self, filepath: str = SHELF_FILEPATH,
+                 legacy_shelve_filepath: str = None, timeout: float = 30.0):
+        self.filepath = filepath
+        self.legacy_shelve_filepath = legacy_shelve_filepath
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+        self._batch_depth = 0
+        self._indexes = {}
+
+    def _connect(self) -> sqlite3.Connection:
+        # a connection must not be shared with a forked child process
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(os.path.abspath(self.filepath))
+            os.makedirs(directory, exist_ok=True)
+            is_new = not os.path.exists(self.filepath)
+            connection = sqlite3.connect(self.filepath, timeout=self.timeout,
+                                         isolation_level=None, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            connection.executescript(_SCHEMA)
+            if connection.execute('PRAGMA user_version').fetchone()[0] < _SCHEMA_VERSION:
+                self._migrate(connection)
+            self._connection, self._pid = connection, os.getpid()
+            if is_new and self.legacy_shelve_filepath is not None:
+                self.import_shelve(self.legacy_shelve_filepath)
+        return self._connection
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection) -> None:
+        """Re-encodes the pickled field names of a version 0 database (see `encode_field`)."""
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = connection.execute('SELECT rowid, field FROM fields ORDER BY rowid').fetchall()
+            connection.executemany(
+                'UPDATE OR REPLACE fields SET field = ? WHERE rowid = ?',
+                [(encode_field(pickle.loads(field)), rowid) for rowid, field in rows])
+            connection.execute('INSERT OR IGNORE INTO tables (table_key) SELECT DISTINCT table_key FROM fields')
+            connection.execute(f'PRAGMA user_version = {_SCHEMA_VERSION}')
+        except BaseException:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    @contextmanager
+    def batch(self):
+        """Groups the writes made inside the block into one transaction.
+
+        Blocks can be nested; only the outermost one commits.
+        """
+        with self._lock:
+            connection = self._connect()
+            if self._batch_depth == 0:
+                connection.execute('BEGIN IMMEDIATE')
+            self._batch_depth += 1
+            try:
+                yield self
+            except BaseException:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    connection.execute('ROLLBACK')
+                raise
+            else:
+                self._batch_depth -= 1
+                if self._batch_depth == 0:
+                    connection.execute('COMMIT')
+
+    def persist(self, data: dict, table_key: str) -> None:
+        """Stores the fields of `data` in `table_key`, keeping the other fields of the table."""
+        self.persist_many({table_key: data})
+
+    def _bump_generations(self, table_keys: Iterable[str]) -> None:
+        self._connection.executemany(
+            'INSERT INTO generations (table_key, generation) VALUES (?, 1) '
+            'ON CONFLICT (table_key) DO UPDATE SET generation = generation + 1',
+            [(table_key,) for table_key in table_keys])
+
+    def persist_many(self, tables: Dict[str, dict]) -> None:
+        """Stores the fields of several tables in a single transaction."""
+        rows = [(table_key, encode_field(field), _dumps(value))
+                for table_key, data in tables.items()
+                for field, value in data.items()]
+        with self.batch():
+            # a table exists once persisted, even without fields
+            self._connection.executemany('INSERT OR IGNORE INTO tables (table_key) VALUES (?)',
+                                         [(table_key,) for table_key in tables])
+            self._connection.executemany(
+                'INSERT INTO fields (table_key, field, value) VALUES (?, ?, ?) '
+                'ON CONFLICT (table_key, field) DO UPDATE SET value = excluded.value', rows)
+            self._bump_generations(tables)
+
+    def delete(self, table_key: str, fields: Iterable = None) -> None:
+        """Removes `fields` from `table_key`, or the whole table if `fields` is None."""
+        with self.batch():
+            if fields is None:
+                self._connection.execute('DELETE FROM fields WHERE table_key = ?', (table_key,))
+                self._connection.execute('DELETE FROM tables WHERE table_key = ?', (table_key,))
+            else:
+                self._connection.executemany(
+                    'DELETE FROM fields WHERE table_key = ? AND field = ?',
+                    [(table_key, encode_field(field)) for field in fields])
+            self._bump_generations([table_key])
+
+    def read(self, table_key: str) -> Optional[dict]:
+        """Returns the dictionary stored at `table_key`, or None if there is no such table."""
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT field, value FROM fields WHERE table_key = ? ORDER BY rowid',
+                (table_key,)).fetchall()
+            if not rows and table_key not in self:
+                return None
+        return {decode_field(field): pickle.loads(value) for field, value in rows}
+
+    def read_fields(self, table_key: str, fields: Iterable) -> dict:
+        """Returns only `fields` of `table_key`; missing fields are left out."""
+        keys = [encode_field(field) for field in fields]
+        result = {}
+        with self._lock:
+            connection = self._connect()
+            # stay below SQLITE_MAX_VARIABLE_NUMBER
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = connection.execute(
+                    f'SELECT field, value FROM fields WHERE table_key = ? '
+                    f'AND field IN ({",".join("?" * len(chunk))})',
+                    [table_key] + chunk).fetchall()
+                result.update((decode_field(field), pickle.loads(value)) for field, value in rows)
+        return result
+
+    def keys(self, table_key: str) -> list:
+        """Returns the field names of `table_key` without loading their values."""
+        with self._lock:
+            rows = self._connect().execute(
+                'SELECT field FROM fields WHERE table_key = ? ORDER BY rowid',
+                (table_key,)).fetchall()
+        return [decode_field(field) for field, in rows]
+
+    def generation(self, table_key: str) -> int:
+        """Write generation of `table_key`, incremented by every write to the table.
+
+        Writes made by other processes are seen as well.
+        """
+        with self._lock:
+            row = self._connect().execute(
+                'SELECT generation FROM generations WHERE table_key = ?', (table_key,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def index(self, table_key: str) -> KeyIndex:
+        """Returns the cached `KeyIndex` of `table_key`, rebuilt only after a write to the table."""
+        generation = self.generation(table_key)
+        index = self._indexes.get(table_key)
+        if index is None or index.generation != generation:
+            index = KeyIndex(self.keys(table_key), generation)
+            self._indexes[table_key] = index
+        return index
+
+    def tables(self) -> List[str]:
+        with self._lock:
+            rows = self._connect().execute('SELECT table_key FROM tables').fetchall()
+        return [table_key for table_key, in rows]
+
+    def __contains__(self, table_key: str) -> bool:
+        with self._lock:
+            return self._connect().execute(
+                'SELECT 1 FROM tables WHERE table_key = ?', (table_key,)).fetchone() is not None
+
+    def import_shelve(self, shelve_filepath: str) -> int:
+        """Copies every table of a `shelve` file into this store, returns the number of tables."""
+        try:
+            with shelve.open(shelve_filepath, flag='r') as db:
+                tables = {table_key: db[table_key] for table_key in db.keys()}
+        except Exception as msg:
+            log.info(f'no shelve imported from {shelve_filepath}: {msg}')
+            return 0
+        self.persist_many({table_key: data for table_key, data in tables.items()
+                           if isinstance(data, dict)})
+        return len(tables)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+_shelves = {}
+_shelves_lock = threading.Lock()
+
+
+def get_shelf(filepath: str = SHELF_FILEPATH) -> Shelf:
+    """Returns the process-wide `Shelf` of `filepath`."""
+    key = os.path.abspath(filepath)
+    with _shelves_lock:
+        if key not in _shelves:
+            legacy = SHELVE_FILEPATH if key == os.path.abspath(SHELF_FILEPATH) else None
+            _shelves[key] = Shelf(filepath, legacy_shelve_filepath=legacy)
+        return _shelves[key]
+
+
+def shelf_persist(data: dict, table_key: str, SHELVE_FILEPATH: str = SHELF_FILEPATH):
+    """Persist dictionaries and objects in the shelf. Only the fields in `data`
+    are written; the other fields already stored in `table_key` are kept.
+
+    See: `Shelf`
 
-    See: [docs](https://docs.python.org/3/library/shelve.html)
-    See also: [PERSISTENT DICT WITH MULTIPLE STANDARD FILE FORMATS (PYTHON RECIPE)](https://code.activestate.com/recipes/576642/)
-    
     :param
     :param data: data holding dictionary
     :param table_key: key to store the dictionary
+    :param SHELVE_FILEPATH: filepath of the shelf database.
+
+    :returns: True if success else False
 
-    :Warning:  Because the `shelve` module is backed by `pickle`,
-    it is insecure to load a shelf from an untrusted source. 
+    :Warning:  Because the shelf is backed by `pickle`,
+    it is insecure to load a shelf from an untrusted source.
     Like with `pickle`, loading a shelf can execute arbitrary code.
     """
-
-    
+    # TODO: autoremove *key* if the len(data) < len(db[table_key])
     try:
-        with shelve.open(SHELVE_FILEPATH, writeback=False) as db:
-
-            flag = table_key in db
-
-            # TODO: autoremove *key* if the len(data) < len(db[table_key])
-            if flag:
-                # extract a copy
-                _holder = db[table_key]
-                # mutate the copy
-                _holder.update(data)
-                # stores the copy right back, to persist it
-                db[table_key] = _holder                
-            else:
-                db[table_key] = data
+        get_shelf(SHELVE_FILEPATH).persist(data, table_key)
     except Exception as msg:
         log.error(f'persist_data_in_shelve_error: {msg}')
         return False
@@ -49,42 +407,46 @@ def shelf_persist(data: dict, table_key: str, SHELVE_FILEPATH: str = SHELVE_FILE
         return True
 
 
-def shelf_read(table_key: str, SHELVE_FILEPATH: str= SHELVE_FILEPATH):
+def shelf_read(table_key: str, SHELVE_FILEPATH: str = SHELF_FILEPATH):
     """Returns the dictionary stored at `table_key`
 
     :param table_key: table name used as key to store the dictionary.
-    :param SHELVE_FILEPATH: filepath of the shelve file.
+    :param SHELVE_FILEPATH: filepath of the shelf database.
 
     :returns: if success returns {table_key: db[table_key]} else None
     """
-    try:            
-        with shelve.open(SHELVE_FILEPATH, writeback=False) as db:
-            
-            flag = table_key in db
-
-            if flag:
-                return {table_key: db[table_key]}
-            else:
-                return None
+    try:
+        data = get_shelf(SHELVE_FILEPATH).read(table_key)
     except Exception as msg:
         log.error(f'shelf read error: {msg}')
         return None
-        
+    return None if data is None else {table_key: data}
+
 
-def match_in_shelve(input: List[str], table_key: str = 'biota_columns') -> list:
+def match_in_shelve(input: List[str], table_key: str = 'biota_columns',
+                    normalize: bool = False, prefix: bool = False,
+                    fuzzy_cutoff: float = None) -> list:
     """Matches an input list of strings to the dictionary keys stored in `table_key`
 
+    The keys are matched against an in-memory index of the table that is only
+    rebuilt after the table has been written to. See `KeyIndex.match`.
+
     :param input: List of strings to match in `table_key` dictionary
-    :param table_key: string name with the table key to search in shelf. 
+    :param table_key: string name with the table key to search in shelf.
+    :param normalize: ignore case and whitespace differences.
+    :param prefix: also match the keys starting with an input string.
+    :param fuzzy_cutoff: similarity (0-1) above which unmatched strings are matched to the closest key.
 
-    :returns: a list with the items from the input list found in `table_key`. 
-              `None` if match was unsuccessfull
+    :returns: a list with the keys of `table_key` matched by the input list, in table order.
+              `None` if there is no such table or the match was unsuccessfull
     """
-
-    result = shelf_read(table_key)
-    if result is not None:
-        return [c for c in result[table_key] if c in input]
-    else:
+    try:
+        shelf = get_shelf()
+        index = shelf.index(table_key)
+        if not index.keys and table_key not in shelf:
+            return None
+    except Exception as msg:
+        log.error(f'shelf match error: {msg}')
         return None
-
+    return index.match(input, normalize=normalize, prefix=prefix, fuzzy_cutoff=fuzzy_cutoff)
 
@@ -0,0 +1,317 @@
+"""Background jobs for the long stages of the services.
+
+A Streamlit rerun must not wait for a computation of several minutes, nor
+restart it. Stages (importable functions, see `stages.py`) are submitted to a
+process pool instead, as functions or by dotted name (so that the app process
+does not import them) and identified by a hash of the function and its
+parameters, so that the reruns and the sessions asking for the same thing
+share a single job. Scripts poll the job on each rerun without blocking.
+
+Jobs are recorded in an SQLite registry next to their pickled results, so a
+finished job is also reused after the app restarts, and progress reported
+by the worker processes is visible to every session.
+
+:Warning: results are stored with `pickle`, the jobs directory must not be
+writable by untrusted users.
+"""
+import hashlib
+import importlib
+import json
+import multiprocessing
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Callable, Optional, Union
+
+from turpy.logger import log
+from config import JOBS_DIRPATH, JOBS_MAX_WORKERS
+
+PENDING, RUNNING, DONE, FAILED = 'pending', 'running', 'done', 'failed'
+# minimum interval between two progress writes of a job
+PROGRESS_INTERVAL_S = 0.5
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    message TEXT NOT NULL DEFAULT '',
+    error TEXT,
+    owner_pid INTEGER,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+"""
+
+
+def _function_name(function: Union[Callable, str]) -> str:
+    """Dotted name of a function, e.g. 'stages.write_gridcounts'."""
+    if isinstance(function, str):
+        return function
+    return f'{function.__module__}.{function.__qualname__}'
+
+
+def _qualname(function: Union[Callable, str]) -> str:
+    if isinstance(function, str):
+        return function.rpartition('.')[2]
+    return function.__qualname__
+
+
+def _resolve(function: Union[Callable, str]) -> Callable:
+    """The function itself, imported if given by its dotted name."""
+    if isinstance(function, str):
+        module_name, _, name = function.rpartition('.')
+        return getattr(importlib.import_module(module_name), name)
+    return function
+
+
+def job_key(function: Union[Callable, str], params: dict) -> str:
+    """Hash of the function (or its dotted name) and its (JSON serializable) parameters."""
+    payload = json.dumps({'function': _function_name(function),
+                          'params': params}, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()[:32]
+
+
+def _pid_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobRegistry:
+    """Jobs and their pickled results, in `dirpath`.
+
+    One connection per process, in WAL mode so that the workers can report
+    progress while the app reads it.
+    """
+
+    def __init__(self, dirpath: str = JOBS_DIRPATH, timeout: float = 30.0):
+        self.dirpath = Path(dirpath)
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None or self._pid != os.getpid():
+            self.dirpath.mkdir(parents=True, exist_ok=True)
+            connection = sqlite3.connect(str(self.dirpath / 'jobs.sqlite'), timeout=self.timeout,
+                                         check_same_thread=False, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(_SCHEMA)
+            self._connection, self._pid = connection, os.getpid()
+        return self._connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def result_filepath(self, key: str) -> Path:
+        return self.dirpath / f'{key}.pkl'
+
+    def get(self, key: str) -> Optional[dict]:
+        rows = self._execute(
+            'SELECT key, name, params, status, progress, message, error, owner_pid, created, updated '
+            'FROM jobs WHERE key = ?', (key,))
+        if not rows:
+            return None
+        return dict(zip(('key', 'name', 'params', 'status', 'progress', 'message', 'error',
+                         'owner_pid', 'created', 'updated'), rows[0]))
+
+    def create(self, key: str, name: str, params: dict, owner_pid: int) -> None:
+        now = time.time()
+        self._execute(
+            'INSERT INTO jobs (key, name, params, status, progress, message, error, owner_pid, created, updated) '
+            "VALUES (?, ?, ?, ?, 0, '', NULL, ?, ?, ?) "
+            'ON CONFLICT (key) DO UPDATE SET status = excluded.status, progress = 0, message = \'\', '
+            'error = NULL, owner_pid = excluded.owner_pid, created = excluded.created, updated = excluded.updated',
+            (key, name, json.dumps(params, sort_keys=True, default=str), PENDING, owner_pid, now, now))
+
+    def update(self, key: str, **fields) -> None:
+        fields['updated'] = time.time()
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._execute(f'UPDATE jobs SET {assignments} WHERE key = ?', (*fields.values(), key))
+
+    def save_result(self, key: str, result: Any) -> None:
+        filepath = self.result_filepath(key)
+        tmp_filepath = filepath.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp_filepath, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filepath, filepath)
+
+    def load_result(self, key: str) -> Any:
+        with open(self.result_filepath(key), 'rb') as f:
+            return pickle.load(f)
+
+    def delete(self, key: str) -> None:
+        self._execute('DELETE FROM jobs WHERE key = ?', (key,))
+        self.result_filepath(key).unlink(missing_ok=True)
+
+
+def _run_job(dirpath: str, key: str, function: Union[Callable, str], params: dict) -> None:
+    """Runs a job in a worker process and records its progress, result or error."""
+    registry = JobRegistry(dirpath)
+    registry.update(key, status=RUNNING, owner_pid=os.getpid())
+    last_write = [0.0]
+
+    def progress(fraction: float, message: str = '') -> None:
+        now = time.monotonic()
+        if now - last_write[0] >= PROGRESS_INTERVAL_S:
+            last_write[0] = now
+            registry.update(key, progress=float(min(max(fraction, 0.0), 1.0)), message=str(message))
+
+    try:
+        result = _resolve(function)(progress=progress, **params)
+        registry.save_result(key, result)
+        registry.update(key, status=DONE, progress=1.0, message='')
+    except Exception:
+        error = traceback.format_exc()
+        log.error(f'job {_qualname(function)} {key} failed: {error}')
+        registry.update(key, status=FAILED, error=error)
+
+
+class Job:
+    """Handle on a submitted job; every property reads the current state of the registry."""
+
+    def __init__(self, registry: JobRegistry, key: str):
+        self.registry = registry
+        self.key = key
+
+    @property
+    def state(self) -> dict:
+        return self.registry.get(self.key) or {}
+
+    @property
+    def status(self) -> str:
+        return self.state.get('status', FAILED)
+
+    @property
+    def progress(self) -> float:
+        return self.state.get('progress', 0.0)
+
+    @property
+    def message(self) -> str:
+        return self.state.get('message', '')
+
+    @property
+    def error(self) -> Optional[str]:
+        return self.state.get('error')
+
+    @property
+    def done(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def result(self) -> Any:
+        """The result of a finished job, None while it is pending or running; raises if it failed."""
+        state = self.state
+        if state.get('status') == DONE:
+            return self.registry.load_result(self.key)
+        if state.get('status') == FAILED:
+            raise RuntimeError(f"job {state.get('name')} failed:\n{state.get('error')}")
+        return None
+
+
+class JobRunner:
+    """Runs the stages submitted by the services in a process pool, one job per parameter hash.
+
+    Args:
+        registry (JobRegistry, optional): job registry. Defaults to the one in JOBS_DIRPATH.
+        max_workers (int, optional): worker processes. Defaults to JOBS_MAX_WORKERS.
+    """
+
+    def __init__(self, registry: JobRegistry = None, max_workers: int = JOBS_MAX_WORKERS):
+        self.registry = registry or JobRegistry()
+        self.max_workers = max_workers
+        self._pool = None
+        self._futures = {}
+        self._lock = threading.RLock()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            # workers are spawned, not forked from the multithreaded app process
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self._pool
+
+    def _in_progress(self, key: str, state: dict) -> bool:
+        future = self._futures.get(key)
+        if future is not None:
+            return not future.done() or state['status'] in (PENDING, RUNNING)
+        # submitted by another app process (or before a restart) and still alive
+        return state['status'] in (PENDING, RUNNING) and state['owner_pid'] != os.getpid() \
+            and _pid_alive(state['owner_pid'])
+
+    def _submit_to_pool(self, key: str, function: Union[Callable, str], params: dict):
+        try:
+            return self._executor().submit(_run_job, str(self.registry.dirpath), key, function, params)
+        except BrokenProcessPool:
+            # a worker died and the pool refuses new work: start a new one
+            log.error(f'job {_qualname(function)} {key}: broken process pool, restarting it')
+            self._pool = None
+            return self._executor().submit(_run_job, str(self.registry.dirpath), key, function, params)
+
+    def submit(self, function: Union[Callable, str], rerun_failed: bool = False, versions: dict = None,
+               **params) -> Job:
+        """Returns the job computing `function(progress=..., **params)`, submitting it if needed.
+
+        `function` may be given by its dotted name (e.g. 'stages.write_gridcounts'),
+        which is only imported by the worker processes; the job key is the same.
+
+        A job that is done is reused as long as its result is on disk; a job that
+        failed is only submitted again if `rerun_failed`.
+
+        `versions` identifies the inputs read by the function (e.g. the
+        `file_fingerprint` of its files): it is part of the job key, so a changed
+        input makes a new job, but it is not passed to the function.
+        """
+        key = job_key(function, params if versions is None else {**params, '_versions': versions})
+        with self._lock:
+            state = self.registry.get(key)
+            if state is not None:
+                if state['status'] == DONE and self.registry.result_filepath(key).exists():
+                    return Job(self.registry, key)
+                if state['status'] == FAILED and not rerun_failed:
+                    return Job(self.registry, key)
+                if state['status'] in (PENDING, RUNNING) and self._in_progress(key, state):
+                    return Job(self.registry, key)
+
+            self.registry.create(key, _qualname(function), params, owner_pid=os.getpid())
+            self._futures[key] = self._submit_to_pool(key, function, params)
+            self._futures[key].add_done_callback(lambda future, key=key: self._finished(key, future))
+            log.info(f'job {_qualname(function)} {key} submitted')
+        return Job(self.registry, key)
+
+    def _finished(self, key: str, future) -> None:
+        error = future.exception()
+        if error is not None:
+            # the worker died before it could record the failure
+            self.registry.update(key, status=FAILED, error=repr(error))
+        # the registry holds the outcome from now on (reentrant lock: a future
+        # already done runs its callback inside `submit`)
+        with self._lock:
+            if self._futures.get(key) is future:
+                del self._futures[key]
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False)
+                self._pool = None
+
+
+# shared by every session of the app process
+job_runner = JobRunner()
@@ -0,0 +1,59 @@
+"""Lazy imports of the heavy libraries.
+
+`lazy_import(name)` returns a placeholder module that imports `name` on the
+first access to one of its attributes, so that a library only needed by some
+code paths (e.g. folium for the maps, matplotlib for the plots) does not
+delay the first paint of the services that import it:
+
+    folium = lazy_import('folium')
+    ...
+    fmap = folium.Map(...)  # folium is imported here
+
+Only attribute access triggers the import: annotations referring to a lazy
+module must be strings (`-> 'folium.Map'`), and `from x import y` stays eager.
+"""
+import importlib
+import sys
+import types
+
+
+class LazyModule(types.ModuleType):
+    """Placeholder of a module not imported yet (see `lazy_import`)."""
+
+    def _load(self) -> types.ModuleType:
+        module = self.__dict__.get('_module')
+        if module is None:
+            # the import lock makes concurrent first accesses safe
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attribute: str):
+        return getattr(self._load(), attribute)
+
+    def __dir__(self):
+        return dir(self._load())
+
+    def __repr__(self) -> str:
+        state = 'loaded' if '_module' in self.__dict__ else 'not loaded'
+        return f'<lazy module {self.__name__!r} ({state})>'
+
+
+def lazy_import(name: str) -> types.ModuleType:
+    """Returns the module `name` if it is already imported, otherwise a placeholder importing it on first use.
+
+    Args:
+        name (str): absolute module name, e.g. 'matplotlib.pyplot'.
+
+    Returns:
+        types.ModuleType: the module or its `LazyModule` placeholder.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    return LazyModule(name)
+
+
+def is_loaded(module: types.ModuleType) -> bool:
+    """True if `module` is a module or a placeholder whose module has been imported."""
+    return not isinstance(module, LazyModule) or '_module' in module.__dict__
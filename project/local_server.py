@@ -0,0 +1,125 @@
+"""Small HTTP server running next to Streamlit in the app process.
+
+Streamlit can only push whole pages to the browser. Content that the browser
+should fetch on demand (map tiles, file downloads) is served from here
+instead: modules register a handler for a path prefix and the server is
+started once per process, in a daemon thread.
+
+The browser reaches the server at `LOCAL_SERVER_PUBLIC_URL`, which must be
+exposed next to the Streamlit port (see `docker-compose.yaml`). Only the
+routes registered with `cross_origin` (the map tiles) can be read by the
+scripts of other origins. A port in use is an error, unless
+`LOCAL_SERVER_PORT_ATTEMPTS` allows trying the next ones; the public URL then
+follows the port actually bound, which the browser must be able to reach.
+"""
+import errno
+import os
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import BinaryIO, Callable, Dict, Tuple, Union
+from urllib.parse import parse_qs, urlsplit, urlunsplit
+
+from turpy.logger import log
+from config import LOCAL_SERVER_HOST, LOCAL_SERVER_PORT, LOCAL_SERVER_PORT_ATTEMPTS, LOCAL_SERVER_PUBLIC_URL
+
+# handler(path relative to the prefix, query) -> (status, headers, body); the
+# body is bytes or a binary file, streamed to the client and closed
+Handler = Callable[[str, Dict[str, list]], Tuple[int, Dict[str, str], Union[bytes, BinaryIO]]]
+# bytes per write when streaming a file body
+STREAM_BUFFER_SIZE = 2 ** 20
+
+_routes = {}
+_server = None
+_server_lock = threading.Lock()
+
+
+def register_route(prefix: str, handler: Handler, cross_origin: bool = False) -> None:
+    """Serves the GET requests whose path starts with `/<prefix>/` with `handler`.
+
+    Args:
+        prefix (str): first segment of the paths served.
+        handler (Handler): builds the response.
+        cross_origin (bool, optional): let the scripts of any origin read the responses
+            (`Access-Control-Allow-Origin: *`). Defaults to False.
+    """
+    _routes[prefix.strip('/')] = (handler, cross_origin)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        prefix, _, rest = url.path.lstrip('/').partition('/')
+        route = _routes.get(prefix)
+        if route is None:
+            self.send_error(404)
+            return
+        handler, cross_origin = route
+        try:
+            status, headers, body = handler(rest, parse_qs(url.query))
+        except Exception as msg:
+            log.error(f'local server error on {self.path}: {msg}')
+            self.send_error(500)
+            return
+        if cross_origin:
+            headers = {'Access-Control-Allow-Origin': '*', **headers}
+
+        if isinstance(body, bytes):
+            self._send(status, headers, body, len(body))
+        else:
+            with body:
+                self._send(status, headers, body, os.fstat(body.fileno()).st_size)
+
+    def _send(self, status: int, headers: Dict[str, str], body, length: int) -> None:
+        self.send_response(status)
+        self.send_header('Content-Length', str(length))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if isinstance(body, bytes):
+            self.wfile.write(body)
+        else:
+            shutil.copyfileobj(body, self.wfile, STREAM_BUFFER_SIZE)
+
+    def log_message(self, format, *args):
+        log.debug(f'local server: {format % args}')
+
+
+def _bind(host: str, port: int) -> ThreadingHTTPServer:
+    """A server bound to `port`, or to the first free port of the `LOCAL_SERVER_PORT_ATTEMPTS` from it."""
+    attempts = 1 if port == 0 else LOCAL_SERVER_PORT_ATTEMPTS
+    for attempt in range(attempts):
+        try:
+            return ThreadingHTTPServer((host, port + attempt), _RequestHandler)
+        except OSError as error:
+            if error.errno != errno.EADDRINUSE or attempt == attempts - 1:
+                log.error(f'local server: cannot listen on {host}:{port + attempt}: {error}; '
+                          f'free the port or set LOCAL_SERVER_PORT (and LOCAL_SERVER_PUBLIC_URL)')
+                raise
+            log.warning(f'local server: port {port + attempt} is in use, trying {port + attempt + 1}, '
+                        f'which the browser must be able to reach')
+
+
+def _public_url(port: int, bound_port: int) -> str:
+    url = urlsplit(LOCAL_SERVER_PUBLIC_URL.rstrip('/'))
+    if bound_port != port and url.port == port:
+        url = url._replace(netloc=f'{url.hostname}:{bound_port}')
+    return urlunsplit(url)
+
+
+def ensure_server(host: str = LOCAL_SERVER_HOST, port: int = LOCAL_SERVER_PORT) -> str:
+    """Starts the server if it is not running yet and returns its public URL."""
+    global _server
+    with _server_lock:
+        if _server is None:
+            server = _bind(host, port)
+            server.daemon_threads = True
+            threading.Thread(target=server.serve_forever, name='local_server',
+                             daemon=True).start()
+            _server = server
+            log.info(f'local server listening on {host}:{_server.server_address[1]}')
+    if port == 0:
+        # ephemeral port, only meaningful on this machine (tests)
+        return f'http://127.0.0.1:{_server.server_address[1]}'
+    return _public_url(port, _server.server_address[1])
@@ -0,0 +1,169 @@
+"""Parallel H3 polyfill of every feature of a GeoDataFrame.
+
+`h3.polyfill` is single-threaded and its cost grows with the bounding box of
+the polygon, so a single huge multipolygon (e.g. a dissolved NMD class
+layer) is slow to fill. Here multipart geometries are exploded into
+polygons, the polygons larger than `POLYFILL_TILE_DEG` are cut into
+bounding-box tiles, and the pieces can be filled in a process pool (spawned,
+not forked from the multithreaded app process; see `jobs.py`). The tiles
+overlap very slightly so that no cell centered on a seam is lost, and the
+cells found twice are de-duplicated.
+
+A cell belongs to a feature when its center lies inside the feature
+geometry, as in `h3.polyfill`.
+
+The cells of every piece are memoized in `h3_cache` by the digest of its
+coordinates and the resolution, so only new pieces are filled again on a
+rerun, or after a restart.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+import numpy as np
+import pandas as pd
+
+from h3_cache import geojson_digest, h3_cache
+from h3_funtools import check_h3_resolution
+from lazy import lazy_import
+from reproject import same_crs, to_crs
+
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+h3_int = lazy_import('h3.api.numpy_int')
+
+# polygons wider or taller than this (in degrees) are cut into tiles of this size
+POLYFILL_TILE_DEG = 0.25
+# overlap of neighbouring tiles, so that cells centered on a seam are kept
+POLYFILL_TILE_OVERLAP_DEG = 1e-7
+# pieces filled per task sent to the process pool
+POLYFILL_BATCH_SIZE = 64
+
+
+def _tile_polygon(polygon, tile_deg: float) -> list:
+    """Cuts `polygon` into pieces no larger than `tile_deg` x `tile_deg` degrees."""
+    minx, miny, maxx, maxy = polygon.bounds
+    if maxx - minx <= tile_deg and maxy - miny <= tile_deg:
+        return [polygon]
+
+    xs = np.arange(minx, maxx, tile_deg)
+    ys = np.arange(miny, maxy, tile_deg)
+    x0, y0 = (grid.ravel() for grid in np.meshgrid(xs, ys))
+    overlap = POLYFILL_TILE_OVERLAP_DEG
+    if hasattr(shapely, 'box'):
+        # shapely >= 2: vectorized
+        pieces = shapely.intersection(
+            polygon, shapely.box(x0 - overlap, y0 - overlap,
+                                 x0 + tile_deg + overlap, y0 + tile_deg + overlap))
+    else:
+        pieces = [polygon.intersection(shapely.geometry.box(x - overlap, y - overlap,
+                                           x + tile_deg + overlap, y + tile_deg + overlap))
+                  for x, y in zip(x0.tolist(), y0.tolist())]
+
+    polygons = []
+    for piece in pieces:
+        if piece.is_empty:
+            continue
+        parts = getattr(piece, 'geoms', [piece])
+        polygons.extend(part for part in parts if part.geom_type == 'Polygon' and not part.is_empty)
+    return polygons
+
+
+def _polyfill_batch(args) -> List[np.ndarray]:
+    geometries, resolution = args
+    return [np.asarray(h3_int.polyfill(geometry, resolution, geo_json_conformant=True), dtype=np.uint64)
+            for geometry in geometries]
+
+
+def _fill_pieces(geometries: List[dict], resolution: int, n_workers: int) -> List[np.ndarray]:
+    """The uint64 cells of every piece, filled once per distinct piece and resolution."""
+    keys = [geojson_digest(geometry) for geometry in geometries]
+    filled = h3_cache.get_many('polyfill', keys, resolution)
+    # identical pieces (e.g. the same feature twice) are filled once
+    missing = {}
+    for key, geometry in zip(keys, geometries):
+        if key not in filled:
+            missing.setdefault(key, geometry)
+    missing_keys, missing_geometries = list(missing), list(missing.values())
+
+    batches = [(missing_geometries[i:i + POLYFILL_BATCH_SIZE], resolution)
+               for i in range(0, len(missing_geometries), POLYFILL_BATCH_SIZE)]
+    if n_workers > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(batches)),
+                                 mp_context=multiprocessing.get_context('spawn')) as pool:
+            results = list(pool.map(_polyfill_batch, batches))
+    else:
+        results = [_polyfill_batch(batch) for batch in batches]
+
+    computed = dict(zip(missing_keys, (cells for result in results for cells in result)))
+    h3_cache.put_many('polyfill', computed, resolution)
+    filled.update(computed)
+    return [filled[key] for key in keys]
+
+
+def polygon_pieces(gdf: 'gpd.GeoDataFrame', tile_deg: float = POLYFILL_TILE_DEG
+                   ) -> Tuple[np.ndarray, List[dict]]:
+    """Explodes and tiles the geometries of `gdf` (in EPSG:4326).
+
+    Returns:
+        Tuple[np.ndarray, List[dict]]: row position of each piece and its GeoJSON geometry.
+    """
+    positions, geometries = [], []
+    for position, geometry in enumerate(gdf.geometry.values):
+        if geometry is None or geometry.is_empty:
+            continue
+        for polygon in getattr(geometry, 'geoms', [geometry]):
+            if polygon.geom_type != 'Polygon':
+                continue
+            for piece in _tile_polygon(polygon, tile_deg):
+                positions.append(position)
+                geometries.append(shapely.geometry.mapping(piece))
+    return np.asarray(positions, dtype=np.int64), geometries
+
+
+def polyfill_membership(
+        gdf: 'gpd.GeoDataFrame',
+        resolution: int,
+        tile_deg: float = POLYFILL_TILE_DEG,
+        n_workers: int = 1) -> pd.DataFrame:
+    """Fills every feature of `gdf` with H3 cells.
+
+    Args:
+        gdf (gpd.GeoDataFrame): polygons or multipolygons, in any CRS.
+        resolution (int): H3 resolution.
+        tile_deg (float, optional): size of the tiles large polygons are cut into.
+            Defaults to POLYFILL_TILE_DEG.
+        n_workers (int, optional): processes filling the pieces; None for all CPUs. Defaults
+            to 1, which fills them in this process (a streamlit rerun should not start a pool).
+
+    Returns:
+        pd.DataFrame: one row per (cell, feature) pair, with the uint64 cell in column
+        `H3_{resolution}` and the index label of the feature in `feature`. A cell
+        appears once per feature that contains its center.
+    """
+    resolution = check_h3_resolution(resolution)
+    if gdf.crs is not None and not same_crs(gdf.crs, 'EPSG:4326'):
+        gdf = to_crs(gdf, 'EPSG:4326')
+
+    positions, geometries = polygon_pieces(gdf, tile_deg)
+    n_workers = multiprocessing.cpu_count() if n_workers is None else n_workers
+    pieces = _fill_pieces(geometries, resolution, n_workers)
+
+    column = f'H3_{resolution}'
+    if not pieces:
+        return pd.DataFrame({column: np.empty(0, dtype=np.uint64), 'feature': gdf.index[:0]})
+
+    features = np.repeat(positions, [len(cells) for cells in pieces])
+    cells = np.concatenate(pieces)
+    # cells on the seams of the tiles (or in several parts of a feature) are found twice
+    order = np.lexsort((cells, features))
+    features, cells = features[order], cells[order]
+    first = np.ones(len(cells), dtype=bool)
+    first[1:] = (features[1:] != features[:-1]) | (cells[1:] != cells[:-1])
+    return pd.DataFrame({column: cells[first],
+                         'feature': gdf.index.take(features[first])})
+
+
+def polyfill_cells(gdf: 'gpd.GeoDataFrame', resolution: int, **kwargs) -> np.ndarray:
+    """The distinct uint64 H3 cells whose center lies in any feature of `gdf` (see `polyfill_membership`)."""
+    return np.unique(polyfill_membership(gdf, resolution, **kwargs)[f'H3_{resolution}'].to_numpy())
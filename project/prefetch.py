@@ -0,0 +1,247 @@
+"""Parallel, resumable download of the `DATA_URL_DICT` datasets.
+
+Each file is downloaded to `<name>.part`, resumed with HTTP range requests
+after an interruption and only renamed to its final name once complete.
+Its SHA-256 is then recorded in `<dirpath>/manifest.json`, and a dataset is
+only handed to `gpd.read_file` once it matches its manifest entry.
+
+Run `python project/prefetch.py` to download every dataset ahead of the
+first user session (e.g. when the container starts).
+"""
+import argparse
+import hashlib
+import http.client
+import json
+import os
+import re
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Dict, Union
+
+from turpy.logger import log
+from config import DATA_DIRPATH, DATA_URL_DICT
+
+MANIFEST_FILENAME = 'manifest.json'
+DOWNLOAD_BLOCK_SIZE = 1 << 20
+
+# (absolute path, size, mtime_ns) of the files already checked in this process
+_verified = set()
+_verified_lock = threading.Lock()
+# one download at a time per destination file
+_fetch_locks = defaultdict(threading.Lock)
+# one writer at a time per manifest file, whichever `Manifest` instance writes it
+_manifest_locks = defaultdict(threading.Lock)
+_manifest_locks_lock = threading.Lock()
+
+
+def direct_download_url(url: str) -> str:
+    """Turns a Google Drive share link into a direct download URL; other URLs are returned as is."""
+    match = re.search(r'drive\.google\.com/file/d/([^/]+)', url)
+    if match is None:
+        return url
+    return f'https://drive.usercontent.google.com/download?id={match.group(1)}&export=download&confirm=t'
+
+
+def sha256sum(filepath: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class Manifest:
+    """Checksums of the downloaded datasets, stored as JSON in `dirpath`.
+
+    The instances of the same file share a lock, so concurrent records (e.g.
+    two sessions fetching different datasets) are not lost. An unreadable
+    manifest reads as empty: its files are checked again.
+    """
+
+    def __init__(self, dirpath: Union[str, Path] = DATA_DIRPATH):
+        self.filepath = Path(dirpath) / MANIFEST_FILENAME
+        with _manifest_locks_lock:
+            self._lock = _manifest_locks[os.path.abspath(self.filepath)]
+
+    def read(self) -> Dict[str, dict]:
+        try:
+            with open(self.filepath) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as msg:
+            log.error(f'unreadable manifest {self.filepath}, its files are checked again: {msg}')
+            return {}
+        return manifest if isinstance(manifest, dict) else {}
+
+    def get(self, name: str) -> dict:
+        return self.read().get(name)
+
+    def record(self, name: str, **entry) -> None:
+        """Stores `entry` for `name`, rewriting the manifest atomically."""
+        with self._lock:
+            manifest = self.read()
+            manifest[name] = entry
+            self.filepath.parent.mkdir(parents=True, exist_ok=True)
+            tmp_filepath = self.filepath.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+            with open(tmp_filepath, 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            os.replace(tmp_filepath, self.filepath)
+
+
+def _total_size(response, offset: int) -> int:
+    content_range = response.headers.get('Content-Range')
+    if content_range and '/' in content_range and not content_range.endswith('/*'):
+        return int(content_range.rsplit('/', 1)[1])
+    content_length = response.headers.get('Content-Length')
+    return offset + int(content_length) if content_length is not None else None
+
+
+def download(url: str, destination: Union[str, Path], timeout: float = 60,
+             retries: int = 3, backoff: float = 1.0) -> Path:
+    """Downloads `url` to `destination`, resuming a previous partial download.
+
+    The data is written to `<destination>.part` and renamed to `destination`
+    only when the expected number of bytes has been received.
+
+    :param url: URL of the file (Google Drive share links are supported).
+    :param destination: final path of the file.
+    :param timeout: socket timeout in seconds.
+    :param retries: attempts after the first one, each resuming where the last stopped.
+    :param backoff: seconds to wait before the first retry, doubled on each retry.
+
+    :returns: `destination` as a Path.
+    """
+    destination = Path(destination)
+    destination.parent.mkdir(parents=True, exist_ok=True)
+    part_filepath = destination.with_name(destination.name + '.part')
+    url = direct_download_url(url)
+
+    for attempt in range(retries + 1):
+        offset = part_filepath.stat().st_size if part_filepath.exists() else 0
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        try:
+            with urllib.request.urlopen(urllib.request.Request(url, headers=headers),
+                                        timeout=timeout) as response:
+                if response.headers.get_content_type() == 'text/html':
+                    raise ValueError(f'{url} returned an HTML page instead of the file')
+                if offset and response.status != 206:
+                    # the server ignored the range, start over
+                    offset = 0
+                total_size = _total_size(response, offset)
+                with open(part_filepath, 'ab' if offset else 'wb') as f:
+                    for block in iter(lambda: response.read(DOWNLOAD_BLOCK_SIZE), b''):
+                        f.write(block)
+        except urllib.error.HTTPError as error:
+            if error.code == 416 and offset:
+                # range not satisfiable: the partial file already holds everything
+                total_size = offset
+            elif error.code >= 500 and attempt < retries:
+                log.warning(f'download of {destination.name} failed with HTTP {error.code}, retrying')
+                time.sleep(backoff * 2 ** attempt)
+                continue
+            else:
+                raise
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as error:
+            log.warning(f'download of {destination.name} interrupted '
+                        f'(attempt {attempt + 1}/{retries + 1}): {error}')
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            continue
+
+        size = part_filepath.stat().st_size
+        if total_size is None or size == total_size:
+            os.replace(part_filepath, destination)
+            return destination
+        if size > total_size:
+            part_filepath.unlink()
+            raise ValueError(f'{destination.name}: received {size} bytes, expected {total_size}')
+        log.warning(f'download of {destination.name} incomplete ({size}/{total_size} bytes)')
+
+    raise IOError(f'download of {destination.name} incomplete after {retries + 1} attempts')
+
+
+def verify_dataset(name: str, dirpath: Union[str, Path] = DATA_DIRPATH,
+                   manifest: Manifest = None) -> bool:
+    """Returns True if `<dirpath>/<name>` exists and matches its manifest entry.
+
+    A file is hashed once per (size, mtime) in this process.
+    """
+    manifest = manifest or Manifest(dirpath)
+    filepath = Path(dirpath) / name
+    entry = manifest.get(name)
+    if entry is None or not filepath.exists():
+        return False
+
+    stat = filepath.stat()
+    key = (str(filepath.resolve()), stat.st_size, stat.st_mtime_ns)
+    with _verified_lock:
+        if key in _verified:
+            return True
+    if stat.st_size != entry['size'] or sha256sum(filepath) != entry['sha256']:
+        return False
+    with _verified_lock:
+        _verified.add(key)
+    return True
+
+
+def fetch_dataset(url: str, name: str, dirpath: Union[str, Path] = DATA_DIRPATH,
+                  manifest: Manifest = None, **download_kwargs) -> Path:
+    """Returns the path of a verified local copy of dataset `name`, downloading it if needed."""
+    manifest = manifest or Manifest(dirpath)
+    filepath = Path(dirpath) / name
+    with _fetch_locks[str(filepath.resolve())]:
+        if verify_dataset(name, dirpath, manifest):
+            return filepath
+
+        if filepath.exists():
+            log.warning(f'{name} does not match the manifest, downloading it again')
+        download(url, filepath, **download_kwargs)
+        manifest.record(name, url=url, size=filepath.stat().st_size,
+                        sha256=sha256sum(filepath),
+                        downloaded_at=datetime.now(timezone.utc).isoformat(timespec='seconds'))
+        if not verify_dataset(name, dirpath, manifest):
+            raise IOError(f'{name} changed while it was being recorded')
+        return filepath
+
+
+def prefetch_datasets(data_url_dict: dict = DATA_URL_DICT,
+                      dirpath: Union[str, Path] = DATA_DIRPATH,
+                      max_workers: int = 4, **download_kwargs) -> Dict[str, Union[Path, Exception]]:
+    """Downloads and verifies every dataset of `data_url_dict` in parallel.
+
+    :returns: the local path of each dataset name, or the exception that made it fail.
+    """
+    manifest = Manifest(dirpath)
+    datasets = list(data_url_dict.values())
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {item['name']: pool.submit(fetch_dataset, item['URL'], item['name'],
+                                             dirpath, manifest, **download_kwargs)
+                   for item in datasets}
+
+    results = {}
+    for name, future in futures.items():
+        error = future.exception()
+        if error is not None:
+            log.error(f'prefetch of {name} failed: {error}')
+        results[name] = future.result() if error is None else error
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download and verify the DATA_URL_DICT datasets.')
+    parser.add_argument('--dirpath', default=DATA_DIRPATH)
+    parser.add_argument('--max-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    failed = [name for name, result in prefetch_datasets(
+        dirpath=args.dirpath, max_workers=args.max_workers).items()
+        if isinstance(result, Exception)]
+    raise SystemExit(1 if failed else 0)
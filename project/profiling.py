@@ -0,0 +1,170 @@
+"""Startup profile of the app: import times and first render of a service.
+
+The profile is taken in a fresh interpreter started with `-X importtime`, as
+on a cold container start. It records:
+
+- the time to import the app modules and to render the service a first
+  time (which loads it) and a second time (a rerun), with Streamlit in bare
+  mode (nothing is displayed);
+- the import time of every library, as the sum of the self times of its
+  modules, and the cumulative time of the modules imported at top level.
+
+The report is written as JSON to `PROFILING_DIRPATH`, one file per service,
+so that cold-start regressions can be tracked. Run from the repository root:
+
+    python project/profiling.py --service hexagon
+
+Rendering a service runs it for real (downloads, jobs): use `--no-render`
+to profile the imports only.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime, timezone
+
+from config import PROFILING_DIRPATH, SERVICES_YAML_URL
+
+# libraries listed in the report
+TOP_IMPORTS = 30
+
+
+def parse_importtime(stderr: str) -> list:
+    """Parses the `-X importtime` lines of `stderr`.
+
+    Returns:
+        list: (module, self seconds, cumulative seconds, depth) tuples, in import order.
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            # the header line
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(fields[0]) / 1e6, int(fields[1]) / 1e6, depth))
+    return imports
+
+
+def summarize_imports(imports: list, top: int = TOP_IMPORTS) -> dict:
+    """Import seconds per library and of the modules imported at top level, the slowest first."""
+    libraries = defaultdict(float)
+    for name, self_s, _, _ in imports:
+        libraries[name.split('.')[0]] += self_s
+    top_level = [(name, cumulative_s) for name, _, cumulative_s, depth in imports if depth == 0]
+    return {
+        'total_s': round(sum(self_s for _, self_s, _, _ in imports), 4),
+        'libraries': [{'name': name, 'seconds': round(seconds, 4)}
+                      for name, seconds in sorted(libraries.items(), key=lambda item: -item[1])[:top]],
+        'top_level': [{'name': name, 'cumulative_s': round(seconds, 4)}
+                      for name, seconds in sorted(top_level, key=lambda item: -item[1])[:top]],
+    }
+
+
+def _profile_service(service: str, render: bool) -> dict:
+    """Runs in the profiled interpreter: times the app imports and the renders of `service`."""
+    phases = {}
+    start = time.perf_counter()
+    import streamlit  # noqa: F401
+    phases['import_streamlit_s'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    from services import ServiceRegistry
+    registry = ServiceRegistry(SERVICES_YAML_URL)
+    services = registry.services()
+    phases['import_app_s'] = time.perf_counter() - start
+
+    if service not in services:
+        raise SystemExit(f'unknown service {service!r}, one of {list(services)}')
+    module_filepath = services[service]['url']
+
+    error = None
+    if render:
+        for phase in ('first_render_s', 'rerun_s'):
+            start = time.perf_counter()
+            try:
+                registry.run(module_filepath)
+            except Exception as exc:
+                error = f'{type(exc).__name__}: {exc}'
+            phases[phase] = time.perf_counter() - start
+            if error:
+                break
+    else:
+        # loads the module without calling render()
+        start = time.perf_counter()
+        registry.load(module_filepath)
+        phases['load_s'] = time.perf_counter() - start
+
+    return {'phases': {name: round(seconds, 4) for name, seconds in phases.items()}, 'error': error}
+
+
+def profile_startup(service: str = 'hexagon', render: bool = True) -> dict:
+    """Profiles the start of the app with `service` selected, in a new interpreter.
+
+    Args:
+        service (str, optional): name of the service in the services yaml. Defaults to 'hexagon'.
+        render (bool, optional): render the service (twice), otherwise only load it. Defaults to True.
+
+    Returns:
+        dict: the report.
+    """
+    command = [sys.executable, '-X', 'importtime', os.path.abspath(__file__),
+               '--service', service, '--child']
+    if not render:
+        command.append('--no-render')
+    start = time.perf_counter()
+    completed = subprocess.run(command, capture_output=True, text=True)
+    wall_s = time.perf_counter() - start
+    if completed.returncode != 0:
+        raise RuntimeError(f'profiling {service} failed:\n{completed.stderr[-4000:]}')
+
+    child = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {
+        'service': service,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'wall_s': round(wall_s, 4),
+        'phases': child['phases'],
+        'error': child['error'],
+        'imports': summarize_imports(parse_importtime(completed.stderr)),
+    }
+
+
+def write_report(report: dict, dirpath: str = PROFILING_DIRPATH) -> str:
+    """Writes `report` to `<dirpath>/startup_<service>.json` and returns its path."""
+    os.makedirs(dirpath, exist_ok=True)
+    filepath = os.path.join(dirpath, f"startup_{report['service']}.json")
+    with open(filepath, 'w') as f:
+        json.dump(report, f, indent=2)
+    return filepath
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Profile the import time and first render of a service.')
+    parser.add_argument('--service', default='hexagon')
+    parser.add_argument('--no-render', dest='render', action='store_false')
+    parser.add_argument('--dirpath', default=PROFILING_DIRPATH)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(_profile_service(args.service, args.render)))
+    else:
+        report = profile_startup(args.service, render=args.render)
+        filepath = write_report(report, args.dirpath)
+        for name, seconds in report['phases'].items():
+            print(f'{name:<24} {seconds:>8.3f}')
+        print(f"{'imports_s':<24} {report['imports']['total_s']:>8.3f}")
+        for library in report['imports']['libraries'][:10]:
+            print(f"  {library['name']:<22} {library['seconds']:>8.3f}")
+        if report['error']:
+            print(f"error: {report['error']}")
+        print(f'report written to {filepath}')
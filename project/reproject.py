@@ -0,0 +1,261 @@
+"""Fast reprojection of coordinates and GeoDataFrames.
+
+`GeoDataFrame.to_crs` creates a pyproj `Transformer` on every call and
+transforms in a single thread. Here the coordinates are transformed in
+place, in chunks, in thread pools that live as long as the process (PROJ
+releases the GIL), and each pool thread creates its transformers once per
+CRS pair (they must not be shared between threads). The Streamlit script
+threads, new on every rerun, never transform themselves. Only the coordinate arrays are transformed: the
+geometries are rebuilt from them in one vectorized call (shapely >= 2),
+and code that only needs the coordinates (e.g. `h3_funtools.points_to_h3`)
+does not rebuild any geometry.
+
+The datasets reprojected by `reprojected_dataset` and the geometries passed
+to `cached_to_crs` are memoized per (fingerprint, CRS), so the reruns of a
+service reuse them.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+from typing import Tuple, Union
+
+import numpy as np
+
+from dataset_cache import dataset_cache
+from geoio import file_fingerprint
+from lazy import lazy_import
+
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+pyproj = lazy_import('pyproj')
+
+# coordinates transformed per task sent to the thread pool
+REPROJECT_CHUNK_SIZE = 250_000
+# reprojected frames memoized for all the sessions
+REPROJECT_CACHE_SIZE = 8
+
+_local = threading.local()
+# persistent pools per number of workers, see `_executor`
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+@lru_cache(maxsize=64)
+def _crs(crs) -> 'pyproj.CRS':
+    return pyproj.CRS.from_user_input(crs)
+
+
+def as_crs(crs) -> 'pyproj.CRS':
+    """`crs` (EPSG code, string, pyproj CRS, ...) as a pyproj CRS, parsed once per distinct value."""
+    if isinstance(crs, pyproj.CRS):
+        return crs
+    return _crs(crs)
+
+
+@lru_cache(maxsize=256)
+def _same_crs(crs_from: str, crs_to: str) -> bool:
+    return pyproj.CRS.from_user_input(crs_from).equals(pyproj.CRS.from_user_input(crs_to))
+
+
+def same_crs(crs_from, crs_to) -> bool:
+    """True if the two CRS are equivalent, compared once per pair."""
+    return _same_crs(as_crs(crs_from).srs, as_crs(crs_to).srs)
+
+
+def get_transformer(crs_from, crs_to) -> 'pyproj.Transformer':
+    """The (always x, y) transformer between two CRS, created once per pair and thread."""
+    key = (as_crs(crs_from).srs, as_crs(crs_to).srs)
+    transformers = getattr(_local, 'transformers', None)
+    if transformers is None:
+        transformers = _local.transformers = {}
+    transformer = transformers.get(key)
+    if transformer is None:
+        transformer = transformers[key] = pyproj.Transformer.from_crs(
+            as_crs(crs_from), as_crs(crs_to), always_xy=True)
+    return transformer
+
+
+def _executor(n_workers: int = None) -> ThreadPoolExecutor:
+    """The process-wide pool of `n_workers` threads, whose transformers outlive the calls."""
+    # the threads of a pool do not survive in a forked child process
+    key = (os.getpid(), n_workers)
+    with _pools_lock:
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ThreadPoolExecutor(
+                max_workers=n_workers, thread_name_prefix='reproject')
+        return pool
+
+
+def transform_coordinates(
+        x: np.ndarray,
+        y: np.ndarray,
+        crs_from,
+        crs_to,
+        z: np.ndarray = None,
+        chunk_size: int = REPROJECT_CHUNK_SIZE,
+        n_workers: int = None) -> Tuple[np.ndarray, ...]:
+    """Transforms coordinate arrays in place, in chunks, in a thread pool.
+
+    Args:
+        x (np.ndarray): x (or longitude) coordinates, contiguous float64.
+        y (np.ndarray): y (or latitude) coordinates, contiguous float64.
+        crs_from: CRS of the coordinates.
+        crs_to: CRS to transform them to.
+        z (np.ndarray, optional): z coordinates, transformed too if given.
+        chunk_size (int, optional): coordinates per task. Defaults to REPROJECT_CHUNK_SIZE.
+        n_workers (int, optional): threads. Defaults to None (ThreadPoolExecutor default);
+            1 transforms the chunks one after the other.
+
+    Returns:
+        Tuple[np.ndarray, ...]: the same arrays, `(x, y)` or `(x, y, z)`.
+    """
+    arrays = (x, y) if z is None else (x, y, z)
+    for array in arrays:
+        if array.dtype != np.float64 or not array.flags.c_contiguous or not array.flags.writeable:
+            raise ValueError('coordinates must be writeable, contiguous float64 arrays')
+    if same_crs(crs_from, crs_to) or len(x) == 0:
+        return arrays
+
+    def transform(start: int) -> None:
+        transformer = get_transformer(crs_from, crs_to)
+        transformer.transform(*(array[start:start + chunk_size] for array in arrays), inplace=True)
+
+    # even a single chunk goes to the pool, whose threads keep their transformers
+    list(_executor(n_workers).map(transform, range(0, len(x), chunk_size)))
+    return arrays
+
+
+def transform_geometries(geometries: np.ndarray, crs_from, crs_to, n_workers: int = None) -> np.ndarray:
+    """Returns new geometries with the coordinates of `geometries` transformed (shapely >= 2)."""
+    geometries = np.asarray(geometries, dtype=object)
+    include_z = bool(shapely.has_z(geometries).any())
+    coordinates = shapely.get_coordinates(geometries, include_z=include_z)
+    columns = [np.ascontiguousarray(coordinates[:, i]) for i in range(coordinates.shape[1])]
+    transform_coordinates(*columns[:2], crs_from, crs_to, z=columns[2] if include_z else None,
+                          n_workers=n_workers)
+    if len(coordinates) == len(geometries) and (shapely.get_type_id(geometries) == 0).all():
+        # points: built directly, faster than replacing the coordinates
+        return shapely.points(*columns)
+    return shapely.set_coordinates(geometries.copy(), np.column_stack(columns))
+
+
+def to_crs(gdf: 'Union[gpd.GeoDataFrame, gpd.GeoSeries]', crs, n_workers: int = None
+           ) -> 'Union[gpd.GeoDataFrame, gpd.GeoSeries]':
+    """Same as `gdf.to_crs(crs)`, with cached transformers and threaded chunks.
+
+    The other columns are shallow copies. Falls back to `gdf.to_crs` with shapely < 2.
+    """
+    if gdf.crs is None:
+        raise ValueError('cannot reproject geometries without a CRS')
+    if same_crs(gdf.crs, crs):
+        return gdf.copy(deep=False)
+    if not hasattr(shapely, 'set_coordinates'):
+        return gdf.to_crs(crs)
+
+    geoseries = gdf.geometry if isinstance(gdf, gpd.GeoDataFrame) else gdf
+    geometries = transform_geometries(geoseries.values, gdf.crs, crs, n_workers=n_workers)
+    # the geometries are valid, they are not checked again one by one
+    reprojected = gpd.GeoSeries(gpd.array.GeometryArray(geometries, crs=as_crs(crs)),
+                                index=geoseries.index, name=geoseries.name)
+    if isinstance(gdf, gpd.GeoSeries):
+        return reprojected
+    gdf = gdf.copy(deep=False)
+    # the CRS of the frame is the one of its geometry column
+    gdf[gdf.geometry.name] = reprojected
+    return gdf
+
+
+def geometry_fingerprint(gdf: 'Union[gpd.GeoDataFrame, gpd.GeoSeries]') -> str:
+    """Hash of the geometries, index and CRS of `gdf` (points by their coordinates only)."""
+    geoseries = gdf.geometry if isinstance(gdf, gpd.GeoDataFrame) else gdf
+    geometries = np.asarray(geoseries.values, dtype=object)
+    digest = hashlib.sha256(str(gdf.crs).encode())
+    if (shapely.get_type_id(geometries) == 0).all():
+        digest.update(np.ascontiguousarray(shapely.get_coordinates(geometries, include_z=True)).tobytes())
+    else:
+        for wkb in shapely.to_wkb(geometries):
+            digest.update(wkb or b'')
+    index = geoseries.index
+    digest.update(index.to_numpy().tobytes() if index.dtype != object else repr(index.tolist()).encode())
+    return digest.hexdigest()[:32]
+
+
+class ReprojectionCache:
+    """LRU cache of reprojected frames, keyed by (fingerprint, CRS); hands out shallow copies.
+
+    Args:
+        max_entries (int, optional): frames kept. Defaults to REPROJECT_CACHE_SIZE.
+    """
+
+    def __init__(self, max_entries: int = REPROJECT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, fingerprint: str, crs, reproject) -> 'Union[gpd.GeoDataFrame, gpd.GeoSeries]':
+        """The frame of `fingerprint` in `crs`, calling `reproject()` to compute it on a miss."""
+        key = (fingerprint, as_crs(crs).srs)
+        with self._lock:
+            gdf = self._entries.get(key)
+            if gdf is not None:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return gdf.copy(deep=False)
+        gdf = reproject()
+        with self._lock:
+            self._misses += 1
+            self._entries[key] = gdf
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return gdf.copy(deep=False)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {'hits': self._hits, 'misses': self._misses,
+                    'hit_rate': self._hits / lookups if lookups else 0.0,
+                    'entries': len(self._entries)}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+def reprojected_dataset(filepath: Union[str, Path], crs='EPSG:4326') -> 'gpd.GeoDataFrame':
+    """The dataset of `filepath` (through `dataset_cache`) in `crs`, reprojected once per file version.
+
+    The returned frame is a shallow copy: its values must not be modified in place.
+    """
+    return reprojection_cache.get(
+        file_fingerprint(filepath), crs, lambda: to_crs(dataset_cache.get(filepath, mode='view'), crs))
+
+
+def cached_to_crs(gdf: 'Union[gpd.GeoDataFrame, gpd.GeoSeries]', crs, fingerprint: str = None
+                  ) -> 'Union[gpd.GeoDataFrame, gpd.GeoSeries]':
+    """`to_crs(gdf, crs)`, with the reprojected geometries memoized per `geometry_fingerprint`.
+
+    Hashing the geometries is much cheaper than transforming them. The other
+    columns are those of `gdf`, shallow copied.
+    """
+    geoseries = gdf.geometry if isinstance(gdf, gpd.GeoDataFrame) else gdf
+    if same_crs(gdf.crs, crs):
+        return gdf.copy(deep=False)
+    reprojected = reprojection_cache.get(
+        fingerprint or geometry_fingerprint(geoseries), crs, lambda: to_crs(geoseries, crs))
+    if isinstance(gdf, gpd.GeoSeries):
+        return reprojected
+    gdf = gdf.copy(deep=False)
+    gdf[gdf.geometry.name] = reprojected
+    return gdf
+
+
+# shared by every session of the app process
+reprojection_cache = ReprojectionCache()
@@ -1,21 +1,116 @@
 import os
+import sys
+import threading
+import types
 import streamlit as st
 from collections import OrderedDict
 from turpy.io.load_yaml import load_yaml
-from turpy.utils import script_as_module
+from turpy.logger import log
+
+
+class ServiceRegistry:
+    """Services listed in a yaml file, loaded once per process.
+
+    The yaml file is parsed again only when it is modified. Each service file is
+    compiled once and executed once as a module (`services.<name>`): its imports,
+    constants and functions are the load-once part. A service that defines a
+    `render()` function only has it called on the reruns; a service without one
+    is executed whole on every rerun, from its cached code object. A service file
+    is reloaded when it is modified. Services load outside the registry lock, so
+    a slow service does not hold up the others.
+
+    Args:
+        filepath (str): yaml file listing the services (name, description, url).
+    """
+
+    def __init__(self, filepath: str):
+        self.filepath = os.path.abspath(filepath)
+        self._lock = threading.RLock()
+        self._services = None
+        self._services_mtime = None
+        # service filepath -> (mtime, code object, module)
+        self._modules = {}
+        # service filepath -> lock held while the service loads
+        self._module_locks = {}
+
+    def services(self) -> OrderedDict:
+        """The services of the yaml file, by name."""
+        with self._lock:
+            mtime = os.path.getmtime(self.filepath)
+            if self._services is None or mtime != self._services_mtime:
+                available_activities_list = load_yaml(filepath=self.filepath) or []
+                self._services = OrderedDict(
+                    (item['name'], item) for item in available_activities_list)
+                self._services_mtime = mtime
+            return self._services
+
+    def _load(self, module_filepath: str):
+        """Code and module of the service, compiled and executed once; True if executed by this call."""
+        module_filepath = os.path.abspath(module_filepath)
+        with self._lock:
+            lock = self._module_locks.setdefault(module_filepath, threading.Lock())
+        # the services load in parallel, each once
+        with lock:
+            mtime = os.path.getmtime(module_filepath)
+            with self._lock:
+                cached = self._modules.get(module_filepath)
+            if cached is not None and cached[0] == mtime:
+                return cached[1], cached[2], False
+
+            with open(module_filepath, 'rb') as f:
+                code = compile(f.read(), module_filepath, 'exec')
+            name = f'services.{os.path.splitext(os.path.basename(module_filepath))[0]}'
+            module = types.ModuleType(name)
+            module.__file__ = module_filepath
+            # registered before its execution, as an import would
+            sys.modules[name] = module
+            try:
+                exec(code, module.__dict__)
+            except BaseException:
+                # a failed (or interrupted) load is retried on the next rerun
+                with self._lock:
+                    self._modules.pop(module_filepath, None)
+                raise
+            with self._lock:
+                self._modules[module_filepath] = (mtime, code, module)
+            return code, module, True
+
+    def load(self, module_filepath: str):
+        """Compiles the service in `module_filepath` and executes its module, once.
+
+        A service without `render()` is executed whole: `run` executes it again
+        on the next reruns.
+
+        Returns:
+            Tuple[types.CodeType, types.ModuleType]: code and module of the service.
+        """
+        code, module, _ = self._load(module_filepath)
+        return code, module
+
+    def run(self, module_filepath: str) -> None:
+        """Renders the service in `module_filepath` for this rerun."""
+        code, module, executed = self._load(module_filepath)
+        render = getattr(module, 'render', None)
+        if callable(render):
+            render()
+        elif not executed:
+            # the whole script is the render step
+            exec(code, {'__name__': module.__name__, '__file__': module.__file__})
+
 
 def get_available_activities(filepath: str, label: str = "services to perform", key: str = None):
     """Retrieves from a yaml file the services to show to the user as a sidebar menu"""
 
-    available_activities_list = load_yaml(filepath=os.path.abspath(filepath))
+    filepath = os.path.abspath(filepath)
+    with _registries_lock:
+        registry = _registries.setdefault(filepath, ServiceRegistry(filepath))
 
-    activities_dict = OrderedDict(
-        {item['name']: item for item in available_activities_list})
+    activities_dict = registry.services()
 
     tasks_names = []
     selected_task = None
 
-    if available_activities_list is not None:
+    if activities_dict:
 
         for _, task_dict in activities_dict.items():
             tasks_names.append(
@@ -24,7 +119,16 @@ def get_available_activities(filepath: str, label: str = "services to perform",
         selected_task, module_filepath = st.sidebar.selectbox(
             label,
             tasks_names, format_func=lambda x: str(x[0]), key=key)
-        # Super geek powers!
-        script_as_module(module_filepath)
+
+        if not os.path.exists(module_filepath):
+            log.error(f'service {selected_task}: {module_filepath} not found')
+            st.error(f'The service {selected_task} is not available.')
+        else:
+            registry.run(module_filepath)
 
     return selected_task, activities_dict
+
+
+# shared by every session of the app process
+_registries = {}
+_registries_lock = threading.Lock()
@@ -1,15 +1,56 @@
+import pandas as pd
 import streamlit as st
 
+from development_API import N_ROWS_PER_STATION
+from ingest import ingest_tsv, preview, read_header
+
 # Extract-Transform-Load (ETL)
 
-with st.beta_expander(label="Input files", expanded=True):
-   
-    uploaded_file =  st.file_uploader('', )
-
-    st.write("""
-    Only `tab` separated text files with `encoding='utf-8` are accepted.
-    
-    ***NOTE:*** *`max uploaded size = 200 MB`)*.""")
-    
-    if uploaded_file is not None:
-        st.write(uploaded_file )
+
+def render():
+    with st.beta_expander(label="Input files", expanded=True):
+
+        uploaded_file =  st.file_uploader('', )
+
+        st.write(f"""
+        Only `tab` separated text files with `encoding='utf-8` are accepted,
+        with blocks of {N_ROWS_PER_STATION} rows per station.
+
+        ***NOTE:*** *`max uploaded size = 200 MB`)*.""")
+
+    if uploaded_file is None:
+        return
+
+    try:
+        columns = read_header(uploaded_file)
+    except Exception as msg:
+        st.error(f'ERROR: Reading {uploaded_file.name}: {msg}')
+        return
+
+    station_column = st.selectbox(
+        'Station column', [None] + columns,
+        format_func=lambda column: '(none)' if column is None else column, key='etl_station_column')
+
+    # the upload is parsed in chunks of station blocks; a rerun with the same
+    # file and options reuses the Parquet file written the first time
+    progress_bar = st.progress(0.0)
+    status = st.empty()
+
+    def progress(fraction: float, message: str = ''):
+        progress_bar.progress(fraction)
+        status.text(message)
+
+    try:
+        report = ingest_tsv(uploaded_file, name=uploaded_file.name,
+                            station_column=station_column, progress=progress)
+    except ValueError as msg:
+        st.error(f'ERROR: Ingesting {uploaded_file.name}: {msg}')
+        return
+    progress(1.0, f"{report['rows_written']:,} of {report['rows']:,} rows written to {report['parquet_filepath']}")
+
+    if report['invalid_blocks']:
+        st.warning(f"{report['invalid_blocks']:,} of {report['blocks']:,} station blocks are invalid "
+                   f"and were left out.")
+        st.write(pd.DataFrame(report['errors']))
+
+    st.write(preview(report['parquet_filepath']))
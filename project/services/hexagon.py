@@ -1,21 +1,33 @@
 import os
+import time
 from pathlib import Path
-import json
-import geojson
 import numpy as np
 import pandas as pd
-from pandas.io.json import json_normalize
-import geopandas as gpd
-from shapely.geometry import Polygon
 import streamlit as st
-import streamlit.components.v1 as components
-import matplotlib.pyplot as plt
-from h3 import h3
-import folium
 
-from turpy.io.gdrive import download_file
-from config import DATA_URL_DICT
-from h3_funtools import visualize_hexagons, visualize_polygon, polygonize_hexagons
+from prefetch import fetch_dataset, verify_dataset
+from config import DATA_URL_DICT, H3_PYRAMID_RESOLUTIONS, ZONAL_RASTER_DIRPATH
+from geoio import read_geodataframe_chunks, file_fingerprint
+from dataset_cache import dataset_cache
+from h3_cache import h3_cache
+from reproject import reprojected_dataset
+from h3_pyramid import pyramid as h3_pyramid
+from h3_funtools import visualize_hexagons, visualize_polygon, polygonize_hexagons, h3_int_to_str
+from tiles import register_layer, hexagon_tiles_map
+from features import encode_h3_features
+from spatial_join import points_in_polygons
+from jobs import job_runner
+import h3_neighbors
+from lazy import lazy_import
+
+# loaded on first use: only some reruns draw maps or plots, and the first
+# paint handles no geometry. The stages (rasterio, fiona) are submitted by
+# name and only imported by the job workers
+folium = lazy_import('folium')
+components = lazy_import('streamlit.components.v1')
+plt = lazy_import('matplotlib.pyplot')
+gpd = lazy_import('geopandas')
+h3 = lazy_import('h3.api.basic_str')
 
 import warnings
 warnings.filterwarnings('ignore')
@@ -25,7 +37,17 @@ np.set_printoptions(suppress=True)
 pd.set_option('display.float_format', lambda x: '%.5f' % x)
 
 
-st.title('Hexagon grid')
+# statistics offered on the counts, see `h3_neighbors`
+NEIGHBORHOOD_STATISTICS = {
+    'none': None,
+    'k-ring mean': h3_neighbors.k_ring_mean,
+    'distance-decay smoothing': h3_neighbors.decay_smooth,
+    'hotspots (Getis-Ord Gi*)': h3_neighbors.getis_ord_g,
+    "clusters (local Moran's I)": h3_neighbors.local_morans_i,
+}
+
+# seconds between two polls of a background job
+JOB_POLL_INTERVAL_S = 2
 
 # Stockholm
 lat_centr_point = 59.6025
@@ -46,90 +68,93 @@ def latlong_to_geojson_string_h3_geometry(latitude_dd:float, longitude_dd:float,
     
     
 
-    list_hex_res = []
-    list_hex_res_geom = []
-
     h = h3.geo_to_h3(
         lat=latitude_dd,
         lng=longitude_dd,
         resolution = resolution
         )
 
-    list_hex_res.append(h)
-    # get the geometry of the hexagon and convert to geojson
-    h_geom = {"type": "Polygon",
-              "coordinates": [h3.h3_to_geo_boundary(h=h, geo_json=True)]
-              }
-    list_hex_res_geom.append(h_geom)
-
-    df_res_point = pd.DataFrame({"h3_resolution": resolution,
-                                 "hex_id": list_hex_res,
-                                 "geometry": list_hex_res_geom
-                                 })
-
-    list_features = []
-
-
-    for _, row in df_res_point.iterrows():
-        feature = geojson.feature.Feature(geometry=row["geometry"],
-                        id=row["hex_id"],
-            properties={"resolution": int(row["h3_resolution"])})
-        list_features.append(feature)
-
-    feat_collection = geojson.feature.FeatureCollection(list_features)
-    geojson_result = json.dumps(feat_collection)
+    # the hexagon geometry is written directly from the columns
+    geojson_result = encode_h3_features(
+        [h], properties={"resolution": [resolution]}, with_geometry=True).decode()
 
     return geojson_result
 
 
-@st.cache(allow_output_mutation=True)
-def geodataframe_from_local_filepath(local_filepath:Path)->gpd.GeoDataFrame:
+def geodataframe_from_local_filepath(local_filepath:Path)->'gpd.GeoDataFrame':
     """Returns a Geopandas GeoDataFrame
 
+    The file is parsed once per content version and shared between sessions
+    through `dataset_cache`. The returned frame is a shallow copy: columns can
+    be added or replaced, but its values are read-only.
+
     Args:
         local_filepath (Path): [description]
     """
     assert local_filepath.exists()
 
-    gdf = gpd.read_file(local_filepath)
+    gdf = dataset_cache.get(local_filepath, mode='view')
     return gdf
 
 
+def ensure_local_dataset(DATA_URL: str, dirpath: str, filename: str) -> bool:
+    """Downloads the dataset unless a verified local copy exists. Returns False if it failed."""
+    save_dest = Path(dirpath)
+    save_dest.mkdir(exist_ok=True)
+
+    # the local copy is only used once it matches its checksum in the manifest
+    if not verify_dataset(filename, dirpath=dirpath):
+        with st.spinner("Downloading data from google drive... this may take sometime! \n Please wait ..."):
+            try:
+                fetch_dataset(url=DATA_URL, name=filename, dirpath=dirpath)
+            except Exception as msg:
+                st.error(f'ERROR: Downloading {filename}: {msg}')
+                return False
+    return True
+
+
 def load_geopandas_dataset(
     DATA_URL: str, 
     dirpath: str = './data/',
-    filename: str = "NMD2018_boolean_klass_62_10m.gpkg"):
+    filename: str = "NMD2018_boolean_klass_62_10m.gpkg",
+    chunk_size: int = None,
+    bbox: tuple = None,
+    columns: list = None,
+    max_rows: int = None,
+    crs=None):
     """
 
     Note: assumes datapath like:
     DATA_URL = r"https://drive.google.com/file/d/<google_file_id>/view?usp=sharing"
-    """
-    file_id = DATA_URL.split('/')[-2]
-
-    save_dest = Path(dirpath)
-    save_dest.mkdir(exist_ok=True)
 
+    Args:
+        chunk_size (int, optional): if given, returns an iterator of GeoDataFrame
+            chunks of at most `chunk_size` rows instead of the whole dataset. Defaults to None.
+        bbox (tuple, optional): streaming only, (minx, miny, maxx, maxy) filter in the dataset CRS.
+        columns (list, optional): streaming only, attribute columns to read (`[]` for geometry only).
+        max_rows (int, optional): streaming only, maximum number of rows to read.
+        crs (optional): CRS to return the dataset in, reprojected once per file version
+            (see `reproject.reprojected_dataset`). Defaults to None (as stored).
+    """
     destination_filepath = os.path.join(dirpath, filename)
 
     gdf = None
 
-    if Path(destination_filepath).exists():
-        with st.spinner('Loading local data ... please wait'):
+    if not ensure_local_dataset(DATA_URL=DATA_URL, dirpath=dirpath, filename=filename):
+        return gdf
+
+    if chunk_size is not None:
+        return read_geodataframe_chunks(
+            destination_filepath, chunk_size=chunk_size, bbox=bbox,
+            columns=columns, max_rows=max_rows)
+
+    with st.spinner('Loading local data ... please wait'):
+        if crs is not None:
+            gdf = reprojected_dataset(destination_filepath, crs)
+        else:
             gdf = geodataframe_from_local_filepath(
                 local_filepath=Path(destination_filepath))
-    else:
-        with st.spinner("Downloading data from google drive... this may take sometime! \n Please wait ..."):
-            status, local_filepath = download_file(
-                data_url = DATA_URL,
-                destination_filepath=destination_filepath
-            )
-            if status:
-                gdf = geodataframe_from_local_filepath(
-                    local_filepath=local_filepath)
-            else:
-                st.error('ERROR: Downloading status : {status}: {local_filepath}')
-                
-    
+
     return gdf  # Note gdf is None by default 
 
         
@@ -168,6 +193,34 @@ def folium_static(fig, width=700, height=500):
     )
 
 
+def show_job_progress(job, title: str, retry=None):
+    """Shows the progress of a background job, without waiting for it (see `poll_jobs`).
+
+    A failed job is shown with a Retry button, which calls `retry()` to
+    submit it again (with `rerun_failed=True`).
+
+    Returns:
+        jobs.Job: the job shown, the resubmitted one after a retry.
+    """
+    if job.status == 'failed':
+        st.error(f'ERROR: {title}: {job.error}')
+        if retry is None or not st.button('Retry', key=f'retry_{job.key}'):
+            return job
+        job = retry()
+    if job.status != 'done':
+        st.info(f'{title} in the background ... {job.message}')
+        st.progress(job.progress)
+    return job
+
+
+def poll_jobs(jobs: list) -> None:
+    """Reruns the script shortly while one of `jobs` is running; called once the whole page is drawn."""
+    if any(not job.done for job in jobs):
+        # interacting with the page meanwhile is not blocked
+        time.sleep(JOB_POLL_INTERVAL_S)
+        st.experimental_rerun()
+
+
 def lat_lng_to_h3(row, h3_level:int):
     """
     """
@@ -177,50 +230,98 @@ def lat_lng_to_h3(row, h3_level:int):
 def main():
     """
     """
+    st.title('Hexagon grid')
     
     # APERTURE_SIZE = 7
 
     filename = DATA_URL_DICT[3]['name']
     DATA_URL = DATA_URL_DICT[3]['URL']
     
-    gdf = load_geopandas_dataset(
-        DATA_URL=DATA_URL, 
-        dirpath='./data/', 
-        filename=filename)
-
-    if gdf is not None:
-        #
-        assert gdf.crs is not None
-        assert gdf.crs != ""
-
-        st.write(f"gdf.crs: {gdf.crs}")
-        gdf = gdf.to_crs(epsg='4326').copy()
-        #
-        h3_level = 8.5
-        gdf[f'H3_{h3_level}'] = gdf.apply(
-            lambda row: h3.geo_to_h3(
-                row.geometry.y, row.geometry.x, h3_level), axis=1)
+    # the points are indexed once at the finest resolution and every
+    # coarser level is precomputed, so moving the slider only reads a level
+    coarsest_level, finest_level = H3_PYRAMID_RESOLUTIONS
+    # H3 resolutions are integers (a fractional level is rejected by h3)
+    h3_level = st.sidebar.slider(
+        'H3 resolution', min_value=coarsest_level, max_value=finest_level,
+        value=min(max(8, coarsest_level), finest_level), key='hexagon_resolution')
+
+    dataset_filepath = os.path.join('./data/', filename)
+    counts = None
+    # background jobs shown on this rerun, polled at the end of it
+    jobs = []
+    if Path(dataset_filepath).exists():
+        counts = h3_pyramid.read(file_fingerprint(dataset_filepath), h3_level)
+
+    stream_dataset = st.sidebar.checkbox(
+        'Stream the dataset in chunks', value=True, key='hexagon_stream')
+
+    if counts is None and ensure_local_dataset(DATA_URL=DATA_URL, dirpath='./data/', filename=filename):
+        # reprojection and H3 indexing run in the background: reruns (and other
+        # sessions) poll the same job instead of restarting it
+        index_params = dict(
+            dataset_filepath=dataset_filepath,
+            finest_level=finest_level,
+            coarsest_level=coarsest_level,
+            stream=stream_dataset,
+            fingerprint=file_fingerprint(dataset_filepath))
+        job = show_job_progress(
+            job_runner.submit('stages.index_dataset_h3', **index_params), 'Counting points per hexagon',
+            retry=lambda: job_runner.submit('stages.index_dataset_h3', rerun_failed=True, **index_params))
+        jobs.append(job)
+        if job.status == 'done':
+            counts = h3_pyramid.read(job.result(), h3_level)
+
+    if counts is not None:
+        # the map fetches the hexagons in view from the tile server instead
+        # of embedding every cell in the page
+        tile_url = register_layer(f'gridcounts_H3_{h3_level}', counts[['count']], h3_level)
+        tiles_map = hexagon_tiles_map(
+            tile_url, f'gridcounts_H3_{h3_level}', counts['count'],
+            center_location=[lat_centr_point, lon_centr_point])
+        folium_static(tiles_map)
+
+        st.write(counts[['count']].reset_index().assign(**{
+            f'H3_{h3_level}': lambda frame: h3_int_to_str(frame[f'H3_{h3_level}'])}).head(20))
+
+        # neighborhood statistics of the counts, over the cells with points (and, for the
+        # hotspots and clusters, the empty cells around them)
+        statistic = st.sidebar.selectbox(
+            'Neighborhood statistic', list(NEIGHBORHOOD_STATISTICS), key='hexagon_neighborhood')
+        if NEIGHBORHOOD_STATISTICS[statistic] is not None:
+            k = st.sidebar.slider('Rings', min_value=1, max_value=5, value=1, key='hexagon_rings')
+            with st.spinner(f'{statistic} ... please wait'):
+                result = NEIGHBORHOOD_STATISTICS[statistic](counts['count'], k=k)
+            if isinstance(result, pd.DataFrame):
+                significant = (result['p'] < 0.05) & (result['z'] > 0)
+                if 'quadrant' in result:
+                    st.write(f"{(significant & (result['quadrant'] == 'HH')).sum():,} of {len(result):,} "
+                             f"cells are in significant high-high clusters (p < 0.05).")
+                else:
+                    st.write(f'{significant.sum():,} of {len(result):,} cells are significant hotspots (p < 0.05).')
+                result = result.sort_values('z', ascending=False)
+            st.write(result.reset_index().assign(**{
+                f'H3_{h3_level}': lambda frame: h3_int_to_str(frame[f'H3_{h3_level}'])}).head(20))
+
+        # raster statistics per cell, written with the counts
+        raster_filepaths = sorted(str(filepath) for filepath in Path(ZONAL_RASTER_DIRPATH).glob('*.tif*'))
+        selected_rasters = st.sidebar.multiselect(
+            'Zonal statistics of rasters', raster_filepaths,
+            format_func=os.path.basename, key='hexagon_rasters')
 
         # st.write(gdf.plot())
         # lat, lng, hex resolution
-        h3_address = h3.geo_to_h3(58.426172, 17.3623063, h3_level)
-        hex_center_coordinates = h3.h3_to_geo(h3_address)
-        hex_boundary = h3.h3_to_geo_boundary(h3_address)
-        m = visualize_hexagons([h3_address])
-        tooltip = "Hexagon center"
-        folium.Marker(
-            hex_center_coordinates, popup="Hexagon center", tooltip=tooltip
-        ).add_to(m)
+        # h3_address = h3.geo_to_h3(58.426172, 17.3623063, h3_level)
+        # hex_center_coordinates = h3.h3_to_geo(h3_address)
+        # hex_boundary = h3.h3_to_geo_boundary(h3_address)
+        # m = visualize_hexagons([h3_address])
+        # tooltip = "Hexagon center"
+        # folium.Marker(
+        #     hex_center_coordinates, popup="Hexagon center", tooltip=tooltip
+        # ).add_to(m)
 
         # hexagons = polygonize_hexagons(gdf=gdf, APERTURE_SIZE=8, crs='EPSG:3006')
 
         #st.write(hexagons)
-        
-        # st.write(gdf[f'H3_{h3_level}'].head(20))
-
-        # find all points that fall in the grid polygon
-        counts = gdf.groupby([f'H3_{h3_level}'])[f'H3_{h3_level}'].agg(
-            'count').to_frame('count').reset_index()
 
         # https://spatialthoughts.com/2020/07/01/point-in-polygon-h3-geopandas/
         # To visualize the results or export it to a GIS, we need to convert the H3 cell ids to a geometry.
@@ -228,25 +329,55 @@ def main():
         # Since GeoPandas uses shapely library for constructing geometries, we convert the list of coordinates 
         # to a shapely Polygon object. Note the optional second argument to the h3_to_geo_boundary function which 
         # we have set to True which returns the coordinates in the(x, y) order compared to default(lat, lon)
-
-        def add_geometry(row):
-            points = h3.h3_to_geo_boundary(
-                row[f'H3_{h3_level}'], True)
-            return Polygon(points)
-
-        st.write(counts.head(20))
-        counts['geometry'] = counts.apply(add_geometry, axis=1)
-
-        counts_gdf = gpd.GeoDataFrame(counts, crs='EPSG:4326')
+        # (see `stages.write_gridcounts`)
 
         # We turn the dataframe to a GeoDataframe with the CRS EPSG:4326
-        # (WGS84 Latitude/Longitude) and write it to a geopackage.
+        # (WGS84 Latitude/Longitude) and write it to a geopackage, in the background.
+        # A raster replaced on disk makes a new job (its fingerprint is in the key).
         output_filename = f'./data/gridcounts_H3_{h3_level}.gpkg'
-        counts_gdf.to_file(driver='GPKG', filename=output_filename)
+        gridcounts_params = dict(
+            versions={'rasters': [file_fingerprint(filepath) for filepath in selected_rasters]},
+            fingerprint=file_fingerprint(dataset_filepath),
+            h3_level=h3_level,
+            output_filepath=output_filename,
+            raster_filepaths=selected_rasters)
+        job = show_job_progress(
+            job_runner.submit('stages.write_gridcounts', **gridcounts_params), f'Writing {output_filename}',
+            retry=lambda: job_runner.submit('stages.write_gridcounts', rerun_failed=True, **gridcounts_params))
+        jobs.append(job)
+        if job.status == 'done' and selected_rasters:
+            st.write(job.result().head(20))
 
         #hexs = h3.polyfill(
         #    gdf.geometry[0].__geo_interface__, APERTURE_SIZE, geo_json_conformant=True)
 
+    # exact point-in-polygon counts on the 500 m grid, instead of H3 binning
+    if st.sidebar.checkbox('Count points per 500 m grid polygon (exact join)',
+                           value=False, key='hexagon_exact_join'):
+        grid = load_geopandas_dataset(
+            DATA_URL=DATA_URL_DICT[2]['URL'],
+            dirpath='./data/',
+            filename=DATA_URL_DICT[2]['name'])
+        # the points are reprojected to the grid CRS once, not on every rerun
+        points = None if grid is None else load_geopandas_dataset(
+            DATA_URL=DATA_URL,
+            dirpath='./data/',
+            filename=filename,
+            crs=grid.crs)
+
+        if grid is not None and points is not None:
+            with st.spinner('Joining the points to the grid ... please wait'):
+                joined = points_in_polygons(points[[points.geometry.name]], grid)
+            grid_counts = joined.groupby('index_right').size().rename('count')
+            st.write(grid.drop(columns=grid.geometry.name).join(grid_counts, how='inner').head(20))
+
+    # hit rates of the caches shared by the sessions of this app process
+    with st.sidebar.beta_expander('Cache statistics', expanded=False):
+        st.write({'h3_cache': h3_cache.stats(), 'dataset_cache': dataset_cache.stats()})
+
+    # the page is drawn whole before waiting for the background jobs
+    poll_jobs(jobs)
+
     """
   
     fig, ax = plt.subplots(figsize=(2, 4))
@@ -330,5 +461,6 @@ def main():
     
     """
 
-#
-main()
+def render():
+    """Draws the service on every rerun; the rest of the module is loaded once (see `services.ServiceRegistry`)."""
+    main()
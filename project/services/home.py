@@ -1,3 +1,5 @@
 import streamlit as st
 
-st.write("# Home")
+
+def render():
+    st.write("# Home")
@@ -0,0 +1,247 @@
+"""Exact point-in-polygon join, prefiltered with H3 cells and backed by a spatial index.
+
+Every polygon is covered with H3 cells twice (see `polyfill.polyfill_membership`):
+
+- the cells whose center lies in the polygon grown by twice the edge length
+  of a cell: they contain every point of the polygon (candidate cells);
+- the cells whose center lies in the polygon shrunk by twice the edge
+  length: they lie entirely inside the polygon (interior cells).
+
+Each point is indexed with `points_to_h3`. A point whose cell is not a
+candidate of any polygon matches nothing. A point whose cell is an interior
+cell of all its candidate polygons matches them without any geometry test.
+Only the remaining points, near the polygon boundaries, are tested against
+the polygons with the exact predicate, in vectorized bulk queries of an
+STRtree (shapely >= 2) or of an rtree index. The points are processed in
+chunks, in a thread pool (shapely 2 releases the GIL).
+
+The prefilter pays off for polygons with many vertices (e.g. the NMD
+layers); simple polygons such as the 500 m hexagon grid are only tested
+through the spatial index (see `prefilter_resolution`).
+
+The predicate is `intersects`, as the default of `gpd.sjoin`: points on
+the boundary of a polygon match it.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+from config import GEO_CHUNK_SIZE
+from h3_funtools import H3_EDGE_LENGTH_M, missing_geometries, points_to_h3
+from lazy import lazy_import
+from polyfill import polyfill_membership
+from reproject import to_crs
+
+gpd = lazy_import('geopandas')
+shapely = lazy_import('shapely')
+
+# below this average number of vertices, the polygons are tested directly
+PREFILTER_MIN_VERTICES = 32
+
+try:
+    from rtree import index as rtree_index
+except ImportError:
+    rtree_index = None
+
+
+class SpatialIndex:
+    """Bulk `intersects` queries of points against polygons, with an STRtree or an rtree."""
+
+    def __init__(self, geometries: np.ndarray):
+        self.geometries = np.asarray(geometries, dtype=object)
+        if hasattr(shapely, 'STRtree') and hasattr(shapely, 'prepare'):
+            # shapely >= 2
+            self._tree = shapely.STRtree(self.geometries)
+            self._rtree = None
+        elif rtree_index is not None:
+            from shapely.prepared import prep
+            self._tree = None
+            self._rtree = rtree_index.Index(
+                (i, geom.bounds, None) for i, geom in enumerate(self.geometries)
+                if geom is not None and not geom.is_empty)
+            self._prepared = [prep(geom) if geom is not None else None for geom in self.geometries]
+        else:
+            raise ImportError('spatial_join needs shapely >= 2 or rtree')
+
+    def query(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Returns the (point position, polygon position) pairs where the point intersects the polygon."""
+        if self._tree is not None:
+            point_positions, polygon_positions = self._tree.query(points, predicate='intersects')
+            return point_positions, polygon_positions
+
+        point_positions, polygon_positions = [], []
+        for i, point in enumerate(points):
+            for j in self._rtree.intersection(point.bounds):
+                if self._prepared[j].intersects(point):
+                    point_positions.append(i)
+                    polygon_positions.append(j)
+        return np.asarray(point_positions, dtype=np.int64), np.asarray(polygon_positions, dtype=np.int64)
+
+
+def _geometry_num_coordinates(geometry) -> int:
+    if geometry is None or geometry.is_empty:
+        return 0
+    if hasattr(geometry, 'geoms'):
+        return sum(_geometry_num_coordinates(part) for part in geometry.geoms)
+    if hasattr(geometry, 'exterior'):
+        return len(geometry.exterior.coords) + sum(len(ring.coords) for ring in geometry.interiors)
+    return len(geometry.coords)
+
+
+def _num_coordinates(geometries) -> np.ndarray:
+    """Number of vertices of each geometry."""
+    geometries = np.asarray(geometries, dtype=object)
+    if hasattr(shapely, 'get_num_coordinates'):
+        # shapely >= 2
+        return shapely.get_num_coordinates(geometries)
+    return np.fromiter((_geometry_num_coordinates(geometry) for geometry in geometries),
+                       dtype=np.int64, count=len(geometries))
+
+
+def prefilter_resolution(polygons: 'gpd.GeoDataFrame') -> int:
+    """The H3 resolution of the prefilter of `polygons`, -1 when it would not pay off.
+
+    Testing a point against a polygon costs in proportion to its vertices:
+    the prefilter is used when the polygons have on average more than
+    PREFILTER_MIN_VERTICES vertices, with cells at least 64 times smaller
+    than the typical polygon.
+    """
+    if len(polygons) == 0 or _num_coordinates(polygons.geometry.values).mean() < PREFILTER_MIN_VERTICES:
+        return -1
+    metric = polygons if polygons.crs.is_projected else polygons.to_crs(polygons.estimate_utm_crs())
+    size = np.sqrt(np.median(metric.geometry.area))
+    for resolution, edge_length in enumerate(H3_EDGE_LENGTH_M):
+        if edge_length * 64 <= size:
+            return resolution
+    return len(H3_EDGE_LENGTH_M) - 1
+
+
+def _cell_coverage(polygons: 'gpd.GeoDataFrame', resolution: int) -> pd.DataFrame:
+    """Candidate and interior cells of every polygon, as (cell, position, interior) rows."""
+    metric = polygons if polygons.crs.is_projected else polygons.to_crs(polygons.estimate_utm_crs())
+    margin = 2 * H3_EDGE_LENGTH_M[resolution]
+    positions = pd.RangeIndex(len(polygons))
+    column = f'H3_{resolution}'
+
+    # the polygons are simplified within `tolerance` and offset by `tolerance` more, which
+    # keeps the covers conservative; mitred offsets contain the exact offset when growing
+    # and are contained in it when shrinking, with few vertices
+    tolerance = margin / 2
+    simplified = metric.geometry.simplify(tolerance)
+
+    def coverage(distance: float) -> pd.DataFrame:
+        distance += np.sign(distance) * tolerance
+        grown = gpd.GeoDataFrame(geometry=simplified.buffer(distance, join_style=2).values,
+                                 index=positions, crs=metric.crs)
+        # filled in this process: the join runs on the interactive path
+        membership = polyfill_membership(grown[~grown.is_empty], resolution)
+        return membership.rename(columns={column: 'cell', 'feature': 'position'})
+
+    candidates = coverage(margin)
+    interior = coverage(-margin).assign(interior=True)
+    coverage = candidates.merge(interior, on=['cell', 'position'], how='left')
+    # cells missing from the interior cover are NaN
+    coverage['interior'] = coverage['interior'].eq(True)
+    return coverage
+
+
+class PointInPolygonJoin:
+    """Joins points to the polygons they fall in, reusing the index and coverage of the polygons.
+
+    Args:
+        polygons (gpd.GeoDataFrame): polygons to join to, with a CRS.
+        resolution (int, optional): H3 resolution of the prefilter, -1 to disable it. Defaults to
+            None (see `prefilter_resolution`).
+        n_workers (int, optional): threads joining the chunks of points. Defaults to None
+            (ThreadPoolExecutor default).
+    """
+
+    def __init__(self, polygons: 'gpd.GeoDataFrame', resolution: int = None, n_workers: int = None):
+        if polygons.crs is None:
+            raise ValueError('the polygons must have a CRS')
+        self.polygons = polygons
+        self.n_workers = n_workers
+        self.index = SpatialIndex(polygons.geometry.values)
+        self.resolution = prefilter_resolution(polygons) if resolution is None else resolution
+        self._resolved = None
+        self._candidate_cells = None
+        if self.resolution >= 0:
+            coverage = _cell_coverage(polygons, self.resolution)
+            # cells whose points match exactly their candidate polygons (all interior)
+            all_interior = coverage.groupby('cell')['interior'].all()
+            resolved_cells = all_interior.index[all_interior.to_numpy()]
+            self._resolved = coverage[coverage['cell'].isin(resolved_cells)][['cell', 'position']]
+            self._candidate_cells = np.unique(coverage['cell'].to_numpy())
+            self._resolved_cells = np.unique(resolved_cells.to_numpy(dtype=np.uint64))
+
+    def _join_chunk(self, points: 'gpd.GeoSeries') -> Tuple[np.ndarray, np.ndarray]:
+        """(point position in the chunk, polygon position) pairs of a chunk of points."""
+        geometries = to_crs(points, self.polygons.crs).values
+        geometries = np.asarray(geometries, dtype=object)
+        if self._resolved is None:
+            return self.index.query(geometries)
+
+        # points without a geometry keep cell 0, which is no candidate: they match nothing
+        located = ~missing_geometries(points)
+        cells = np.zeros(len(points), dtype=np.uint64)
+        cells[located] = points_to_h3(points[located], self.resolution).to_numpy()
+        candidate = np.isin(cells, self._candidate_cells)
+        resolved = candidate & np.isin(cells, self._resolved_cells)
+
+        # points in cells lying inside all their polygons: no geometry test
+        resolved_positions = np.flatnonzero(resolved)
+        pairs = pd.DataFrame({'point': resolved_positions, 'cell': cells[resolved_positions]}).merge(
+            self._resolved, on='cell')
+        # points near a boundary: exact test
+        boundary_positions = np.flatnonzero(candidate & ~resolved)
+        point_positions, polygon_positions = self.index.query(geometries[boundary_positions])
+
+        return (np.concatenate([pairs['point'].to_numpy(dtype=np.int64),
+                                boundary_positions[point_positions]]),
+                np.concatenate([pairs['position'].to_numpy(dtype=np.int64),
+                                np.asarray(polygon_positions, dtype=np.int64)]))
+
+    def pairs(self, points: 'gpd.GeoDataFrame', chunk_size: int = GEO_CHUNK_SIZE) -> pd.DataFrame:
+        """Returns the (point position, polygon position) pairs, sorted by point then polygon."""
+        geoseries = points.geometry if isinstance(points, gpd.GeoDataFrame) else points
+        if geoseries.crs is None:
+            raise ValueError('the points must have a CRS')
+        starts = range(0, len(geoseries), chunk_size)
+        with ThreadPoolExecutor(max_workers=self.n_workers) as pool:
+            results = list(pool.map(lambda start: self._join_chunk(geoseries.iloc[start:start + chunk_size]),
+                                    starts))
+        point_parts = [point + start for start, (point, _) in zip(starts, results)]
+        polygon_parts = [polygon for _, polygon in results]
+        if not point_parts:
+            return pd.DataFrame({'point': np.empty(0, dtype=np.int64),
+                                 'polygon': np.empty(0, dtype=np.int64)})
+        point, polygon = np.concatenate(point_parts), np.concatenate(polygon_parts)
+        order = np.lexsort((polygon, point))
+        return pd.DataFrame({'point': point[order], 'polygon': polygon[order]})
+
+    def join(self, points: 'gpd.GeoDataFrame', chunk_size: int = GEO_CHUNK_SIZE) -> 'gpd.GeoDataFrame':
+        """Inner join of `points` with the attributes of the polygons they fall in.
+
+        Same layout as `gpd.sjoin(points, polygons, how='inner', predicate='intersects')`:
+        the index of the points, their columns, `index_right` and the polygon columns.
+        """
+        pairs = self.pairs(points, chunk_size=chunk_size)
+        left = points.iloc[pairs['point'].to_numpy()]
+        right = self.polygons.drop(columns=self.polygons.geometry.name).iloc[pairs['polygon'].to_numpy()]
+        right = right.reset_index().rename(columns={right.index.name or 'index': 'index_right'})
+        right.index = left.index
+        overlap = left.columns.intersection(right.columns)
+        left = left.rename(columns={column: f'{column}_left' for column in overlap})
+        right = right.rename(columns={column: f'{column}_right' for column in overlap})
+        return gpd.GeoDataFrame(pd.concat([left, right], axis=1),
+                                geometry=points.geometry.name, crs=points.crs)
+
+
+def points_in_polygons(points: 'gpd.GeoDataFrame', polygons: 'gpd.GeoDataFrame',
+                       resolution: int = None, chunk_size: int = GEO_CHUNK_SIZE,
+                       n_workers: int = None) -> 'gpd.GeoDataFrame':
+    """Exact point-in-polygon join, an alternative to `gpd.sjoin` for many points (see `PointInPolygonJoin`)."""
+    return PointInPolygonJoin(polygons, resolution=resolution, n_workers=n_workers).join(
+        points, chunk_size=chunk_size)
@@ -0,0 +1,117 @@
+"""Long-running stages of the services, as importable functions.
+
+The services are executed as scripts on every rerun, so their functions
+cannot be sent to another process. The heavy stages live here instead and
+are run in the background by `jobs.job_runner`. Each stage takes a
+`progress(fraction, message)` callback and returns a small, picklable result.
+"""
+from typing import Callable, Iterable
+
+import geopandas as gpd
+
+from turpy.logger import log
+from config import GEO_CHUNK_SIZE
+from geoio import count_features, file_fingerprint, read_geodataframe_chunks
+from dataset_cache import dataset_cache
+from h3_store import TableAccumulator
+from h3_pyramid import pyramid as h3_pyramid
+from h3_funtools import cells_to_polygons, h3_int_to_str, points_to_h3
+from zonal import zonal_statistics
+
+
+def _no_progress(fraction: float, message: str = '') -> None:
+    pass
+
+
+def index_dataset_h3(
+        dataset_filepath: str,
+        finest_level: int,
+        coarsest_level: int,
+        stream: bool = True,
+        chunk_size: int = GEO_CHUNK_SIZE,
+        fingerprint: str = None,
+        progress: Callable[[float, str], None] = _no_progress) -> str:
+    """Counts the points of a dataset per H3 cell and builds the pyramid of `h3_pyramid`.
+
+    The points are reprojected to EPSG:4326 and indexed at `finest_level`; the
+    coarser levels down to `coarsest_level` are rolled up from it.
+
+    Args:
+        dataset_filepath (str): point dataset.
+        finest_level (int): finest H3 resolution.
+        coarsest_level (int): coarsest H3 resolution.
+        stream (bool, optional): read the dataset in chunks of `chunk_size` rows instead
+            of loading it whole. Defaults to True.
+        chunk_size (int, optional): rows per chunk. Defaults to GEO_CHUNK_SIZE.
+        fingerprint (str, optional): fingerprint of the dataset, if already known. Passing it
+            makes a new job of a changed file.
+        progress (Callable[[float, str], None], optional): progress callback.
+
+    Returns:
+        str: fingerprint of the dataset, the key of its pyramid levels.
+    """
+    fingerprint = fingerprint or file_fingerprint(dataset_filepath)
+    # counted privately, then published whole: concurrent runs of the same
+    # dataset do not add to each other's counts
+    accumulator = TableAccumulator()
+
+    if stream:
+        n_rows = max(count_features(dataset_filepath), 1)
+        done = 0
+        # only the geometry is read, one chunk at a time
+        for chunk in read_geodataframe_chunks(dataset_filepath, chunk_size=chunk_size, columns=[]):
+            accumulator.add(points_to_h3(chunk, resolution=finest_level).to_numpy())
+            done += len(chunk)
+            progress(0.9 * done / n_rows, f'{done:,} of {n_rows:,} points indexed')
+    else:
+        progress(0.0, 'loading the dataset')
+        gdf = dataset_cache.get(dataset_filepath, mode='view')
+        # only the coordinates are reprojected, while indexing
+        progress(0.5, f'indexing {len(gdf):,} points')
+        # find all points that fall in the grid polygon
+        accumulator.add(points_to_h3(gdf, resolution=finest_level).to_numpy())
+
+    progress(0.9, 'building the coarser levels')
+    # the pyramid is the only copy kept: its finest level is the table itself
+    h3_pyramid.build_from_table(
+        fingerprint, accumulator.table(), finest_level, coarsest_level, source=dataset_filepath)
+    log.info(f'index_dataset_h3: {dataset_filepath} indexed at H3 {coarsest_level}-{finest_level}')
+    return fingerprint
+
+
+def write_gridcounts(
+        fingerprint: str,
+        h3_level: int,
+        output_filepath: str,
+        raster_filepaths: Iterable[str] = (),
+        progress: Callable[[float, str], None] = _no_progress):
+    """Writes the counts per H3 cell of a dataset, with the zonal statistics of rasters, to a GeoPackage.
+
+    Args:
+        fingerprint (str): dataset fingerprint, as returned by `index_dataset_h3`.
+        h3_level (int): H3 resolution written.
+        output_filepath (str): GeoPackage written.
+        raster_filepaths (Iterable[str], optional): rasters whose statistics are joined.
+        progress (Callable[[float, str], None], optional): progress callback.
+
+    Returns:
+        pd.DataFrame: the table written, without the geometry.
+    """
+    counts = h3_pyramid.read(fingerprint, h3_level)
+    if counts is None:
+        raise ValueError(f'H3 level {h3_level} of {fingerprint} was not built')
+    counts = counts[['count']]
+
+    raster_filepaths = list(raster_filepaths)
+    for i, raster_filepath in enumerate(raster_filepaths):
+        progress(0.8 * i / len(raster_filepaths), f'zonal statistics of {raster_filepath}')
+        counts = counts.join(zonal_statistics(raster_filepath, counts.index.to_numpy()))
+    counts = counts.reset_index()
+
+    progress(0.8, f'writing {output_filepath}')
+    column = f'H3_{h3_level}'
+    counts_gdf = gpd.GeoDataFrame(
+        counts.assign(**{column: h3_int_to_str(counts[column])}),
+        geometry=cells_to_polygons(counts[column]), crs='EPSG:4326')
+    counts_gdf.to_file(driver='GPKG', filename=output_filepath)
+    return counts.assign(**{column: h3_int_to_str(counts[column])})
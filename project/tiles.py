@@ -0,0 +1,286 @@
+"""Mapbox vector tiles (MVT) of H3 hexagon layers, served by `local_server`.
+
+A layer is registered once from a per-cell table; the browser then requests
+`/tiles/<layer>/<version>/<z>/<x>/<y>.pbf` for the tiles in its viewport
+only. Each tile is cut on demand from precomputed cell bounds, at an H3
+resolution suited to the zoom, and kept in an LRU cache.
+
+Layers are identified by their name and a hash of their content, so the
+sessions showing different tables under the same name do not replace each
+other's layer; the least recently used layers past `TILE_LAYERS_MAX` are
+dropped.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, List
+
+import numpy as np
+import pandas as pd
+from branca.element import JavascriptLink, MacroElement
+from jinja2 import Template
+
+from h3_funtools import (_cell_boundary, check_h3_resolution, h3_boundaries_array,
+                         h3_to_parent_array, resolution_for_zoom)
+from local_server import ensure_server, register_route
+from lazy import lazy_import
+
+folium = lazy_import('folium')
+mapbox_vector_tile = lazy_import('mapbox_vector_tile')
+shapely = lazy_import('shapely')
+
+TILE_EXTENT = 4096
+# fraction of the tile added around it so that hexagons on its edges are complete
+TILE_BUFFER = 1 / 16
+# encoded tiles kept in memory, in bytes (a dense tile is a few hundred KiB)
+TILE_CACHE_MAX_BYTES = 64 * 1024 ** 2
+# layers (name and content) kept for all the sessions
+TILE_LAYERS_MAX = 32
+# cells above this count in one tile are rolled up to a coarser resolution
+MAX_TILE_FEATURES = 20_000
+VECTORGRID_JS_URL = 'https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.js'
+# default aggregation of the columns when cells are rolled up
+DEFAULT_AGGREGATIONS = {'count': 'sum', 'sum': 'sum', 'min': 'min', 'max': 'max'}
+
+
+class _Level:
+    """Cells of a layer at one resolution, with their rings and bounds."""
+
+    def __init__(self, frame: pd.DataFrame):
+        self.cells = frame.index.to_numpy(dtype=np.uint64)
+        self.properties = frame.reset_index(drop=True)
+        self.rings, self.irregular = h3_boundaries_array(self.cells)
+        lng, lat = self.rings[..., 0], self.rings[..., 1]
+        with np.errstate(invalid='ignore'):
+            self.minx, self.maxx = np.nanmin(lng, axis=1), np.nanmax(lng, axis=1)
+            self.miny, self.maxy = np.nanmin(lat, axis=1), np.nanmax(lat, axis=1)
+        for i in np.flatnonzero(self.irregular):
+            boundary = _cell_boundary(int(self.cells[i]))
+            self.minx[i], self.miny[i] = boundary.min(axis=0)
+            self.maxx[i], self.maxy[i] = boundary.max(axis=0)
+
+    def ring(self, i: int) -> np.ndarray:
+        return _cell_boundary(int(self.cells[i])) if self.irregular[i] else self.rings[i]
+
+
+class HexagonLayer:
+    """A per-cell table served as vector tiles, rolled up to coarser resolutions on demand."""
+
+    def __init__(self, frame: pd.DataFrame, resolution: int, aggregations: Dict[str, str]):
+        self.frame = frame
+        self.resolution = check_h3_resolution(resolution)
+        self.aggregations = {column: aggregations.get(column, 'sum') for column in frame.columns}
+        digest = hashlib.sha256(pd.util.hash_pandas_object(frame, index=True).to_numpy().tobytes())
+        digest.update(repr((list(map(str, frame.columns)), self.resolution,
+                            sorted(self.aggregations.items()))).encode())
+        self.version = digest.hexdigest()[:16]
+        self._levels = {}
+        self._lock = threading.Lock()
+
+    def level(self, resolution: int) -> _Level:
+        with self._lock:
+            if resolution not in self._levels:
+                frame = self.frame
+                if resolution < self.resolution:
+                    parents = h3_to_parent_array(frame.index.to_numpy(dtype=np.uint64), resolution)
+                    frame = frame.groupby(parents).agg(self.aggregations)
+                self._levels[resolution] = _Level(frame)
+            return self._levels[resolution]
+
+
+# (name, version) -> HexagonLayer, least recently used first
+_layers = OrderedDict()
+_layers_lock = threading.Lock()
+_tiles = OrderedDict()
+_tiles_nbytes = 0
+_tiles_lock = threading.Lock()
+
+
+def _get_layer(name: str, version: str) -> HexagonLayer:
+    with _layers_lock:
+        layer = _layers.get((name, version))
+        if layer is not None:
+            _layers.move_to_end((name, version))
+        return layer
+
+
+def _tile_bounds(z: int, x: int, y: int):
+    """(west, south, east, north) of a web mercator tile in degrees."""
+    n = 2 ** z
+    west, east = x / n * 360.0 - 180.0, (x + 1) / n * 360.0 - 180.0
+    north = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+    south = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n))))
+    return west, south, east, north
+
+
+def _to_tile_pixels(lnglat: np.ndarray, z: int, x: int, y: int) -> np.ndarray:
+    n = 2 ** z
+    lat = np.radians(np.clip(lnglat[..., 1], -85.0511, 85.0511))
+    px = ((lnglat[..., 0] + 180.0) / 360.0 * n - x) * TILE_EXTENT
+    py = ((1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * n - y) * TILE_EXTENT
+    return np.stack([px, py], axis=-1)
+
+
+def _encode(layers: List[dict]) -> bytes:
+    try:
+        # mapbox-vector-tile >= 2
+        return mapbox_vector_tile.encode(
+            layers, default_options={'y_coord_down': True, 'extents': TILE_EXTENT})
+    except TypeError:
+        return mapbox_vector_tile.encode(layers, y_coord_down=True, extents=TILE_EXTENT)
+
+
+def render_tile(name: str, version: str, z: int, x: int, y: int) -> bytes:
+    """Encodes the cells of layer `name` (`version`) intersecting tile z/x/y as an MVT."""
+    layer = _get_layer(name, version)
+    if layer is None:
+        raise KeyError(f'no tile layer {name}/{version}')
+    west, south, east, north = _tile_bounds(z, x, y)
+    buffer_x, buffer_y = (east - west) * TILE_BUFFER, (north - south) * TILE_BUFFER
+    resolution = min(layer.resolution,
+                     resolution_for_zoom(z, latitude=(south + north) / 2))
+
+    while True:
+        level = layer.level(resolution)
+        selected = np.flatnonzero((level.maxx >= west - buffer_x) & (level.minx <= east + buffer_x)
+                                  & (level.maxy >= south - buffer_y) & (level.miny <= north + buffer_y))
+        if len(selected) <= MAX_TILE_FEATURES or resolution == 0:
+            break
+        resolution -= 1
+
+    properties = level.properties.iloc[selected].to_dict(orient='records')
+    features = []
+    for i, props in zip(selected.tolist(), properties):
+        pixels = _to_tile_pixels(level.ring(i), z, x, y)
+        props = {key: (value.item() if hasattr(value, 'item') else value)
+                 for key, value in props.items()}
+        props['h3'] = format(int(level.cells[i]), 'x')
+        features.append({'geometry': shapely.geometry.Polygon(pixels), 'properties': props})
+    return _encode([{'name': name, 'features': features}])
+
+
+def get_tile(name: str, version: str, z: int, x: int, y: int) -> bytes:
+    """Returns tile z/x/y of layer `name` from the LRU cache, rendering it if needed."""
+    global _tiles_nbytes
+    key = (name, version, z, x, y)
+    with _tiles_lock:
+        if key in _tiles:
+            _tiles.move_to_end(key)
+            return _tiles[key]
+    tile = render_tile(name, version, z, x, y)
+    with _tiles_lock:
+        previous = _tiles.pop(key, None)
+        if previous is not None:
+            _tiles_nbytes -= len(previous)
+        _tiles[key] = tile
+        _tiles_nbytes += len(tile)
+        while _tiles_nbytes > TILE_CACHE_MAX_BYTES and len(_tiles) > 1:
+            _, evicted = _tiles.popitem(last=False)
+            _tiles_nbytes -= len(evicted)
+    return tile
+
+
+def _handle_tile_request(path: str, query: dict):
+    try:
+        name, version, z, x, y = path.split('/')
+        z, x, y = int(z), int(x), int(y.split('.')[0])
+    except ValueError:
+        return 400, {}, b''
+    if _get_layer(name, version) is None or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return 404, {}, b''
+    return 200, {'Content-Type': 'application/vnd.mapbox-vector-tile',
+                 'Cache-Control': 'public, max-age=86400'}, get_tile(name, version, z, x, y)
+
+
+# fetched by the map, from the origin of the Streamlit page
+register_route('tiles', _handle_tile_request, cross_origin=True)
+
+
+def register_layer(name: str, frame: pd.DataFrame, resolution: int,
+                   aggregations: Dict[str, str] = None) -> str:
+    """Serves a per-cell table as the vector tile layer `name` and returns its tile URL template.
+
+    Args:
+        name (str): layer name, used in the URL and as the MVT layer name.
+        frame (pd.DataFrame): numeric columns indexed by uint64 H3 cell.
+        resolution (int): H3 resolution of the cells.
+        aggregations (Dict[str, str], optional): pandas aggregation of each column
+            when cells are rolled up at low zooms. Defaults to DEFAULT_AGGREGATIONS,
+            and 'sum' for the other columns.
+
+    Returns:
+        str: URL template with `{z}/{x}/{y}` placeholders.
+    """
+    layer = HexagonLayer(frame, resolution, aggregations or DEFAULT_AGGREGATIONS)
+    key = (name, layer.version)
+    with _layers_lock:
+        # the same table registered again on a rerun keeps its rolled up levels
+        if key not in _layers:
+            _layers[key] = layer
+        _layers.move_to_end(key)
+        while len(_layers) > TILE_LAYERS_MAX:
+            _layers.popitem(last=False)
+    base_url = ensure_server()
+    return f'{base_url}/tiles/{name}/{layer.version}/{{z}}/{{x}}/{{y}}.pbf'
+
+
+class VectorTileLayer(MacroElement):
+    """Leaflet.VectorGrid layer of an H3 tile layer, colored by `value_property`."""
+
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = L.vectorGrid.protobuf({{ this.url|tojson }}, {
+                vectorTileLayerStyles: {
+                    {{ this.layer_name|tojson }}: function(properties, zoom) {
+                        var value = properties[{{ this.value_property|tojson }}];
+                        var breaks = {{ this.breaks|tojson }};
+                        var colors = {{ this.colors|tojson }};
+                        var color = colors[0];
+                        for (var i = 0; i < breaks.length; i++) {
+                            if (value >= breaks[i]) { color = colors[i + 1]; }
+                        }
+                        return {fill: true, fillColor: color, fillOpacity: 0.6,
+                                color: color, weight: 0.5};
+                    }
+                },
+                interactive: true,
+                maxNativeZoom: 22
+            }).addTo({{ this._parent.get_name() }});
+        {% endmacro %}
+        """)
+
+    def __init__(self, url: str, layer_name: str, breaks: list, colors: list,
+                 value_property: str = 'count'):
+        super().__init__()
+        self._name = 'VectorTileLayer'
+        self.url = url
+        self.layer_name = layer_name
+        self.value_property = value_property
+        self.breaks = [float(value) for value in breaks]
+        self.colors = list(colors)
+
+    def render(self, **kwargs):
+        self.get_root().header.add_child(JavascriptLink(VECTORGRID_JS_URL),
+                                         name='leaflet_vectorgrid')
+        super().render(**kwargs)
+
+
+def hexagon_tiles_map(
+    tile_url: str,
+    layer_name: str,
+    values: pd.Series,
+    center_location: list,
+    zoom_start: float = 5.5,
+    tiles: str = "cartodbpositron",
+    colors: list = ('#ffffb2', '#fecc5c', '#fd8d3c', '#f03b20', '#bd0026')
+) -> 'folium.Map':
+    """Returns a folium map that loads an H3 layer through the tile service.
+
+    Only the tiles in view are fetched, so the page size does not depend
+    on the number of cells. Colors are split at the quantiles of `values`.
+    """
+    fmap = folium.Map(location=center_location, zoom_start=zoom_start, tiles=tiles)
+    quantiles = np.linspace(0, 1, len(colors) + 1)[1:-1]
+    breaks = np.quantile(values.to_numpy(), quantiles) if len(values) else []
+    VectorTileLayer(tile_url, layer_name, breaks=breaks, colors=colors).add_to(fmap)
+    return fmap
@@ -0,0 +1,218 @@
+"""Zonal statistics of rasters (GeoTIFF) over H3 cells, with windowed reads.
+
+The cells are grouped into blocks of about `ZONAL_BLOCK_PX` x `ZONAL_BLOCK_PX`
+raster pixels. For each block, only the window covering the bounding boxes
+of its cells is read, the cells are rasterized once into a label array of
+the window and the statistics of all the cells are computed together with
+`np.bincount`. Blocks are processed in a thread pool (rasterio and numpy
+release the GIL), each thread with its own dataset handle, so the memory
+used is bounded by the number of threads times the block size whatever
+the size of the raster.
+
+A pixel belongs to the cell containing its center. Nodata pixels are ignored.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Tuple
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import rasterio
+from rasterio.features import rasterize
+from rasterio.windows import Window, from_bounds
+
+from turpy.logger import log
+from h3_funtools import cells_to_polygons, h3_to_int_array
+from reproject import to_crs
+
+# side of the blocks of cells read at once, in raster pixels
+ZONAL_BLOCK_PX = 2048
+STATISTICS = ('count', 'mean', 'sum', 'min', 'max', 'majority')
+# largest (cells x distinct values) histogram used for the majority
+ZONAL_MAJORITY_DENSE_SIZE = 2 ** 24
+# zonal statistics kept in memory for the reruns of the app
+ZONAL_CACHE_SIZE = 32
+
+
+def _block_window(dataset, bounds: np.ndarray) -> Window:
+    """Window of `dataset` covering `bounds` (minx, miny, maxx, maxy), snapped to whole pixels."""
+    minx, miny = bounds[:, 0].min(), bounds[:, 1].min()
+    maxx, maxy = bounds[:, 2].max(), bounds[:, 3].max()
+    window = from_bounds(minx, miny, maxx, maxy, transform=dataset.transform)
+    col_off, row_off = int(np.floor(window.col_off)), int(np.floor(window.row_off))
+    col_stop = int(np.ceil(window.col_off + window.width))
+    row_stop = int(np.ceil(window.row_off + window.height))
+    col_off, row_off = max(col_off, 0), max(row_off, 0)
+    col_stop, row_stop = min(col_stop, dataset.width), min(row_stop, dataset.height)
+    return Window(col_off, row_off, max(col_stop - col_off, 0), max(row_stop - row_off, 0))
+
+
+def _majority(labels: np.ndarray, values: np.ndarray, n: int) -> np.ndarray:
+    """Most frequent value per label (the smallest one on ties), NaN for empty labels."""
+    majority = np.full(n, np.nan)
+    if len(labels) == 0:
+        return majority
+    # sorted codes, so that the first maximum is the smallest value
+    codes, uniques = pd.factorize(values, sort=True)
+    n_values = len(uniques)
+    keys = labels.astype(np.int64) * n_values + codes
+    if n * n_values <= ZONAL_MAJORITY_DENSE_SIZE:
+        # categorical rasters: a dense (label, value) histogram
+        counts = np.bincount(keys, minlength=n * n_values).reshape(n, n_values)
+        has_data = counts.any(axis=1)
+        majority[has_data] = uniques[counts[has_data].argmax(axis=1)]
+        return majority
+    keys, counts = np.unique(keys, return_counts=True)
+    key_labels = keys // n_values
+    # per label, the key with the highest count first
+    order = np.lexsort((-counts, key_labels))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = key_labels[order][1:] != key_labels[order][:-1]
+    best = order[first]
+    majority[key_labels[best]] = uniques[keys[best] % n_values]
+    return majority
+
+
+def _block_statistics(dataset, band: int, polygons: gpd.GeoSeries, bounds: np.ndarray,
+                      statistics: Tuple[str, ...]) -> dict:
+    n = len(polygons)
+    window = _block_window(dataset, bounds)
+    result = {name: np.full(n, np.nan) for name in statistics}
+    if 'count' in result:
+        result['count'][:] = 0
+    if window.width <= 0 or window.height <= 0:
+        return result
+
+    data = dataset.read(band, window=window, masked=True)
+    # label 0 is "no cell"
+    labels = rasterize(
+        zip(polygons.values, range(1, n + 1)), out_shape=data.shape,
+        transform=dataset.window_transform(window), fill=0, dtype='int32')
+    valid = (labels > 0) & ~np.ma.getmaskarray(data)
+    labels = labels[valid] - 1
+    values = np.asarray(data.data[valid], dtype=np.float64)
+
+    count = np.bincount(labels, minlength=n)
+    has_data = count > 0
+    if 'count' in result:
+        result['count'] = count.astype(np.float64)
+    if 'sum' in result or 'mean' in result:
+        total = np.bincount(labels, weights=values, minlength=n)
+        if 'sum' in result:
+            result['sum'][has_data] = total[has_data]
+        if 'mean' in result:
+            result['mean'][has_data] = total[has_data] / count[has_data]
+    if 'min' in result:
+        minimum = np.full(n, np.inf)
+        np.minimum.at(minimum, labels, values)
+        result['min'][has_data] = minimum[has_data]
+    if 'max' in result:
+        maximum = np.full(n, -np.inf)
+        np.maximum.at(maximum, labels, values)
+        result['max'][has_data] = maximum[has_data]
+    if 'majority' in result:
+        result['majority'] = _majority(labels, values, n)
+    return result
+
+
+def zonal_statistics(
+        raster_filepath: str,
+        cells: Iterable,
+        statistics: Tuple[str, ...] = ('mean', 'sum', 'majority'),
+        band: int = 1,
+        block_px: int = ZONAL_BLOCK_PX,
+        n_workers: int = None,
+        prefix: str = None) -> pd.DataFrame:
+    """Computes statistics of a raster band over each of `cells`.
+
+    Args:
+        raster_filepath (str): GeoTIFF (or any raster readable by rasterio) with a CRS.
+        cells (Iterable): H3 cells, as integers or hexadecimal strings.
+        statistics (Tuple[str, ...], optional): among STATISTICS. Defaults to ('mean', 'sum', 'majority').
+        band (int, optional): band read. Defaults to 1.
+        block_px (int, optional): side of the blocks read at once, in pixels. Defaults to ZONAL_BLOCK_PX.
+        n_workers (int, optional): threads reading blocks. Defaults to None (ThreadPoolExecutor default).
+        prefix (str, optional): prefix of the column names. Defaults to the raster file stem.
+
+    Returns:
+        pd.DataFrame: one column `{prefix}_{statistic}` per statistic, indexed by uint64 cell.
+        Cells without valid pixels have a count of 0 and NaN statistics.
+    """
+    unknown = set(statistics) - set(STATISTICS)
+    if unknown:
+        raise ValueError(f'unknown statistics {sorted(unknown)}, expected some of {STATISTICS}')
+    cells = np.unique(h3_to_int_array(cells))
+    prefix = prefix or os.path.splitext(os.path.basename(raster_filepath))[0]
+    columns = [f'{prefix}_{name}' for name in statistics]
+    if len(cells) == 0:
+        return pd.DataFrame({column: np.empty(0) for column in columns},
+                            index=pd.Index(cells, name='cell'))
+
+    with rasterio.open(raster_filepath) as dataset:
+        raster_crs = dataset.crs
+        pixel_width, pixel_height = abs(dataset.transform.a), abs(dataset.transform.e)
+    polygons = to_crs(gpd.GeoSeries(cells_to_polygons(cells), crs='EPSG:4326'), raster_crs)
+    bounds = polygons.bounds.to_numpy()
+
+    # cells are grouped by the block of pixels containing the center of their bounding box
+    block_x = np.floor((bounds[:, 0] + bounds[:, 2]) / 2 / (block_px * pixel_width)).astype(np.int64)
+    block_y = np.floor((bounds[:, 1] + bounds[:, 3]) / 2 / (block_px * pixel_height)).astype(np.int64)
+    _, block = np.unique(np.stack([block_x, block_y]), axis=1, return_inverse=True)
+    block = block.ravel()
+    order = np.argsort(block, kind='stable')
+    splits = np.flatnonzero(np.diff(block[order])) + 1
+    blocks = np.split(order, splits)
+
+    local = threading.local()
+
+    def process(members: np.ndarray) -> Tuple[np.ndarray, dict]:
+        if not hasattr(local, 'dataset'):
+            # rasterio datasets must not be shared between threads
+            local.dataset = rasterio.open(raster_filepath)
+            datasets.append(local.dataset)
+        return members, _block_statistics(
+            local.dataset, band, polygons.iloc[members], bounds[members], tuple(statistics))
+
+    datasets = []
+    result = {name: np.full(len(cells), np.nan) for name in statistics}
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as pool:
+            for members, block_result in pool.map(process, blocks):
+                for name, values in block_result.items():
+                    result[name][members] = values
+    finally:
+        for dataset in datasets:
+            dataset.close()
+
+    log.info(f'zonal statistics of {raster_filepath} over {len(cells)} cells '
+             f'in {len(blocks)} blocks')
+    return pd.DataFrame({f'{prefix}_{name}': values for name, values in result.items()},
+                        index=pd.Index(cells, name='cell'))
+
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def cached_zonal_statistics(raster_filepath: str, cells: Iterable, **kwargs) -> pd.DataFrame:
+    """`zonal_statistics`, memoized in the process on the raster file, the cells and the arguments."""
+    cells = np.unique(h3_to_int_array(cells))
+    stat = os.stat(raster_filepath)
+    key = (os.path.abspath(raster_filepath), stat.st_mtime_ns, stat.st_size,
+           hashlib.blake2b(cells.tobytes(), digest_size=16).hexdigest(),
+           tuple(sorted((name, value if not isinstance(value, list) else tuple(value))
+                        for name, value in kwargs.items())))
+    with _cache_lock:
+        if key in _cache:
+            _cache.move_to_end(key)
+            return _cache[key].copy()
+    frame = zonal_statistics(raster_filepath, cells, **kwargs)
+    with _cache_lock:
+        _cache[key] = frame
+        while len(_cache) > ZONAL_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return frame.copy()
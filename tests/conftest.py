@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the app modules import each other as top-level modules (`from config import ...`),
+# as they do when streamlit runs `project/app.py`
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'project'))
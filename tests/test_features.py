@@ -0,0 +1,54 @@
+import json
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point
+
+import features
+
+
+@pytest.fixture
+def gdf():
+    return gpd.GeoDataFrame(
+        {'name': ['a', None, 'c'],
+         'value': [1.5, np.nan, 3.0],
+         'when': pd.to_datetime(['2021-01-02 03:04:05', None, '2021-03-04 00:00:00']),
+         'tz_when': pd.to_datetime(['2021-01-02', '2021-01-03', None]).tz_localize('UTC'),
+         'count': pd.array([1, None, 3], dtype='Int64')},
+        geometry=[Point(18.0, 59.3), Point(18.1, 59.4), None],
+        index=[10, 11, 12], crs='EPSG:4326')
+
+
+@pytest.mark.parametrize('use_orjson', [True, False])
+def test_datetimes_and_missing_values(gdf, monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(features, 'orjson', None)
+    elif features.orjson is None:
+        pytest.skip('orjson is not installed')
+
+    collection = json.loads(features.encode_geodataframe(gdf))
+    properties = [feature['properties'] for feature in collection['features']]
+    assert [p['when'] for p in properties] == ['2021-01-02 03:04:05', None, '2021-03-04 00:00:00']
+    assert [p['tz_when'] for p in properties] == [
+        '2021-01-02 00:00:00+00:00', '2021-01-03 00:00:00+00:00', None]
+    assert [p['name'] for p in properties] == ['a', None, 'c']
+    assert [p['value'] for p in properties] == [1.5, None, 3.0]
+    assert [p['count'] for p in properties] == [1, None, 3]
+    assert collection['features'][2]['geometry'] is None
+
+
+def test_index_as_id_matches_to_json(gdf):
+    gdf = gdf[['name', 'geometry']]
+    expected = json.loads(gdf.to_json())
+    collection = json.loads(features.encode_geodataframe(gdf, index_as_id=True))
+    assert [f['id'] for f in collection['features']] == [f['id'] for f in expected['features']]
+    assert [f['properties'] for f in collection['features']] == [
+        f['properties'] for f in expected['features']]
+
+
+def test_ids_from_column(gdf):
+    collection = json.loads(features.encode_geodataframe(gdf[['name', 'geometry']], id_column='name'))
+    assert [f['id'] for f in collection['features']] == ['a', None, 'c']
+    assert all(f['properties'] == {} for f in collection['features'])
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+import pytest
+from h3.api import numpy_int as h3_int
+
+import h3_neighbors
+
+K = 2
+
+
+@pytest.fixture(scope='module')
+def counts():
+    """Counts on a patch of cells with gaps, indexed by uint64 cell."""
+    rng = np.random.default_rng(0)
+    center = h3_int.geo_to_h3(59.33, 18.06, 8)
+    cells = np.array(sorted(h3_int.k_ring(center, 6)), dtype=np.uint64)
+    cells = cells[rng.random(len(cells)) < 0.6]
+    return pd.Series(rng.poisson(5, len(cells)).astype(float), index=cells, name='count')
+
+
+def test_k_ring_sum_matches_k_ring(counts):
+    values = counts.to_dict()
+    expected = {cell: sum(values.get(neighbor, 0.0) for neighbor in h3_int.k_ring(cell, K))
+                for cell in counts.index}
+    result = h3_neighbors.k_ring_sum(counts, k=K)
+    assert sorted(result.index) == sorted(expected)
+    np.testing.assert_allclose(result.loc[list(expected)].to_numpy(), list(expected.values()))
+
+
+def test_getis_ord_g_matches_k_ring(counts):
+    # the study area: the observed cells and the cells up to K rings around them, 0 if unobserved
+    cells = sorted({neighbor for cell in counts.index for neighbor in h3_int.k_ring(cell, K)})
+    x = counts.reindex(np.array(cells, dtype=np.uint64), fill_value=0.0)
+    n, mean = len(x), x.mean()
+    s = np.sqrt((x ** 2).mean() - mean ** 2)
+    expected = {}
+    for cell in cells:
+        neighbors = [neighbor for neighbor in h3_int.k_ring(cell, K) if neighbor in x.index]
+        w = len(neighbors)
+        expected[cell] = (x.loc[neighbors].sum() - mean * w) / (s * np.sqrt((n * w - w ** 2) / (n - 1)))
+
+    result = h3_neighbors.getis_ord_g(counts, k=K)
+    assert sorted(result.index) == cells
+    np.testing.assert_allclose(result['z'].loc[cells].to_numpy(), [expected[cell] for cell in cells])
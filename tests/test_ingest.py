@@ -0,0 +1,115 @@
+import io
+import json
+import os
+
+import pandas as pd
+import pytest
+
+import ingest
+
+ROWS_PER_STATION = 3
+
+
+def tsv(rows) -> io.BytesIO:
+    lines = ['station\tframe\tdepth'] + ['\t'.join(str(value) for value in row) for row in rows]
+    return io.BytesIO(('\n'.join(lines) + '\n').encode())
+
+
+def station_rows(station, depth=1.5):
+    return [(station, frame, depth) for frame in range(ROWS_PER_STATION)]
+
+
+def run(stream, tmp_path, **kwargs):
+    kwargs = {'station_column': 'station', 'chunk_stations': 2,
+              'rows_per_station': ROWS_PER_STATION, **kwargs}
+    return ingest.ingest_tsv(stream, name='stations.tsv', output_dirpath=str(tmp_path), **kwargs)
+
+
+def test_valid_file_is_written_whole(tmp_path):
+    rows = [row for station in ('A', 'B', 'C', 'D', 'E') for row in station_rows(station)]
+    report = run(tsv(rows), tmp_path)
+    assert (report['rows'], report['rows_written'], report['blocks'], report['invalid_blocks']) == (15, 15, 5, 0)
+    assert report['errors'] == []
+    assert report['dtypes'] == {'station': 'string', 'frame': 'Int64', 'depth': 'float64'}
+
+    frame = pd.read_parquet(report['parquet_filepath'])
+    assert frame['station'].tolist() == [station for station in 'ABCDE' for _ in range(ROWS_PER_STATION)]
+    assert frame[ingest.BLOCK_COLUMN].tolist() == [block for block in range(5) for _ in range(ROWS_PER_STATION)]
+    # only the Parquet file and its report are left
+    assert sorted(os.listdir(tmp_path)) == sorted(
+        os.path.basename(report['parquet_filepath'])[:-len('.parquet')] + suffix
+        for suffix in ('.parquet', '.json'))
+
+
+def test_invalid_blocks_are_left_out_and_reported(tmp_path):
+    rows = (station_rows('A')
+            + [('B', 0, 1.0), ('C', 1, 1.0), ('B', 2, 1.0)]    # several station ids
+            + station_rows('A')                                # station already ingested
+            + [('', 0, 1.0)] + station_rows('D')[1:]           # missing station id
+            + station_rows('E')
+            + station_rows('F')[:2])                           # incomplete last block
+    report = run(tsv(rows), tmp_path)
+    assert report['blocks'] == 6
+    assert report['invalid_blocks'] == 4
+    assert [(error['block'], error['reason']) for error in report['errors']] == [
+        (1, 'several station ids'), (2, 'station already ingested'),
+        (3, 'missing station id'), (5, 'incomplete block of 2 rows')]
+    assert report['errors'][2]['line'] == 2 + 3 * ROWS_PER_STATION
+    assert report['errors'][1]['station'] == 'A'
+
+    frame = pd.read_parquet(report['parquet_filepath'])
+    assert report['rows_written'] == len(frame) == 2 * ROWS_PER_STATION
+    assert frame['station'].unique().tolist() == ['A', 'E']
+    assert sorted(frame[ingest.BLOCK_COLUMN].unique()) == [0, 4]
+
+
+def test_dtypes_of_the_first_chunk_are_enforced(tmp_path):
+    # the frame of a later chunk is not an integer
+    rows = station_rows('A') + station_rows('B') + [('C', 'x', 1.0)] * ROWS_PER_STATION
+    with pytest.raises(ValueError, match='stations.tsv'):
+        run(tsv(rows), tmp_path)
+    # nothing is left of a failed ingestion
+    assert os.listdir(tmp_path) == []
+
+
+def test_given_dtypes_override_inference(tmp_path):
+    rows = station_rows(1) + station_rows(2)
+    report = run(tsv(rows), tmp_path, dtypes={'station': 'string', 'depth': 'float32'})
+    assert report['dtypes']['station'] == 'string'
+    frame = pd.read_parquet(report['parquet_filepath'])
+    assert frame['station'].tolist()[:1] == ['1']
+    assert str(frame['depth'].dtype) == 'float32'
+
+
+def test_unknown_station_column(tmp_path):
+    with pytest.raises(ValueError, match="no column 'site'"):
+        run(tsv(station_rows('A')), tmp_path, station_column='site')
+
+
+def test_empty_file(tmp_path):
+    with pytest.raises(ValueError, match='no rows'):
+        run(tsv([]), tmp_path)
+
+
+def test_same_upload_is_ingested_once(tmp_path, monkeypatch):
+    rows = station_rows('A') + station_rows('B')
+    report = run(tsv(rows), tmp_path)
+
+    def fail(*args, **kwargs):
+        raise AssertionError('ingested again')
+
+    monkeypatch.setattr(ingest, 'BlockValidator', fail)
+    assert run(tsv(rows), tmp_path) == report
+    with open(report['parquet_filepath'][:-len('.parquet')] + '.json') as f:
+        assert json.load(f) == report
+    # other parameters make another file
+    monkeypatch.undo()
+    assert run(tsv(rows), tmp_path, station_column=None)['parquet_filepath'] != report['parquet_filepath']
+
+
+def test_read_header_and_preview(tmp_path):
+    stream = tsv(station_rows('A'))
+    assert ingest.read_header(stream) == ['station', 'frame', 'depth']
+    assert stream.tell() == 0
+    report = run(stream, tmp_path)
+    assert len(ingest.preview(report['parquet_filepath'], rows=2)) == 2
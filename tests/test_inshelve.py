@@ -0,0 +1,148 @@
+import pickle
+import shelve
+import sqlite3
+
+import pytest
+
+import inshelve
+
+
+@pytest.fixture
+def shelf(tmp_path):
+    shelf = inshelve.Shelf(str(tmp_path / 'shelf.sqlite'))
+    yield shelf
+    shelf.close()
+
+
+def test_persist_keeps_other_fields_and_order(shelf):
+    shelf.persist({'b': 1, 'a': 2}, 'table')
+    shelf.persist({'c': 3, 'b': 10}, 'table')
+    assert shelf.read('table') == {'b': 10, 'a': 2, 'c': 3}
+    assert shelf.keys('table') == ['b', 'a', 'c']
+    assert shelf.read_fields('table', ['a', 'missing']) == {'a': 2}
+    assert shelf.read('missing') is None
+
+
+def test_field_names_are_stored_canonically(shelf):
+    shelf.persist({('x', 1): 'tuple', 1: 'int', None: 'none', frozenset({1}): 'pickled'}, 'table')
+    shelf.persist({('x', 1): 'tuple again'}, 'table')
+    assert shelf.read('table') == {('x', 1): 'tuple again', 1: 'int', None: 'none',
+                                   frozenset({1}): 'pickled'}
+
+
+def test_empty_table_exists(shelf):
+    shelf.persist({}, 'empty')
+    assert shelf.read('empty') == {}
+    assert 'empty' in shelf
+
+
+def test_delete(shelf):
+    shelf.persist({'a': 1, 'b': 2}, 'table')
+    shelf.delete('table', ['a'])
+    assert shelf.read('table') == {'b': 2}
+    shelf.delete('table')
+    assert shelf.read('table') is None
+
+
+def test_batch_is_rolled_back(shelf):
+    shelf.persist({'a': 1}, 'table')
+    with pytest.raises(KeyError):
+        with shelf.batch():
+            shelf.persist({'a': 2}, 'table')
+            raise KeyError('a')
+    assert shelf.read('table') == {'a': 1}
+
+
+def test_version_0_database_is_migrated(tmp_path):
+    filepath = str(tmp_path / 'shelf.sqlite')
+    # field names pickled, no `tables` table and user_version 0
+    connection = sqlite3.connect(filepath)
+    connection.executescript("""
+        CREATE TABLE fields (table_key TEXT NOT NULL, field BLOB NOT NULL, value BLOB NOT NULL,
+                             UNIQUE (table_key, field));
+        CREATE TABLE generations (table_key TEXT PRIMARY KEY, generation INTEGER NOT NULL);
+    """)
+    connection.executemany('INSERT INTO fields VALUES (?, ?, ?)', [
+        ('table', pickle.dumps('Cod'), pickle.dumps(1)),
+        ('table', pickle.dumps(('x', 1)), pickle.dumps(2)),
+        ('other', pickle.dumps(3), pickle.dumps(3))])
+    connection.commit()
+    connection.close()
+
+    shelf = inshelve.Shelf(filepath)
+    try:
+        assert shelf.read('table') == {'Cod': 1, ('x', 1): 2}
+        assert sorted(shelf.tables()) == ['other', 'table']
+        # the migrated names address the same rows as the new ones
+        shelf.persist({'Cod': 10}, 'table')
+        assert shelf.read('table') == {'Cod': 10, ('x', 1): 2}
+    finally:
+        shelf.close()
+    connection = sqlite3.connect(filepath)
+    assert connection.execute('PRAGMA user_version').fetchone()[0] == inshelve._SCHEMA_VERSION
+    connection.close()
+
+
+def test_legacy_shelve_is_imported(tmp_path):
+    legacy = str(tmp_path / 'legacy_shelve')
+    with shelve.open(legacy) as db:
+        db['biota_columns'] = {'Gadus morhua': 1, 'Perca fluviatilis': 2}
+        db['not_a_table'] = [1, 2]
+    shelf = inshelve.Shelf(str(tmp_path / 'shelf.sqlite'), legacy_shelve_filepath=legacy)
+    try:
+        assert shelf.read('biota_columns') == {'Gadus morhua': 1, 'Perca fluviatilis': 2}
+        assert shelf.read('not_a_table') is None
+    finally:
+        shelf.close()
+
+
+@pytest.fixture
+def species(shelf):
+    shelf.persist({'Gadus morhua': 1, 'Gadus  Morhua ': 2, 'Perca fluviatilis': 3,
+                   'Perca': 4, 'Esox lucius': 5}, 'species')
+    return shelf
+
+
+def test_match_exact(species):
+    index = species.index('species')
+    assert index.match(['Perca', 'Esox lucius', 'missing']) == ['Perca', 'Esox lucius']
+
+
+def test_match_normalized(species):
+    index = species.index('species')
+    assert index.match(['gadus MORHUA'], normalize=True) == ['Gadus morhua', 'Gadus  Morhua ']
+
+
+def test_match_prefix(species):
+    index = species.index('species')
+    assert index.match(['perca'], prefix=True) == ['Perca fluviatilis', 'Perca']
+
+
+def test_match_fuzzy(species):
+    index = species.index('species')
+    assert index.match(['Esox lucious'], fuzzy_cutoff=0.8) == ['Esox lucius']
+    assert index.match(['Salmo salar'], fuzzy_cutoff=0.8) == []
+
+
+def test_index_is_rebuilt_after_a_write(species):
+    index = species.index('species')
+    assert species.index('species') is index
+    species.persist({'Salmo salar': 6}, 'species')
+    rebuilt = species.index('species')
+    assert rebuilt is not index
+    assert rebuilt.match(['Salmo salar']) == ['Salmo salar']
+
+
+def test_match_in_shelve(species, monkeypatch):
+    monkeypatch.setattr(inshelve, 'get_shelf', lambda filepath=None: species)
+    assert inshelve.match_in_shelve(['perca'], table_key='species', prefix=True) == [
+        'Perca fluviatilis', 'Perca']
+    assert inshelve.match_in_shelve(['perca'], table_key='missing') is None
+
+
+def test_shelf_persist_and_read(tmp_path):
+    filepath = str(tmp_path / 'shelf.sqlite')
+    assert inshelve.shelf_persist({'a': 1}, 'table', filepath)
+    assert inshelve.shelf_read('table', filepath) == {'table': {'a': 1}}
+    assert inshelve.shelf_read('missing', filepath) is None
+    inshelve.get_shelf(filepath).close()
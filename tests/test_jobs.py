@@ -0,0 +1,144 @@
+import os
+import time
+
+import pytest
+
+import jobs
+
+
+def count_runs(counter_filepath, value, delay=0.0, progress=None):
+    """Job stage: records its run in `counter_filepath` and returns `value` squared."""
+    with open(counter_filepath, 'a') as f:
+        f.write('run\n')
+    time.sleep(delay)
+    progress(0.5, 'half way')
+    return value ** 2
+
+
+def fail(counter_filepath, message, progress=None):
+    """Job stage that records its run and raises."""
+    with open(counter_filepath, 'a') as f:
+        f.write('run\n')
+    raise RuntimeError(message)
+
+
+def runs(counter_filepath) -> int:
+    if not os.path.exists(counter_filepath):
+        return 0
+    with open(counter_filepath) as f:
+        return len(f.readlines())
+
+
+def wait(job, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while not job.done:
+        assert time.monotonic() < deadline, f'job {job.key} still {job.status}'
+        time.sleep(0.05)
+    return job
+
+
+@pytest.fixture
+def runner(tmp_path):
+    runner = jobs.JobRunner(jobs.JobRegistry(str(tmp_path / 'jobs')), max_workers=2)
+    yield runner
+    runner.shutdown()
+
+
+def test_key_depends_on_function_and_params():
+    key = jobs.job_key(count_runs, {'value': 1})
+    assert key == jobs.job_key(count_runs, {'value': 1})
+    assert key == jobs.job_key(f'{__name__}.count_runs', {'value': 1})
+    assert key != jobs.job_key(count_runs, {'value': 2})
+    assert key != jobs.job_key(fail, {'value': 1})
+
+
+def test_same_job_is_submitted_once(runner, tmp_path):
+    counter = str(tmp_path / 'runs')
+    first = runner.submit(count_runs, counter_filepath=counter, value=3, delay=1.0)
+    second = runner.submit(count_runs, counter_filepath=counter, value=3, delay=1.0)
+    assert first.key == second.key
+    assert wait(first).status == jobs.DONE
+    assert first.result() == 9
+
+    # a finished job is reused, and its future forgotten
+    third = runner.submit(count_runs, counter_filepath=counter, value=3, delay=1.0)
+    assert third.status == jobs.DONE and third.result() == 9
+    assert runs(counter) == 1
+    assert runner._futures == {}
+
+
+def test_versions_make_a_new_job(runner, tmp_path):
+    counter = str(tmp_path / 'runs')
+    first = wait(runner.submit(count_runs, versions={'input': 'a'}, counter_filepath=counter, value=2))
+    second = wait(runner.submit(count_runs, versions={'input': 'b'}, counter_filepath=counter, value=2))
+    assert first.key != second.key
+    assert first.result() == second.result() == 4
+    assert runs(counter) == 2
+
+
+def test_failed_job_is_only_rerun_when_asked(runner, tmp_path):
+    counter = str(tmp_path / 'runs')
+    job = wait(runner.submit(fail, counter_filepath=counter, message='boom'))
+    assert job.status == jobs.FAILED
+    assert 'boom' in job.error
+    with pytest.raises(RuntimeError, match='boom'):
+        job.result()
+
+    assert runner.submit(fail, counter_filepath=counter, message='boom').status == jobs.FAILED
+    assert runs(counter) == 1
+    rerun = wait(runner.submit(fail, rerun_failed=True, counter_filepath=counter, message='boom'))
+    assert rerun.key == job.key
+    assert rerun.status == jobs.FAILED
+    assert runs(counter) == 2
+
+
+def test_job_by_name_runs_in_worker(runner, tmp_path):
+    counter = str(tmp_path / 'runs')
+    job = wait(runner.submit(f'{__name__}.count_runs', counter_filepath=counter, value=5))
+    assert job.result() == 25
+
+
+def test_done_job_is_reused_after_restart(tmp_path):
+    counter = str(tmp_path / 'runs')
+    registry_dirpath = str(tmp_path / 'jobs')
+    runner = jobs.JobRunner(jobs.JobRegistry(registry_dirpath), max_workers=1)
+    try:
+        wait(runner.submit(count_runs, counter_filepath=counter, value=4))
+    finally:
+        runner.shutdown()
+
+    restarted = jobs.JobRunner(jobs.JobRegistry(registry_dirpath), max_workers=1)
+    try:
+        job = restarted.submit(count_runs, counter_filepath=counter, value=4)
+        assert job.status == jobs.DONE and job.result() == 16
+        assert restarted._pool is None
+    finally:
+        restarted.shutdown()
+    assert runs(counter) == 1
+
+
+def test_job_of_a_dead_process_is_submitted_again(tmp_path):
+    counter = str(tmp_path / 'runs')
+    registry = jobs.JobRegistry(str(tmp_path / 'jobs'))
+    params = {'counter_filepath': counter, 'value': 6}
+    key = jobs.job_key(count_runs, params)
+    # left running by an app process that no longer exists (above the largest pid of Linux)
+    registry.create(key, 'count_runs', params, owner_pid=2 ** 22 + 1)
+    registry.update(key, status=jobs.RUNNING)
+
+    runner = jobs.JobRunner(registry, max_workers=1)
+    try:
+        job = wait(runner.submit(count_runs, **params))
+        assert job.key == key and job.result() == 36
+    finally:
+        runner.shutdown()
+    assert runs(counter) == 1
+
+
+def test_missing_result_is_computed_again(runner, tmp_path):
+    counter = str(tmp_path / 'runs')
+    job = wait(runner.submit(count_runs, counter_filepath=counter, value=7))
+    runner.registry.result_filepath(job.key).unlink()
+    job = wait(runner.submit(count_runs, counter_filepath=counter, value=7))
+    assert job.result() == 49
+    assert runs(counter) == 2
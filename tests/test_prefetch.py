@@ -0,0 +1,133 @@
+import hashlib
+import json
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import prefetch
+
+PAYLOAD = bytes(range(256)) * 4096  # 1 MiB
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    """Stand-in for the file host: serves `files`, honours `Range` and can cut a response short."""
+    files = {}
+    ranges = []
+    truncate_next = []
+
+    def do_GET(self):
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        header = self.headers.get('Range')
+        self.ranges.append(header)
+        start = int(re.match(r'bytes=(\d+)-', header).group(1)) if header else 0
+        if start >= len(data):
+            self.send_error(416)
+            return
+        self.send_response(206 if header else 200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(len(data) - start))
+        if header:
+            self.send_header('Content-Range', f'bytes {start}-{len(data) - 1}/{len(data)}')
+        self.end_headers()
+        body = data[start:]
+        if self.truncate_next:
+            body = body[:self.truncate_next.pop()]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    RangeHandler.files = {'/a.gpkg': PAYLOAD, '/b.gpkg': PAYLOAD[::-1]}
+    RangeHandler.ranges = []
+    RangeHandler.truncate_next = []
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), RangeHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_address[1]}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_records_checksum(server, tmp_path):
+    filepath = prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path)
+
+    assert filepath.read_bytes() == PAYLOAD
+    assert not (tmp_path / 'a.gpkg.part').exists()
+    manifest = json.loads((tmp_path / prefetch.MANIFEST_FILENAME).read_text())
+    assert manifest['a.gpkg']['sha256'] == hashlib.sha256(PAYLOAD).hexdigest()
+    assert prefetch.verify_dataset('a.gpkg', dirpath=tmp_path)
+
+
+def test_interrupted_download_is_resumed(server, tmp_path):
+    RangeHandler.truncate_next = [1000]
+
+    prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path, backoff=0)
+
+    assert (tmp_path / 'a.gpkg').read_bytes() == PAYLOAD
+    assert RangeHandler.ranges == [None, 'bytes=1000-']
+
+
+def test_complete_part_file_is_finalized(server, tmp_path):
+    (tmp_path / 'a.gpkg.part').write_bytes(PAYLOAD)
+
+    prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path)
+
+    assert (tmp_path / 'a.gpkg').read_bytes() == PAYLOAD
+
+
+def test_corrupt_file_is_downloaded_again(server, tmp_path):
+    prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path)
+    (tmp_path / 'a.gpkg').write_bytes(PAYLOAD[:10])
+
+    assert not prefetch.verify_dataset('a.gpkg', dirpath=tmp_path)
+    prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path)
+    assert (tmp_path / 'a.gpkg').read_bytes() == PAYLOAD
+
+
+def test_prefetch_datasets(server, tmp_path):
+    data_url_dict = {1: {'URL': f'{server}/a.gpkg', 'name': 'a.gpkg'},
+                     2: {'URL': f'{server}/b.gpkg', 'name': 'b.gpkg'},
+                     3: {'URL': f'{server}/missing.gpkg', 'name': 'missing.gpkg'}}
+
+    results = prefetch.prefetch_datasets(data_url_dict, dirpath=tmp_path, max_workers=3)
+
+    assert results['a.gpkg'].read_bytes() == PAYLOAD
+    assert results['b.gpkg'].read_bytes() == PAYLOAD[::-1]
+    assert isinstance(results['missing.gpkg'], Exception)
+    assert not (tmp_path / 'missing.gpkg').exists()
+
+
+def test_concurrent_records_are_kept(tmp_path):
+    names = [f'{i}.gpkg' for i in range(20)]
+    threads = [threading.Thread(target=prefetch.Manifest(tmp_path).record, args=(name,), kwargs={'size': 1})
+               for name in names]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert sorted(prefetch.Manifest(tmp_path).read()) == sorted(names)
+    assert [path.name for path in tmp_path.iterdir()] == [prefetch.MANIFEST_FILENAME]
+
+
+def test_corrupt_manifest_is_checked_again(server, tmp_path):
+    prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path)
+    (tmp_path / prefetch.MANIFEST_FILENAME).write_text('{"a.gpkg": ')
+
+    assert not prefetch.verify_dataset('a.gpkg', dirpath=tmp_path)
+    assert prefetch.fetch_dataset(f'{server}/a.gpkg', 'a.gpkg', dirpath=tmp_path).read_bytes() == PAYLOAD
+    assert prefetch.verify_dataset('a.gpkg', dirpath=tmp_path)
+
+
+def test_drive_share_links_are_made_direct():
+    url = 'https://drive.google.com/file/d/abc123/view?usp=sharing'
+    assert 'id=abc123' in prefetch.direct_download_url(url)
+    assert prefetch.direct_download_url('http://127.0.0.1/a.gpkg') == 'http://127.0.0.1/a.gpkg'
@@ -0,0 +1,115 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import pytest
+from shapely.geometry import Point, Polygon
+
+import spatial_join
+
+
+@pytest.fixture(autouse=True)
+def data_dirpath(tmp_path, monkeypatch):
+    # the polyfills are memoized in ./data
+    monkeypatch.chdir(tmp_path)
+
+
+def random_points(n: int, seed: int = 0) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    return gpd.GeoDataFrame(
+        {'id': np.arange(n), 'name': 'point'},
+        geometry=gpd.points_from_xy(rng.uniform(17.8, 18.3, n), rng.uniform(59.2, 59.5, n)),
+        index=pd.Index(rng.permutation(n) * 10, name='point_id'), crs='EPSG:4326')
+
+
+def detailed_polygons() -> gpd.GeoDataFrame:
+    """Two overlapping star-shaped polygons with many vertices, and a small square, in SWEREF 99 TM."""
+    def star(x, y, radius, n=400):
+        angles = np.linspace(0, 2 * np.pi, n, endpoint=False)
+        radii = radius * (1 + 0.2 * np.sin(7 * angles))
+        return Polygon(np.column_stack([x + radii * np.cos(angles), y + radii * np.sin(angles)]))
+
+    center = gpd.GeoSeries([Point(18.05, 59.35)], crs='EPSG:4326').to_crs('EPSG:3006').iloc[0]
+    x, y = center.x, center.y
+    return gpd.GeoDataFrame(
+        {'name': ['west', 'east', 'square']},
+        geometry=[star(x - 3_000, y, 6_000), star(x + 3_000, y, 5_000),
+                  Polygon([(x, y + 9_000), (x + 500, y + 9_000), (x + 500, y + 9_500), (x, y + 9_500)])],
+        index=pd.Index([7, 3, 5], name='zone'), crs='EPSG:3006')
+
+
+def assert_same_as_sjoin(result: gpd.GeoDataFrame, points: gpd.GeoDataFrame, polygons: gpd.GeoDataFrame):
+    # the points keep their CRS, sjoin wants both in the same one
+    expected = gpd.sjoin(points.to_crs(polygons.crs), polygons, how='inner', predicate='intersects')
+    assert len(result) > 0
+    assert list(result.columns) == list(expected.columns)
+    assert result.crs == points.crs
+    assert result.geometry.geom_equals(points.geometry.loc[result.index]).all()
+
+    sort = ['id', 'index_right']
+    pd.testing.assert_frame_equal(
+        pd.DataFrame(result.drop(columns='geometry')).reset_index().sort_values(sort, ignore_index=True),
+        pd.DataFrame(expected.drop(columns='geometry')).reset_index().sort_values(sort, ignore_index=True),
+        check_dtype=False)
+
+
+def test_prefilter_is_used_for_detailed_polygons():
+    polygons = detailed_polygons()
+    assert spatial_join.prefilter_resolution(polygons) >= 0
+    assert spatial_join.prefilter_resolution(polygons.iloc[[2]]) == -1
+
+
+@pytest.mark.parametrize('resolution', [None, -1])
+def test_join_matches_sjoin(resolution):
+    points, polygons = random_points(20_000), detailed_polygons()
+    result = spatial_join.points_in_polygons(points, polygons, resolution=resolution, chunk_size=3_000)
+    assert_same_as_sjoin(result, points, polygons)
+
+
+def test_points_on_the_boundary_match():
+    polygons = gpd.GeoDataFrame({'name': ['square']},
+                                geometry=[Polygon([(0, 0), (10, 0), (10, 10), (0, 10)])], crs='EPSG:3006')
+    points = gpd.GeoDataFrame({'id': [0, 1, 2]}, geometry=[Point(0, 5), Point(10, 10), Point(11, 5)],
+                              crs='EPSG:3006')
+    result = spatial_join.points_in_polygons(points, polygons)
+    assert result['id'].tolist() == [0, 1]
+    assert_same_as_sjoin(result, points, polygons)
+
+
+def test_pairs_are_sorted_and_reuse_the_polygons():
+    points, polygons = random_points(5_000, seed=1), detailed_polygons()
+    join = spatial_join.PointInPolygonJoin(polygons)
+    # some points are matched by their cell alone
+    assert join.resolution >= 0 and len(join._resolved) > 0
+    pairs = join.pairs(points, chunk_size=700)
+    assert list(pairs.columns) == ['point', 'polygon']
+    assert pairs.equals(pairs.sort_values(['point', 'polygon']).reset_index(drop=True))
+    # overlapping polygons: some points are in two of them
+    assert pairs['point'].duplicated().any()
+    assert_same_as_sjoin(join.join(random_points(5_000, seed=2)), random_points(5_000, seed=2), polygons)
+
+
+def test_no_points():
+    result = spatial_join.points_in_polygons(random_points(0), detailed_polygons())
+    assert len(result) == 0
+
+
+def without_crs(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    return gpd.GeoDataFrame(gdf.drop(columns='geometry'), geometry=list(gdf.geometry))
+
+
+def test_crs_is_required():
+    points, polygons = random_points(10), detailed_polygons()
+    with pytest.raises(ValueError, match='polygons must have a CRS'):
+        spatial_join.PointInPolygonJoin(without_crs(polygons))
+    with pytest.raises(ValueError, match='points must have a CRS'):
+        spatial_join.points_in_polygons(without_crs(points), polygons)
+
+
+def test_points_without_geometry_match_nothing():
+    points = random_points(2_000, seed=3)
+    points.geometry.iloc[:5] = None
+    points.geometry.iloc[5:10] = Point()
+    polygons = detailed_polygons()
+    result = spatial_join.points_in_polygons(points, polygons, chunk_size=700)
+    assert not result.index.isin(points.index[:10]).any()
+    assert_same_as_sjoin(result, points.iloc[10:], polygons)